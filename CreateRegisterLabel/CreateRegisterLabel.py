@@ -4,6 +4,9 @@ from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import time # for measuring time of processing steps
+import tempfile
+import numpy
+from PreProcess import StageTrace, timedStage, PreProcessLogic, ProstatePhantom, PhantomBenchmark
 
 #
 # CreateRegisterLabel
@@ -21,7 +24,7 @@ class CreateRegisterLabel(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "CreateRegisterLabel" # TODO make this more human readable by adding spaces
     self.parent.categories = ["Prostate"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ['PreProcess']
     self.parent.contributors = ["John Doe (AnyWare Corp.)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
     This is an example of scripted loadable module bundled in an extension.
@@ -185,6 +188,7 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  @timedStage
   def ThresholdAbove(self, inputVolume, thresholdVal, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
@@ -200,6 +204,7 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  @timedStage
   def ImageLabelCombine(self, inputLabelA, inputLabelB, outputLabel):
     """ Combines labelmaps with label A overwriting label B if any overlapping area
     """
@@ -215,7 +220,7 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
-  def run(self, inputCapsule, inputCG, inputVM, outputLabel):
+  def run(self, inputCapsule, inputCG, inputVM, outputLabel, traceDirectory=None):
     """
     Run the actual algorithm
     """
@@ -224,17 +229,12 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
     logging.info('\n\nProcessing started')
     start_time_overall = time.time() # start timer
 
-    # Combine CG and Capsule Labelmaps
-    self.ImageLabelCombine(inputCG, inputCapsule, outputLabel) 
-
-    # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
-    self.ThresholdAbove(outputLabel, 1.5, 0) # PZ has value of 1
-
-    # # Threshold VM to 1 before adding
-    self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
-
-    # # Add VM to output Label
-    self.ImageLabelCombine(outputLabel, inputVM, outputLabel) # first label overwrites 2nd label
+    # Build PZ + VM registration label in a single pass without changing the inputs (same operator as PreProcess module)
+    trace = StageTrace('CreateRegisterLabel', '', traceDirectory).start()
+    try:
+        PreProcessLogic().CreateRegistrationLabel(inputCapsule, inputCG, inputVM, outputLabel)
+    finally:
+        trace.finish()
 
     # Print to Slicer CLI
     end_time_overall = time.time()
@@ -263,37 +263,26 @@ class CreateRegisterLabelTest(ScriptedLoadableModuleTest):
     self.test_CreateRegisterLabel1()
 
   def test_CreateRegisterLabel1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """ Benchmarks creating the registration label of a synthetic prostate phantom (no downloads), checks it against the phantom
+    and fails if it became slower than the stored baseline (see PhantomBenchmark)
     """
+    self.delayDisplay("Starting the phantom benchmark")
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    phantom = ProstatePhantom()
     logic = CreateRegisterLabelLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    benchmark = PhantomBenchmark('CreateRegisterLabel').start(tempfile.mkdtemp())
+
+    masks = phantom.usMasks
+    inputCapsule = phantom.createVolume('capsule', masks['capsule'].astype(numpy.uint8), labelmap=True)
+    inputCG      = phantom.createVolume('cg', 2*masks['cg'].astype(numpy.uint8), labelmap=True)
+    inputVM      = phantom.createVolume('vm', 3*masks['urethra'].astype(numpy.uint8), labelmap=True)
+    outputLabel  = PreProcessLogic().CreateNewLabelVolume('registration')
+    self.assertTrue( logic.hasImageData(inputCapsule) )
+
+    benchmark.time('run', logic.run, inputCapsule, inputCG, inputVM, outputLabel)
+    expected = (masks['capsule'] & ~masks['cg']) | masks['urethra'] # PZ and VM
+    self.assertTrue( numpy.array_equal(PreProcessLogic().arrayFromVolume(outputLabel) > 0, expected) )
+
+    regressions = benchmark.finish()
+    self.assertEqual( regressions, [] )
     self.delayDisplay('Test passed!')
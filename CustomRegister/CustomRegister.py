@@ -4,9 +4,16 @@ from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import time
+import hashlib
+import json
+import tempfile
+import multiprocessing
+import collections
+import numpy
 
 import SimpleITK as sitk
-import sitkUtils
+from vtk.util import numpy_support
+from PreProcess import PreProcessLogic, PreProcessStageCache, SimpleITKBridge, IntermediateNodes, RunCheckpoint, StageTrace, timedStage, traceStage, ProstatePhantom, PhantomBenchmark
 
 #
 # CustomRegister
@@ -27,7 +34,7 @@ class CustomRegister(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "CustomRegister"
     self.parent.categories = ["Prostate"]
-    self.parent.dependencies = ['SegmentationSmoothing','QuadEdgeSurfaceMesher']
+    self.parent.dependencies = ['SegmentationSmoothing','QuadEdgeSurfaceMesher','PreProcess']
     self.parent.contributors = ["Andrey Fedorov (BWH), Andras Lasso (Queen's University), Tyler Glass (Nightingale Lab)"]
     self.parent.helpText = """
     This module performs distance-based image registration using segmentations 
@@ -296,6 +303,14 @@ class CustomRegisterWidget(ScriptedLoadableModuleWidget):
 
     # self.registrationModeGroup.connect('buttonClicked(int)',self.onVisualizationModeClicked)
 
+    #
+    # Distance map cache
+    #
+    self.DistanceMapCacheCheckBox = qt.QCheckBox("Reuse Cached Distance Maps")
+    self.DistanceMapCacheCheckBox.toolTip = "Skip cropping, smoothing and distance mapping of labels whose voxels and bounding box have not changed since a previous run."
+    self.DistanceMapCacheCheckBox.checked = True
+    parametersFormLayout.addRow(self.DistanceMapCacheCheckBox)
+
     #
     # Apply Button
     #
@@ -330,7 +345,8 @@ class CustomRegisterWidget(ScriptedLoadableModuleWidget):
     pass
 
   def onApplyButton(self):
-    logic = CustomRegisterLogic()
+    distanceMapCache = PreProcessStageCache(os.path.join(slicer.app.temporaryPath, 'DistanceMapCache')) if self.DistanceMapCacheCheckBox.checked else None
+    logic = CustomRegisterLogic(distanceMapCache=distanceMapCache)
 
     # self.parameterNode.SetAttribute('FixedImageNodeID',             self.fixedImageSelector.currentNode().GetID())
     self.parameterNode.SetAttribute('FixedLabelNodeID',             self.fixedImageLabelSelector.currentNode().GetID())
@@ -408,6 +424,33 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  distanceMapMemoryBytes = 512*1024**2 # size of the in-memory distance map cache of each logic (see preProcessLabel)
+
+  overlapMetricNames = ('dice', 'jaccard', 'volumeDifference', 'falsePositiveRate', 'falseNegativeRate') # see OverlapMetrics
+
+  def __init__(self, intermediateMemoryBudget=1024**3, maxConcurrentRegistrations=None, registrationThreads=2, distanceMapCache=None):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # Optional PreProcessStageCache of the smoothed labels and distance maps made by preProcessLabel. With it, the smoothed labels and
+    # distance maps of recent calls are also kept in memory by cache key, least recently used entries are dropped beyond distanceMapMemoryBytes
+    self.distanceMapCache = distanceMapCache
+    self.distanceMapMemoryCache = collections.OrderedDict()
+    # Extra segmentationsmoothing CLI parameters used by preProcessLabel (part of the distance map cache key)
+    self.labelSmoothingParameters = {}
+    # Trials of the experiment sweep run as concurrent BRAINSFit processes with a fixed ITK thread budget each, so they do not
+    # oversubscribe the cores and every trial runs with the same number of threads however many run at once
+    self.registrationThreads = registrationThreads
+    self.maxConcurrentRegistrations = maxConcurrentRegistrations or max(1, multiprocessing.cpu_count()//registrationThreads)
+    # NumPy volume helpers and batched label smoothing shared with the PreProcess module
+    self.preProcessLogic = PreProcessLogic()
+    # SimpleITK images of volume nodes without sitkUtils file round trips, counting the bytes copied
+    self.bridge = SimpleITKBridge(self.preProcessLogic)
+    # Cropped labels and trial volumes are removed once their stage is done, released distance maps and smoothed labels
+    # stay in the scene for visualization until they exceed the memory budget (bytes), oldest first
+    self.intermediates = IntermediateNodes(intermediateMemoryBudget)
+    self.checkpoint = None # RunCheckpoint of the running experiment
+    # (key, displacement) of the last transform evaluated on a fixed grid by DisplacementField, shared by all labels of a trial
+    self.displacementField = (None, None)
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -435,7 +478,23 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def run(self, parameterNode):
+  def run(self, parameterNode, traceDirectory=None, checkpointDirectory=None, resume=False, patient=''):
+    """ Runs the registration experiment with a stage trace (Chrome trace JSON and CSV) written to traceDirectory.
+    With a checkpointDirectory the affine registration and every finished trial are checkpointed for the patient, and resume reuses them
+    """
+    trace = StageTrace('CustomRegister', patient, traceDirectory).start()
+    self.intermediates.start()
+    if checkpointDirectory:
+        self.checkpoint = RunCheckpoint(checkpointDirectory, 'CustomRegister', patient, resume)
+    try:
+        return self.runExperiment(parameterNode)
+    finally:
+        self.checkpoint = None
+        self.intermediates.finish()
+        trace.finish()
+
+  @timedStage
+  def runExperiment(self, parameterNode):
     """
     Run the actual algorithm
     """
@@ -487,10 +546,31 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     movingLabelSmoothed = slicer.util.getNode(slicer.mrmlScene.GetNodeByID(movingLabelNodeID).GetName()+'-Smoothed')
     parameterNode.SetAttribute('MovingLabelSmoothedID',movingLabelSmoothed.GetID())
     print('Moving label processing done')
+    # kept for visualization after the run as long as they fit the memory budget
+    self.intermediates.register(fixedLabelDistanceMap, fixedLabelSmoothed, movingLabelDistanceMap, movingLabelSmoothed)
+
+    # Checkpoint records are named by the content of all input labels and the registration parameters, so a resumed run with other labels
+    # or parameters does not reuse them
+    affineParameters = {'useRigid':True,'useAffine':True,'numberOfSamples':'10000','costMetric':'MSE'}
+    splineGridSize = '3,3,3'
+    experimentKey = self.ExperimentKey([slicer.mrmlScene.GetNodeByID(fixedLabelNodeID), slicer.mrmlScene.GetNodeByID(movingLabelNodeID),
+                                        fixedSimilarityLabel1Node, fixedSimilarityLabel2Node, fixedSimilarityLabel3Node, fixedSimilarityLabel4Node,
+                                        movingSimilarityLabel1Node, movingSimilarityLabel2Node, movingSimilarityLabel3Node, movingSimilarityLabel4Node],
+                                       {'bbMin': [int(x) for x in bbMin], 'bbMax': [int(x) for x in bbMax], 'labelSmoothing': self.labelSmoothingParameters,
+                                        'affine': affineParameters, 'splineGridSize': splineGridSize})
 
     # run affine registration
-    registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useRigid':True,'useAffine':True,'numberOfSamples':'10000','costMetric':'MSE','outputTransform':affineTransformNode.GetID()}
-    slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
+    affineRecordName = 'AffineRegistration-' + experimentKey
+    affineRecord = self.checkpoint.readRecord(affineRecordName) if self.checkpoint else None
+    if affineRecord:
+        self.SetTransformMatrix(affineTransformNode, affineRecord['matrix'])
+        print('Affine registration loaded from checkpoint')
+    else:
+        registrationParameters = dict(affineParameters, fixedVolume=fixedLabelDistanceMap.GetID(), movingVolume=movingLabelDistanceMap.GetID(), outputTransform=affineTransformNode.GetID())
+        with traceStage('AffineRegistration', {'numberOfSamples': 10000, 'costMetric': 'MSE'}):
+            slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
+        if self.checkpoint:
+            self.checkpoint.writeRecord(affineRecordName, {'matrix': self.GetTransformMatrix(affineTransformNode)})
     parameterNode.SetAttribute('AffineTransformNodeID',affineTransformNode.GetID())
     print('affineRegistrationCompleted!')
 
@@ -501,10 +581,15 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     # print('bsplineRegistrationCompleted!')
 
     # Smooth fixed labels prior to looping over registration
-    self.LabelMapSmoothing(fixedSimilarityLabel1Node, fixedSimilarityLabel1Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel2Node, fixedSimilarityLabel2Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel3Node, fixedSimilarityLabel3Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel4Node, fixedSimilarityLabel4Node, 0.4)
+    with traceStage('BatchLabelMapSmoothing', {'sigma': 0.4, 'labels': 'fixed'}):
+        self.preProcessLogic.BatchLabelMapSmoothing(0.4, fixedSimilarityLabel1Node, fixedSimilarityLabel2Node, fixedSimilarityLabel3Node, fixedSimilarityLabel4Node)
+
+    # Smooth moving labels once, every trial starts from copies of these
+    movingSimilarityLabelsSmoothed = [self.CloneVolumeData(movingLabelNode, movingLabelNode.GetName()+'-SimilaritySmoothed')
+                                      for movingLabelNode in (movingSimilarityLabel1Node, movingSimilarityLabel2Node, movingSimilarityLabel3Node, movingSimilarityLabel4Node)]
+    self.intermediates.register(*movingSimilarityLabelsSmoothed) # released when the run finishes
+    with traceStage('BatchLabelMapSmoothing', {'sigma': 0.4, 'labels': 'moving'}):
+        self.preProcessLogic.BatchLabelMapSmoothing(0.4, *movingSimilarityLabelsSmoothed)
 
     # Initialize Inputs to Experiment
     #=================================================#
@@ -519,62 +604,35 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     # Initialize Variables
     NumberofSamples  = ['Number of Samples']
     RegisterTimes    = ['Registration Time']
+    EvaluationTimes  = ['Evaluation Time']
     SimilarityLabel1 = ['Similarity of '+LabelTypes[0]]
     SimilarityLabel2 = ['Similarity of '+LabelTypes[1]]
     SimilarityLabel3 = ['Similarity of '+LabelTypes[2]]
     SimilarityLabel4 = ['Similarity of '+LabelTypes[3]]
     Trial_Number     = ['Trial Number']
+    OverlapRows      = [] # all overlap metrics, one row per trial and similarity label
     
-    # Loop for experiment
-    for numSamp in numSamplestoTry:
-        for trial in range(0,numTrials):
-            trial_num = trial+1 # trial number
-
-            # Run first BSpline stage for registration
-            newTransformNode = self.CreateNewTransform(trial_num,numSamp)
-            register_time, DeformableTransformNode = self.bsplineRegisterNumSamp(fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSamp,'3,3,3')
-
-            # Apply transform to moving volume similarity nodes and compute similarity metric
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[0]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel1Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue1 = self.ComputeSimilarityMetric(fixedSimilarityLabel1Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[1]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel2Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue2 = self.ComputeSimilarityMetric(fixedSimilarityLabel2Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[2]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel3Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue3 = self.ComputeSimilarityMetric(fixedSimilarityLabel3Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[3]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel4Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue4 = self.ComputeSimilarityMetric(fixedSimilarityLabel4Node, newVolumeNode)
-
-            # Append values to results variables
-            Trial_Number.append(trial_num)
-            NumberofSamples.append(numSamp)
-            SimilarityLabel1.append(similarityValue1)
-            SimilarityLabel2.append(similarityValue2)
-            SimilarityLabel3.append(similarityValue3)
-            SimilarityLabel4.append(similarityValue4)
-            RegisterTimes.append(register_time)
-
-            # Print status to CLI
-            print "\n\n===================="
-            print "Last event Completed..."
-            print "Trial Number: %i"  % trial_num
-            print "Sample Number: %i" % numSamp
-            print "====================\n\n"
-            
+    # Loop for experiment: the trials are independent, so their registrations run concurrently and the rows come back in sweep order
+    trials = [(numSamp, trial+1) for numSamp in numSamplestoTry for trial in range(0,numTrials)] # (number of samples, trial number)
+    evaluateTrial = lambda numSamp, trial_num, DeformableTransformNode: self.EvaluateTrial(numSamp, trial_num, DeformableTransformNode, LabelTypes,
+        movingSimilarityLabelsSmoothed, (fixedSimilarityLabel1Node, fixedSimilarityLabel2Node, fixedSimilarityLabel3Node, fixedSimilarityLabel4Node), bbMin, bbMax)
+    for numSamp, trial_num, register_time, overlaps, evaluation_time in self.RunTrialSweep(trials, fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode, splineGridSize, evaluateTrial,
+                                                                                                     experimentKey):
+        if overlaps is None: # registration failed
+            overlaps = [dict.fromkeys(self.overlapMetricNames, float('nan')) for labelType in LabelTypes]
+        similarityValue1, similarityValue2, similarityValue3, similarityValue4 = [overlap['dice'] for overlap in overlaps] # similarity index
+        OverlapRows += [[trial_num, numSamp, labelType] + [overlap[name] for name in self.overlapMetricNames] + [evaluation_time]
+                        for labelType, overlap in zip(LabelTypes, overlaps)]
+
+        # Append values to results variables
+        Trial_Number.append(trial_num)
+        NumberofSamples.append(numSamp)
+        SimilarityLabel1.append(similarityValue1)
+        SimilarityLabel2.append(similarityValue2)
+        SimilarityLabel3.append(similarityValue3)
+        SimilarityLabel4.append(similarityValue4)
+        RegisterTimes.append(register_time)
+        EvaluationTimes.append(evaluation_time)
 
     # Print variables to Slicer CLI after all trials done
     print "Number of Samples",
@@ -583,6 +641,8 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     print Trial_Number
     print "Reg. Times",
     print RegisterTimes
+    print "Eval. Times",
+    print EvaluationTimes
     print "Similarity Values",
     print SimilarityLabel1
     print SimilarityLabel2
@@ -591,6 +651,10 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     # Write results to CSV file
     self.WriteCSVResults(CSV_filename,Trial_Number,NumberofSamples,RegisterTimes,SimilarityLabel1,SimilarityLabel2,SimilarityLabel3,SimilarityLabel4)
+    self.WriteOverlapCSV(os.path.splitext(CSV_filename)[0]+'_overlap.csv', OverlapRows)
+
+    # Bytes copied between volume nodes and SimpleITK images
+    self.bridge.report()
 
     # Print results to Slicer CLI
     end_time_overall = time.time()
@@ -614,6 +678,15 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
 
 
+  def WriteOverlapCSV(self, CSVFilename, overlapRows):
+    # Writes all overlap metrics of the experiment to CSV, one row per trial and similarity label
+    import csv
+    with open(CSVFilename, 'wb') as overlapFile:
+        csv_writer = csv.writer(overlapFile)
+        csv_writer.writerow(['Trial Number', 'Number of Samples', 'Label'] + list(self.overlapMetricNames) + ['Evaluation Time'])
+        for overlapRow in overlapRows:
+            csv_writer.writerow(overlapRow)
+
   def CreateNewTransform(self, trial_num, numSamp):
     transformNode = slicer.vtkMRMLTransformNode()
     slicer.mrmlScene.AddNode(transformNode)
@@ -653,6 +726,119 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return volumeNode
 
+  def ExperimentKey(self, labelNodes, parameters):
+    """ Returns a short key of the content of the label nodes and the experiment parameters, used to name checkpoint records
+    """
+    description = json.dumps([[self.preProcessLogic.NodeKey(labelNode) for labelNode in labelNodes], parameters], sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+
+  def TrialRecordName(self, numSamp, trial_num, experimentKey=''):
+    return 'Trial-%snsamp%i-%i' % (experimentKey + '-' if experimentKey else '', numSamp, trial_num)
+
+  def RunTrialSweep(self, trials, fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode, splineGridSizeInput, evaluateTrial, experimentKey=''):
+    """ Runs the BSpline registration of every (number of samples, trial number) in trials as background BRAINSFit processes, at most
+    maxConcurrentRegistrations at once with registrationThreads ITK threads each, and calls evaluateTrial(numSamp, trial_num, transformNode)
+    on the main thread as each registration finishes. Trials checkpointed by an interrupted run with the same experimentKey (see ExperimentKey)
+    are not registered again.
+    Returns [numSamp, trial_num, registration time, evaluation, evaluation time] rows in the order of trials whatever order they finish in
+    (the evaluation of a failed registration is None)
+    """
+    results = {}
+    pending = []
+    for numSamp, trial_num in trials:
+        trialRecord = self.checkpoint.readRecord(self.TrialRecordName(numSamp, trial_num, experimentKey)) if self.checkpoint else None
+        if trialRecord:
+            results[(numSamp, trial_num)] = (trialRecord['registerTime'], trialRecord['similarities'], trialRecord.get('evaluationTime', 0.0))
+            print('Trial %i with %i samples loaded from checkpoint') % (trial_num, numSamp)
+        else:
+            pending.append((numSamp, trial_num))
+    print('Registration sweep: %i trials to run, %i at once with %i ITK threads each') % (len(pending), self.maxConcurrentRegistrations, self.registrationThreads)
+
+    running = [] # (numSamp, trial_num, transform node, CLI node, start time, lane)
+    finished = [] # (numSamp, trial_num, transform node, registration time) of registrations waiting for their evaluation
+    while pending or running or finished:
+        # Fill free slots with pending registrations
+        while pending and len(running) < self.maxConcurrentRegistrations:
+            numSamp, trial_num = pending.pop(0)
+            newTransformNode = self.CreateNewTransform(trial_num, numSamp)
+            registrationParameters = self.BSplineRegistrationParameters(fixedLabelDistanceMap, movingLabelDistanceMap, newTransformNode, affineTransformNode,
+                                                                        numSamp, splineGridSizeInput)
+            cliNode = slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=False)
+            lanes = [entry[5] for entry in running]
+            running.append((numSamp, trial_num, newTransformNode, cliNode, time.time(), min(set(range(len(running)+1)) - set(lanes))))
+
+        # Let the CLI nodes report completion to the main thread
+        slicer.app.processEvents()
+        if not finished:
+            time.sleep(0.05)
+
+        # Stamp the end of every registration that finished since the last pass before evaluating any of them,
+        # so the registration times do not include evaluations of other trials
+        noticed = time.time()
+        for entry in list(running):
+            numSamp, trial_num, newTransformNode, cliNode, startTime, lane = entry
+            if cliNode.IsBusy():
+                continue
+            running.remove(entry)
+            register_time = noticed - startTime
+            if StageTrace.active:
+                StageTrace.active.addStage('bsplineRegisterNumSamp', {'numSamp': numSamp, 'trial': trial_num}, startTime, lane, cliRuns=1)
+            if cliNode.GetStatus() != cliNode.Completed:
+                # reported in the CSV and not checkpointed, so a resumed run registers it again
+                logging.error('RunTrialSweep: registration of trial %i with %i samples finished with status %s' % (trial_num, numSamp, cliNode.GetStatusString()))
+                results[(numSamp, trial_num)] = (register_time, None, 0.0)
+                continue
+            print('Trial %i with %i samples registered (%0.2f s)') % (trial_num, numSamp, register_time)
+            finished.append((numSamp, trial_num, newTransformNode, register_time))
+
+        # Evaluate one finished trial per pass, so registrations ending meanwhile are stamped and their slots refilled in between
+        if finished:
+            numSamp, trial_num, newTransformNode, register_time = finished.pop(0)
+            evaluation_start = time.time()
+            with traceStage('Trial', {'numSamp': numSamp, 'trial': trial_num}):
+                similarities = list(evaluateTrial(numSamp, trial_num, newTransformNode))
+            evaluation_time = time.time() - evaluation_start
+            print('Trial %i with %i samples evaluated (%0.2f s)') % (trial_num, numSamp, evaluation_time)
+            results[(numSamp, trial_num)] = (register_time, similarities, evaluation_time)
+            if self.checkpoint:
+                self.checkpoint.writeRecord(self.TrialRecordName(numSamp, trial_num, experimentKey), {'numSamp': numSamp, 'trial': trial_num, 'registerTime': register_time,
+                                                                                       'similarities': similarities, 'evaluationTime': evaluation_time})
+
+            # Print status to CLI
+            print "\n\n===================="
+            print "Last event Completed..."
+            print "Trial Number: %i"  % trial_num
+            print "Sample Number: %i" % numSamp
+            print "====================\n\n"
+
+    return [[numSamp, trial_num] + list(results[(numSamp, trial_num)]) for numSamp, trial_num in trials]
+
+  def EvaluateTrial(self, numSamp, trial_num, DeformableTransformNode, LabelTypes, movingSimilarityLabelsSmoothed, fixedSimilarityLabelNodes, bbMin=None, bbMax=None):
+    """ Resamples the smoothed moving similarity labels through the BSpline transform of a trial onto the fixed label grid (all labels in one
+    pass, see ResampleLabelsThroughTransform) and returns their overlap metrics with the fixed labels (see ComputeOverlapMetrics), both within
+    the registration crop box if one is given
+    """
+    newVolumeNodes = []
+    for labelType in LabelTypes:
+        newVolumeNode = self.CreateNewVolume(trial_num,numSamp,labelType) # create a new node for the transformed label
+        self.intermediates.register(newVolumeNode) # freed after the trial once over the memory budget
+        newVolumeNodes.append(newVolumeNode)
+    self.ResampleLabelsThroughTransform(DeformableTransformNode, movingSimilarityLabelsSmoothed, fixedSimilarityLabelNodes[0], newVolumeNodes, 20, bbMin, bbMax)
+    with traceStage('BatchLabelMapSmoothing', {'sigma': 0.3, 'labels': 'transformed'}):
+        self.preProcessLogic.BatchLabelMapSmoothing(0.3, *newVolumeNodes)
+
+    overlaps = self.ComputeOverlapMetrics(fixedSimilarityLabelNodes, newVolumeNodes, bbMin, bbMax)
+    print('%-20s' + ' %18s'*len(self.overlapMetricNames)) % (('Label',) + self.overlapMetricNames)
+    for labelType, overlap in zip(LabelTypes, overlaps):
+        print('%-20s' + ' %18.4f'*len(self.overlapMetricNames)) % ((labelType,) + tuple(overlap[name] for name in self.overlapMetricNames))
+    return overlaps
+
+  def BSplineRegistrationParameters(self,fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSampInput,splineGridSizeInput):
+    return {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':str(splineGridSizeInput),
+            'numberOfSamples':str(numSampInput),'costMetric':'MSE','bsplineTransform':newTransformNode.GetID(),'initialTransform':affineTransformNode.GetID(),
+            'numberOfThreads':self.registrationThreads}
+
+  @timedStage
   def bsplineRegisterNumSamp(self,fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSampInput,splineGridSizeInput):
     """ Performs bspline registration for inputted nodes with inputted number of samples
     """
@@ -660,7 +846,7 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     print('Running BSpline Registration...'),
     start_time = time.time()
 
-    registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':str(splineGridSizeInput),'numberOfSamples':str(numSampInput),'costMetric':'MSE','bsplineTransform':newTransformNode.GetID(),'initialTransform':affineTransformNode.GetID()}
+    registrationParameters = self.BSplineRegistrationParameters(fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSampInput,splineGridSizeInput)
     slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
     print('bsplineRegistrationCompleted!'),
 
@@ -670,15 +856,119 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return float(end_time-start_time), newTransformNode
 
-  def transformNodewithBspline(self, movingSimilarityLabel, BSPLINETransform):
-    # tranform input node using bspline transform from registration
-    movingSimilarityLabel.SetAndObserveTransformNodeID(BSPLINETransform.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(movingSimilarityLabel) # hardens transform
+  @timedStage
+  def ResampleLabelsThroughTransform(self, transformNode, movingLabelNodes, referenceVolume, outputNodes, labelValue, bbMin=None, bbMax=None):
+    """ Resamples up to eight moving labels (on one grid) through a transform node onto the grid of a reference volume in one pass and writes
+    them to the output nodes with labelValue. The labels are packed into the bits of one multi-label image, the transform is evaluated once
+    (see DisplacementField) and the eight neighbours of every voxel are read once for all labels. Hardening the transform on a label of value L
+    rounded its linearly interpolated value and thresholded it above 0.5, so a voxel is labelled where the interpolated fraction of the label
+    is at least 0.5/L (L being the largest value of the moving label). With bbMin and bbMax only the crop box (see getBoundingBox) is resampled
+    and the voxels outside it are 0
+    """
+    print('Resampling %i labels through %s...') % (len(movingLabelNodes), transformNode.GetName()),
+    start_time = time.time()
 
-  def processTransformedNode(self, inputNode):
-    # threshold and smooth an input node
-    self.ThresholdScalarVolume(inputNode, 20) # set to label value of 20
-    self.LabelMapSmoothing(inputNode, inputNode, 0.3)
+    # Pack the labels into one multi-label image, one bit per label
+    movingArrays = [self.bridge.arrayFromVolume(labelNode) for labelNode in movingLabelNodes]
+    if len(movingArrays) > 8:
+        raise ValueError('ResampleLabelsThroughTransform: at most 8 labels can be packed, got %i' % len(movingArrays))
+    packedLabels = numpy.zeros(movingArrays[0].shape, dtype=numpy.uint8)
+    movingLabelValues = [float(movingArray.max()) for movingArray in movingArrays]
+    for bit, movingArray in enumerate(movingArrays):
+        if movingArray.shape != packedLabels.shape:
+            raise ValueError('ResampleLabelsThroughTransform: labels of different sizes %s and %s' % (packedLabels.shape, movingArray.shape))
+        packedLabels |= (movingArray != 0).view(numpy.uint8) << numpy.uint8(bit)
+
+    # Continuous moving (i,j,k) index of every reference voxel centre within the crop box
+    referenceShape = self.bridge.arrayFromVolume(referenceVolume).shape
+    crop = self.CropBox(referenceShape, bbMin, bbMax)
+    fixedPoints = self.VoxelCentres(referenceVolume, crop)
+    movingPoints = fixedPoints + self.DisplacementField(transformNode, referenceVolume, crop)
+    rasToIJK = self.MatrixArray(self.preProcessLogic.WorldIJKToRAS(movingLabelNodes[0]))
+    rasToIJK = numpy.linalg.inv(rasToIJK)
+    movingIndex = numpy.dot(movingPoints, rasToIJK[:3, :3].T) + rasToIJK[:3, 3]
+
+    # Trilinear interpolation of all labels, reading the packed labels once per neighbour
+    lowerIndex = numpy.floor(movingIndex).astype(numpy.intp)
+    fraction = movingIndex - lowerIndex
+    interpolated = numpy.zeros((len(movingArrays), len(movingIndex)))
+    upperBound = numpy.array(packedLabels.shape[::-1])
+    for corner in range(8):
+        offset = numpy.array([(corner >> axis) & 1 for axis in range(3)])
+        cornerIndex = lowerIndex + offset
+        weight = numpy.prod(numpy.where(offset, fraction, 1.0-fraction), axis=1)
+        inside = numpy.all((cornerIndex >= 0) & (cornerIndex < upperBound), axis=1) & (weight > 0)
+        cornerIndex = cornerIndex[inside]
+        cornerLabels = packedLabels[cornerIndex[:, 2], cornerIndex[:, 1], cornerIndex[:, 0]]
+        weight = weight[inside]
+        for bit in range(len(movingArrays)):
+            interpolated[bit, inside] += weight * ((cornerLabels >> bit) & 1)
+
+    cropShape = tuple(box.stop - box.start for box in crop)
+    for bit, outputNode in enumerate(outputNodes):
+        outputArray = numpy.zeros(referenceShape, dtype=numpy.uint8)
+        outputArray[crop] = numpy.where(movingLabelValues[bit]*interpolated[bit] >= 0.5, labelValue, 0).reshape(cropShape)
+        self.preProcessLogic.updateVolumeFromArray(outputNode, outputArray, referenceVolume)
+
+    end_time = time.time()
+    print('done (%0.2f s)') % float(end_time-start_time)
+
+  def DisplacementField(self, transformNode, referenceVolume, crop):
+    """ Returns the displacement (RAS, (N,3) in C order of the (k,j,i) crop) that a transform node applies to the voxel centres of a reference
+    grid, evaluated from parent as hardening a volume resamples it. The field of the last transform is kept until the transform, the grid
+    or the crop box changes, so the labels of a trial share one evaluation of the BSpline
+    """
+    transform = transformNode.GetTransformFromParent()
+    key = (transformNode.GetID(), transformNode.GetMTime(), transform.GetMTime(), tuple(self.MatrixArray(self.preProcessLogic.WorldIJKToRAS(referenceVolume)).ravel()),
+           tuple((box.start, box.stop) for box in crop))
+    if self.displacementField[0] != key:
+        fixedPoints = self.VoxelCentres(referenceVolume, crop)
+        self.displacementField = (key, self.EvaluateTransform(transform, fixedPoints) - fixedPoints)
+    return self.displacementField[1]
+
+  def EvaluateTransform(self, transform, points):
+    # transforms an (N,3) array of RAS points with a VTK transform in one call
+    inputPoints = vtk.vtkPoints()
+    inputPoints.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(points, dtype=numpy.float64), deep=True))
+    outputPoints = vtk.vtkPoints()
+    outputPoints.SetDataTypeToDouble()
+    transform.TransformPoints(inputPoints, outputPoints)
+    return numpy_support.vtk_to_numpy(outputPoints.GetData()).copy()
+
+  def CropBox(self, shape, bbMin=None, bbMax=None):
+    # (k,j,i) slices of an array shape left by cropping bbMin and bbMax voxels (i,j,k) from its lower and upper sides (the whole array without a box)
+    if bbMin is None or bbMax is None:
+        return tuple(slice(0, size) for size in shape)
+    return tuple(slice(lower, size-upper) for lower, upper, size in zip(bbMin[::-1], bbMax[::-1], shape))
+
+  def VoxelCentres(self, volumeNode, crop):
+    # RAS coordinates (N,3) of the voxel centres of a volume within (k,j,i) crop slices, in C order
+    k, j, i = numpy.mgrid[crop]
+    ijk = numpy.vstack((i.ravel(), j.ravel(), k.ravel(), numpy.ones(i.size)))
+    return numpy.dot(self.MatrixArray(self.preProcessLogic.WorldIJKToRAS(volumeNode)), ijk)[:3].T
+
+  def MatrixArray(self, matrix):
+    # 4x4 NumPy array of a vtkMatrix4x4
+    return numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+  def GetTransformMatrix(self, transformNode):
+    # 4x4 matrix of a linear transform node as nested lists (for checkpoint records)
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(matrix)
+    return [[matrix.GetElement(row, column) for column in range(4)] for row in range(4)]
+
+  def SetTransformMatrix(self, transformNode, matrixRows):
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+        for column in range(4):
+            matrix.SetElement(row, column, matrixRows[row][column])
+    transformNode.SetMatrixTransformToParent(matrix)
+
+  def CloneVolumeData(self, inputNode, name):
+    # copy the voxels and geometry of an input volume into a new scalar volume node
+    cloneNode = self.createVolumeNode(name)
+    self.preProcessLogic.updateVolumeFromArray(cloneNode, self.preProcessLogic.arrayFromVolume(inputNode), inputNode)
+    return cloneNode
 
   def ComputeSimilarityMetric(self, volumeA, volumeB):
     # Computes the similarity metric for the labels chosen by thew widget
@@ -687,11 +977,8 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     print('Computing Similarity Metric...'),
     start_time = time.time()
 
-    import SimpleITK as sitk
-    import sitkUtils
-
-    A_img  = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress( volumeA.GetName()))
-    B_img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(  volumeB.GetName()))
+    A_img = self.bridge.imageFromVolume(volumeA)
+    B_img = self.bridge.imageFromVolume(volumeB)
     similarity_filter = sitk.SimilarityIndexImageFilter()
     similarity_filter.Execute(A_img, B_img)
 
@@ -701,6 +988,54 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return similarity_filter.GetSimilarityIndex()
 
+  @timedStage
+  def ComputeOverlapMetrics(self, fixedLabelNodes, movingLabelNodes, bbMin=None, bbMax=None):
+    """ Returns the overlap metrics (see OverlapMetrics) of each fixed/moving label node pair, optionally only within the box left by
+    cropping bbMin and bbMax voxels (i,j,k) from the lower and upper sides as returned by getBoundingBox. The labels are read as views
+    """
+    print('Computing Overlap Metrics of %i labels...') % len(fixedLabelNodes),
+    start_time = time.time()
+
+    fixedArrays = [self.bridge.arrayFromVolume(labelNode) for labelNode in fixedLabelNodes]
+    movingArrays = [self.bridge.arrayFromVolume(labelNode) for labelNode in movingLabelNodes]
+    if bbMin is not None and bbMax is not None:
+        crop = self.CropBox(fixedArrays[0].shape, bbMin, bbMax)
+        fixedArrays = [fixedArray[crop] for fixedArray in fixedArrays]
+        movingArrays = [movingArray[crop] for movingArray in movingArrays]
+    overlaps = self.OverlapMetrics(fixedArrays, movingArrays)
+
+    end_time = time.time()
+    print('done (%0.2f s)') % float(end_time-start_time)
+    return overlaps
+
+  def OverlapMetrics(self, fixedArrays, movingArrays):
+    """ Returns a dict of overlap metrics of the nonzero voxels of each fixed/moving array pair (F, M): dice 2|F&M|/(|F|+|M|) (the similarity
+    index), jaccard |F&M|/|F or M|, volumeDifference (|M|-|F|)/|F|, falsePositiveRate |M-F|/|M| and falseNegativeRate |F-M|/|F| (0 for empty sets).
+    The fixed and moving states of up to four pairs are packed into one byte per voxel, so one bincount gives the confusion counts of all of them
+    """
+    ratio = lambda numerator, denominator: numerator/denominator if denominator else 0.0
+    overlaps = []
+    for first in range(0, len(fixedArrays), 4):
+        pairs = list(zip(fixedArrays[first:first+4], movingArrays[first:first+4]))
+        codes = numpy.zeros(fixedArrays[first].shape, dtype=numpy.uint8)
+        for pair, (fixedArray, movingArray) in enumerate(pairs):
+            if fixedArray.shape != movingArray.shape or fixedArray.shape != codes.shape:
+                raise ValueError('OverlapMetrics: labels of different sizes %s and %s' % (fixedArray.shape, movingArray.shape))
+            codes |= (fixedArray != 0).view(numpy.uint8) << numpy.uint8(2*pair+1)
+            codes |= (movingArray != 0).view(numpy.uint8) << numpy.uint8(2*pair)
+        counts = numpy.bincount(codes.ravel(), minlength=4**len(pairs))
+
+        codeValues = numpy.arange(len(counts))
+        for pair in range(len(pairs)):
+            states = (codeValues >> (2*pair)) & 3 # fixed bit, moving bit
+            falseNegatives, falsePositives, truePositives = [float(counts[states == state].sum()) for state in (2, 1, 3)]
+            fixedCount = truePositives + falseNegatives
+            movingCount = truePositives + falsePositives
+            overlaps.append({'dice': ratio(2*truePositives, fixedCount+movingCount), 'jaccard': ratio(truePositives, truePositives+falsePositives+falseNegatives),
+                             'volumeDifference': ratio(movingCount-fixedCount, fixedCount), 'falsePositiveRate': ratio(falsePositives, movingCount),
+                             'falseNegativeRate': ratio(falseNegatives, fixedCount)})
+    return overlaps
+
   def LabelMapSmoothing(self, inputVolume, outputVolume, Sigma, *labelNumber):
     """ Smooths an input volume labelmap using value of sigma provided (number from 0-5). Optionally smooths only selected labels if more arguments passed
     """
@@ -816,97 +1151,134 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return
 
+  @timedStage
   def getBoundingBox(self,fixedLabelNodeID,movingLabelNodeID):
-
-    ls = sitk.LabelStatisticsImageFilter()
-
+    """ Returns the lower and upper (i,j,k) crop sizes that keep the bounding box of the union of the fixed and moving labels
+    plus a margin of 30 voxels in plane and 5 slices. The labels are read through views of their voxels
+    """
     fixedLabelNode = slicer.mrmlScene.GetNodeByID(fixedLabelNodeID)
     movingLabelNode = slicer.mrmlScene.GetNodeByID(movingLabelNodeID)
 
-    fixedLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(fixedLabelNode.GetName())
-    movingLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(movingLabelNode.GetName())
-
-    fixedLabelImage = sitk.ReadImage(fixedLabelAddress)
-    movingLabelImage = sitk.ReadImage(movingLabelAddress)
-
-    cast = sitk.CastImageFilter()
-    cast.SetOutputPixelType(2)
-    unionLabelImage = (cast.Execute(fixedLabelImage) + cast.Execute(movingLabelImage)) > 0
-    unionLabelImage = cast.Execute(unionLabelImage)
+    unionLabel = (self.bridge.arrayFromVolume(fixedLabelNode) != 0) | (self.bridge.arrayFromVolume(movingLabelNode) != 0)
 
-    ls.Execute(unionLabelImage,unionLabelImage)
-    bb = ls.GetBoundingBox(1)
+    # (xmin, xmax, ymin, ymax, zmin, zmax) voxel bounding box from the projections of the union onto each axis
+    bb = []
+    for axis, otherAxes in ((2, (0, 1)), (1, (0, 2)), (0, (1, 2))):
+        occupied = numpy.nonzero(unionLabel.any(axis=otherAxes))[0]
+        bb += [int(occupied[0]), int(occupied[-1])] if len(occupied) else [0, unionLabel.shape[axis]-1]
     print(str(bb))
 
-    size = unionLabelImage.GetSize()
+    size = unionLabel.shape[::-1]
     bbMin = (max(0,bb[0]-30),max(0,bb[2]-30),max(0,bb[4]-5))
     bbMax = (size[0]-min(size[0],bb[1]+30),size[1]-min(size[1],bb[3]+30),size[2]-(min(size[2],bb[5]+5)))
 
     return (bbMin,bbMax)
 
+  @timedStage
   def preProcessLabel(self,labelNodeID,bbMin,bbMax):
+    """ Crops a label to the bounding box, smooths it (left in the scene as <label name>-Smoothed) and returns its signed distance map.
+    With a distance map cache, both are loaded from memory or disk when the label voxels, crop box and smoothing parameters are unchanged
+    """
+    labelNode = slicer.util.getNode(labelNodeID)
+    if not self.distanceMapCache:
+        return self.computeDistanceMap(labelNode, bbMin, bbMax)
+
+    parameters = {'bbMin': [int(x) for x in bbMin], 'bbMax': [int(x) for x in bbMax], 'smoothing': self.labelSmoothingParameters, 'squaredDistance': False}
+    stageKey = self.distanceMapCache.stageKey('preProcessLabel', parameters, [self.preProcessLogic.NodeKey(labelNode)])
+    outputNames = [labelNode.GetName()+'-Smoothed', labelNode.GetName()+'-DistanceMap']
+
+    if stageKey in self.distanceMapMemoryCache:
+        print('Label preprocessing of %s loaded from memory') % labelNode.GetName()
+        with traceStage('preProcessLabel (memory cache hit)', parameters):
+            cachedVolumes = self.distanceMapMemoryCache.pop(stageKey)
+            self.distanceMapMemoryCache[stageKey] = cachedVolumes # most recently used
+            outputNodes = [self.createVolumeNode(name) for name in outputNames]
+            for outputNode, (voxels, ijkToRAS) in zip(outputNodes, cachedVolumes):
+                outputNode.SetAndObserveImageData(self.preProcessLogic.imageDataFromArray(voxels))
+                outputNode.SetIJKToRASMatrix(ijkToRAS)
+        return outputNodes[1]
+
+    entryPath = self.distanceMapCache.lookup(stageKey)
+    if entryPath:
+        print('Label preprocessing of %s loaded from cache') % labelNode.GetName()
+        with traceStage('preProcessLabel (cache hit)', parameters):
+            outputNodes = [self.createVolumeNode(name) for name in outputNames]
+            self.preProcessLogic.readStageEntry(entryPath, outputNodes)
+    else:
+        distanceMap = self.computeDistanceMap(labelNode, bbMin, bbMax)
+        outputNodes = [slicer.util.getNode(outputNames[0]), distanceMap]
+        with traceStage('preProcessLabel (cache write)', parameters):
+            entryPath = self.distanceMapCache.beginEntry(stageKey)
+            self.preProcessLogic.writeStageEntry(entryPath, outputNodes, None)
+            self.distanceMapCache.commitEntry(stageKey, entryPath)
+
+    self.rememberDistanceMap(stageKey, outputNodes)
+    return outputNodes[1]
+
+  def rememberDistanceMap(self, stageKey, outputNodes):
+    # keep copies of the smoothed label and distance map in the memory cache, dropping least recently used entries beyond the budget
+    cachedVolumes = []
+    for outputNode in outputNodes:
+        ijkToRAS = vtk.vtkMatrix4x4()
+        outputNode.GetIJKToRASMatrix(ijkToRAS)
+        cachedVolumes.append((self.preProcessLogic.arrayFromVolume(outputNode).copy(), ijkToRAS))
+    self.distanceMapMemoryCache[stageKey] = cachedVolumes
+    while len(self.distanceMapMemoryCache) > 1 and sum(voxels.nbytes for cachedVolumes in self.distanceMapMemoryCache.values()
+                                                       for voxels, ijkToRAS in cachedVolumes) > self.distanceMapMemoryBytes:
+        self.distanceMapMemoryCache.popitem(last=False)
+
+  def computeDistanceMap(self, labelNode, bbMin, bbMax):
 
     # Start the timer
     start_time = time.time()
 
-    print('Label node ID: '+labelNodeID)
-
-    labelNode = slicer.util.getNode(labelNodeID)
-
-    labelNodeAddress = sitkUtils.GetSlicerITKReadWriteAddress(labelNode.GetName())
-
-    print('Label node address: '+str(labelNodeAddress))
-
-    labelImage = sitk.ReadImage(labelNodeAddress)
+    print('Label node ID: '+labelNode.GetID())
 
-    print('Read image: '+str(labelImage))
+    # The label is read through a view of its voxels, the cropped label is written into the node the smoothing CLI reads
+    labelImage = self.bridge.imageFromVolume(labelNode)
 
     crop = sitk.CropImageFilter()
     crop.SetLowerBoundaryCropSize(bbMin)
     crop.SetUpperBoundaryCropSize(bbMax)
     croppedImage = crop.Execute(labelImage)
 
-    print('Cropped image done: '+str(croppedImage))
-
-    croppedLabelName = labelNode.GetName()+'-Cropped'
-    sitkUtils.PushToSlicer(croppedImage,croppedLabelName,overwrite=True)
-    print('Cropped volume pushed')
-
-    croppedLabel = slicer.util.getNode(croppedLabelName)
-
-    print('Smoothed image done')
+    croppedLabel = self.outputVolumeNode(labelNode.GetName()+'-Cropped')
+    self.bridge.writeVolume(croppedLabel, croppedImage)
+    self.intermediates.register(croppedLabel) # freed when label preprocessing is done
+    print('Cropped image done: '+str(croppedImage.GetSize()))
 
     smoothLabelName = labelNode.GetName()+'-Smoothed'
-    smoothLabel = self.createVolumeNode(smoothLabelName)
+    smoothLabel = self.outputVolumeNode(smoothLabelName)
 
     # smooth the labels
-    smoothingParameters = {'inputImageName':croppedLabel.GetID(), 'outputImageName':smoothLabel.GetID()}
+    smoothingParameters = dict(self.labelSmoothingParameters, inputImageName=croppedLabel.GetID(), outputImageName=smoothLabel.GetID())
     print(str(smoothingParameters))
     cliNode = slicer.cli.run(slicer.modules.segmentationsmoothing, None, smoothingParameters, wait_for_completion = True)
+    print('Smoothed image done')
 
-    # crop the bounding box
-    
     '''
     TODO:
-     * output volume node probably not needed here
      * intermediate nodes should probably be hidden - AGREED!
     '''
 
     dt = sitk.SignedMaurerDistanceMapImageFilter()
     dt.SetSquaredDistance(False)
-    distanceMapName = labelNode.GetName()+'-DistanceMap'
-    print('Reading smoothed image: '+smoothLabel.GetID())
-    smoothLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(smoothLabel.GetName())    
-    smoothLabelImage = sitk.ReadImage(smoothLabelAddress)
-    print(smoothLabelAddress)
-    distanceImage = dt.Execute(smoothLabelImage)
-    sitkUtils.PushToSlicer(distanceImage, distanceMapName, overwrite=True)
+    distanceImage = dt.Execute(self.bridge.imageFromVolume(smoothLabel))
+    distanceMap = self.outputVolumeNode(labelNode.GetName()+'-DistanceMap')
+    self.bridge.writeVolume(distanceMap, distanceImage)
 
     # print to Slicer CLI
     end_time = time.time()
     print('Label preprocessing done (%0.2f s)') % float(end_time-start_time)
 
-    return slicer.util.getNode(distanceMapName)
+    return distanceMap
+
+  def outputVolumeNode(self, name):
+    # existing volume of that name (written in place by the SimpleITK bridge) or a new one
+    existingNode = slicer.mrmlScene.GetFirstNodeByName(name)
+    if existingNode and existingNode.IsA('vtkMRMLScalarVolumeNode'):
+        return existingNode
+    return self.createVolumeNode(name)
 
   def createVolumeNode(self,name):
     import sitkUtils
@@ -933,43 +1305,197 @@ class CustomRegisterTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CustomRegister1()
+    self.setUp()
+    self.test_CustomRegister2()
+    self.setUp()
+    self.test_CustomRegister3()
+    self.setUp()
+    self.test_CustomRegister4()
 
   def test_CustomRegister1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """ Benchmarks the label preprocessing and similarity stages on a synthetic prostate phantom (no downloads), with the deformed
+    "MR" labels as moving labels, and fails if a stage became slower than the stored baseline (see PhantomBenchmark)
     """
+    self.delayDisplay("Starting the phantom benchmark")
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    phantom = ProstatePhantom()
     logic = CustomRegisterLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    benchmark = PhantomBenchmark('CustomRegister').start(tempfile.mkdtemp())
+
+    # Registration labels (PZ and urethra) and capsule similarity labels of both modalities
+    labels = {}
+    for modality, masks in (('us', phantom.usMasks), ('mr', phantom.mrMasks)):
+        registrationMask = (masks['capsule'] & ~masks['cg']) | masks['urethra']
+        labels[modality+'Registration'] = phantom.createVolume(modality+'_registration-label', registrationMask.astype(numpy.uint8), labelmap=True)
+        labels[modality+'Capsule'] = phantom.createVolume(modality+'_cap-label', masks['capsule'].astype(numpy.uint8), labelmap=True)
+    fixedLabelNodeID = labels['usRegistration'].GetID()
+    movingLabelNodeID = labels['mrRegistration'].GetID()
+
+    (bbMin, bbMax) = benchmark.time('getBoundingBox', logic.getBoundingBox, fixedLabelNodeID, movingLabelNodeID)
+    self.assertTrue( all(lower >= 0 for lower in bbMin) and all(upper >= 0 for upper in bbMax) )
+    benchmark.time('preProcessLabel (fixed)', logic.preProcessLabel, fixedLabelNodeID, bbMin, bbMax)
+    distanceMap = benchmark.time('preProcessLabel (moving)', logic.preProcessLabel, movingLabelNodeID, bbMin, bbMax)
+    self.assertTrue( logic.hasImageData(distanceMap) )
+
+    benchmark.time('BatchLabelMapSmoothing', logic.preProcessLogic.BatchLabelMapSmoothing, 0.4, labels['usCapsule'], labels['mrCapsule'])
+    similarity = benchmark.time('ComputeSimilarityMetric', logic.ComputeSimilarityMetric, labels['usCapsule'], labels['mrCapsule'])
+    print('Phantom capsule similarity before registration: %0.3f') % similarity
+    self.assertTrue( 0.5 < similarity < 1.0 ) # the deformation is visible but the capsules still overlap
+
+    # All label pairs at once, on the whole volumes and within the crop box, agree with the similarity index filter
+    fixedLabels, movingLabels = [labels['usCapsule'], labels['usRegistration']], [labels['mrCapsule'], labels['mrRegistration']]
+    overlaps = benchmark.time('ComputeOverlapMetrics', logic.ComputeOverlapMetrics, fixedLabels, movingLabels)
+    self.assertAlmostEqual( overlaps[0]['dice'], similarity, places=6 )
+    self.assertAlmostEqual( overlaps[1]['dice'], logic.ComputeSimilarityMetric(labels['usRegistration'], labels['mrRegistration']), places=6 )
+    self.assertEqual( logic.ComputeOverlapMetrics(fixedLabels, movingLabels, bbMin, bbMax), overlaps )
+
+    regressions = benchmark.finish()
+    self.assertEqual( regressions, [] )
     self.delayDisplay('Test passed!')
 
+  def test_CustomRegister2(self):
+    """ Runs a small registration sweep on the phantom with concurrent BRAINSFit processes and checks that every trial is evaluated
+    once and the rows come back in sweep order
+    """
+    self.delayDisplay("Starting the registration sweep test")
+
+    phantom = ProstatePhantom(dimensions=(64,64,48))
+    logic = CustomRegisterLogic(maxConcurrentRegistrations=3, registrationThreads=1)
+    fixedLabel = phantom.createVolume('us_cap-label', phantom.usMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    movingLabel = phantom.createVolume('mr_cap-label', phantom.mrMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    (bbMin, bbMax) = logic.getBoundingBox(fixedLabel.GetID(), movingLabel.GetID())
+    fixedDistanceMap = logic.preProcessLabel(fixedLabel.GetID(), bbMin, bbMax)
+    movingDistanceMap = logic.preProcessLabel(movingLabel.GetID(), bbMin, bbMax)
+    affineTransformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(affineTransformNode)
+
+    evaluated = []
+    def evaluateTrial(numSamp, trial_num, transformNode):
+        evaluated.append((numSamp, trial_num))
+        self.assertTrue( transformNode.GetTransformToParent() is not None )
+        return [numSamp, trial_num, 0.0, 0.0]
+
+    trials = [(2000, 1), (500, 1), (2000, 2), (500, 2)]
+    rows = logic.RunTrialSweep(trials, fixedDistanceMap, movingDistanceMap, affineTransformNode, '3,3,3', evaluateTrial)
+    self.assertEqual( sorted(evaluated), sorted(trials) )
+    self.assertEqual( [(row[0], row[1]) for row in rows], trials )
+    self.assertEqual( [row[3][:2] for row in rows], [list(trial) for trial in trials] )
+    self.assertTrue( all(row[2] > 0 for row in rows) )
+    self.delayDisplay('Test passed!')
+
+  def test_CustomRegister3(self):
+    """ Checks that preProcessLabel reuses distance maps from memory and disk for unchanged labels and crop boxes and recomputes them otherwise
+    """
+    self.delayDisplay("Starting the distance map cache test")
+
+    import shutil
+    cacheDirectory = tempfile.mkdtemp()
+    phantom = ProstatePhantom(dimensions=(64,64,48))
+    label = phantom.createVolume('us_cap-label', phantom.usMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    logic = CustomRegisterLogic(distanceMapCache=PreProcessStageCache(cacheDirectory))
+    computed = []
+    computeDistanceMap = logic.computeDistanceMap
+    logic.computeDistanceMap = lambda *args: computed.append(args[1:]) or computeDistanceMap(*args)
+
+    bbMin, bbMax = (2,2,1), (3,3,1)
+    distanceMap = logic.preProcessLabel(label.GetID(), bbMin, bbMax)
+    computedArray = logic.preProcessLogic.arrayFromVolume(distanceMap).copy()
+    computedOrigin = distanceMap.GetOrigin()
+    self.assertEqual( len(computed), 1 )
+
+    # Unchanged label and crop box: from memory, then (with an empty memory cache) from disk, with the same voxels and geometry
+    for memoryCached in (True, False):
+        if not memoryCached:
+            logic.distanceMapMemoryCache.clear()
+        cachedMap = logic.preProcessLabel(label.GetID(), bbMin, bbMax)
+        self.assertEqual( len(computed), 1 )
+        self.assertTrue( numpy.array_equal(logic.preProcessLogic.arrayFromVolume(cachedMap), computedArray) )
+        self.assertEqual( cachedMap.GetOrigin(), computedOrigin )
+        self.assertTrue( slicer.util.getNode('us_cap-label-Smoothed') is not None )
+
+    # A different crop box or changed voxels are computed again
+    logic.preProcessLabel(label.GetID(), bbMin, (4,4,2))
+    self.assertEqual( len(computed), 2 )
+    logic.preProcessLogic.arrayFromVolume(label)[20:24, 30:34, 30:34] = 1
+    logic.preProcessLogic.arrayFromVolumeModified(label)
+    logic.preProcessLabel(label.GetID(), bbMin, bbMax)
+    self.assertEqual( len(computed), 3 )
+
+    self.assertEqual( len(CustomRegisterLogic(distanceMapCache=logic.distanceMapCache).distanceMapMemoryCache), 0 ) # not shared between logics
+    shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_CustomRegister4(self):
+    """ Resamples two phantom labels through a translation in one pass and checks the shifted voxels, the crop box and that the transform is
+    evaluated once until it changes, then compares labels of different values with hardening a sub-voxel displacement and thresholding
+    """
+    self.delayDisplay("Starting the label resampling test")
+
+    phantom = ProstatePhantom(dimensions=(64,64,48))
+    logic = CustomRegisterLogic()
+    masks = [phantom.mrMasks['capsule'], phantom.mrMasks['urethra']]
+    movingLabels = [phantom.createVolume('mr_%i-label' % index, mask.astype(numpy.uint8), labelmap=True) for index, mask in enumerate(masks)]
+    referenceVolume = phantom.createVolume('us_cap-label', phantom.usMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    outputNodes = [logic.CreateNewVolume(1, 100, labelType) for labelType in ('cap-label', 'urethra-label')]
+    evaluated = []
+    evaluateTransform = logic.EvaluateTransform
+    logic.EvaluateTransform = lambda *args: evaluated.append(len(args[1])) or evaluateTransform(*args)
+
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    for translation, evaluations in ((1.0, 1), (1.0, 1), (-1.0, 2)): # two voxels along R, the second run reuses the displacement field
+        matrix = vtk.vtkMatrix4x4()
+        matrix.SetElement(0, 3, translation)
+        if translation != logic.GetTransformMatrix(transformNode)[0][3]:
+            transformNode.SetMatrixTransformToParent(matrix)
+        logic.ResampleLabelsThroughTransform(transformNode, movingLabels, referenceVolume, outputNodes, 20)
+        self.assertEqual( len(evaluated), evaluations )
+        shift = int(round(translation/phantom.spacing[0]))
+        for mask, outputNode in zip(masks, outputNodes):
+            expected = numpy.zeros(mask.shape, dtype=numpy.uint8)
+            if shift > 0:
+                expected[:, :, shift:] = 20*mask[:, :, :-shift]
+            else:
+                expected[:, :, :shift] = 20*mask[:, :, -shift:]
+            self.assertTrue( numpy.array_equal(logic.preProcessLogic.arrayFromVolume(outputNode), expected) )
+
+    # Only the crop box is resampled
+    bbMin, bbMax = (4,6,2), (5,3,4)
+    logic.ResampleLabelsThroughTransform(transformNode, movingLabels, referenceVolume, outputNodes, 20, bbMin, bbMax)
+    crop = logic.CropBox(expected.shape, bbMin, bbMax)
+    outputArray = logic.preProcessLogic.arrayFromVolume(outputNodes[1])
+    self.assertTrue( numpy.array_equal(outputArray[crop], expected[crop]) )
+    outputArray[crop] = 0
+    self.assertFalse( outputArray.any() )
+
+    # Same labels as hardening a sub-voxel displacement on copies of labels with values 1 and 34 and thresholding them, as the trial evaluation
+    # did before, where the label of value 34 grows into every voxel touching it
+    movingLabels[1] = phantom.createVolume('mr_lesion-label', 34*masks[1].astype(numpy.uint8), labelmap=True)
+    bounds = [0.0]*6
+    referenceVolume.GetRASBounds(bounds)
+    displacementGrid = vtk.vtkImageData()
+    displacementGrid.SetOrigin(bounds[0]-10.0, bounds[2]-10.0, bounds[4]-10.0)
+    displacementGrid.SetSpacing(bounds[1]-bounds[0]+20.0, bounds[3]-bounds[2]+20.0, bounds[5]-bounds[4]+20.0)
+    displacementGrid.SetDimensions(2, 2, 2)
+    displacementGrid.AllocateScalars(vtk.VTK_DOUBLE, 3)
+    displacements = numpy_support.vtk_to_numpy(displacementGrid.GetPointData().GetScalars())
+    displacements[:] = (0.3*phantom.spacing[0], 0.6*phantom.spacing[1], 0.0) # fractions of a voxel along R and A
+    gridTransform = slicer.vtkOrientedGridTransform()
+    gridTransform.SetDisplacementGridData(displacementGrid)
+    gridTransformNode = slicer.vtkMRMLGridTransformNode()
+    slicer.mrmlScene.AddNode(gridTransformNode)
+    gridTransformNode.SetAndObserveTransformFromParent(gridTransform)
+
+    logic.ResampleLabelsThroughTransform(gridTransformNode, movingLabels, referenceVolume, outputNodes, 20)
+    for movingLabel, outputNode in zip(movingLabels, outputNodes):
+        hardenedNode = logic.CreateNewVolume(1, 100, 'hardened')
+        logic.preProcessLogic.updateVolumeFromArray(hardenedNode, logic.preProcessLogic.arrayFromVolume(movingLabel), movingLabel)
+        hardenedNode.SetAndObserveTransformNodeID(gridTransformNode.GetID())
+        slicer.vtkSlicerTransformLogic().hardenTransform(hardenedNode)
+        logic.ThresholdScalarVolume(hardenedNode, 20)
+        self.assertTrue( numpy.array_equal(logic.preProcessLogic.arrayFromVolume(outputNode), logic.preProcessLogic.arrayFromVolume(hardenedNode)) )
+    self.assertTrue( numpy.count_nonzero(logic.preProcessLogic.arrayFromVolume(outputNodes[1])) > numpy.count_nonzero(masks[1]) )
+    self.delayDisplay('Test passed!')
 
     '''
 
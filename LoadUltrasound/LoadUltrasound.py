@@ -264,37 +264,34 @@ class LoadUltrasoundTest(ScriptedLoadableModuleTest):
     self.test_LoadUltrasound1()
 
   def test_LoadUltrasound1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """ Benchmarks loading a patient written from a synthetic prostate phantom (no downloads) and fails if loading
+    became slower than the stored baseline (see PreProcess.PhantomBenchmark)
     """
+    self.delayDisplay("Starting the phantom benchmark")
+    import json
+    import shutil
+    import tempfile
+    from PreProcess import ProstatePhantom, PhantomBenchmark
+
+    # Write the phantom ultrasound volumes and lesion list in the layout run() reads
+    dataDirectory = tempfile.mkdtemp()
+    inputDir = os.path.join(dataDirectory, 'Patient0', 'Ultrasound')
+    os.makedirs(inputDir)
+    phantom = ProstatePhantom()
+    usNodes = phantom.createUltrasoundNodes()
+    self.assertTrue( slicer.util.saveNode(usNodes['ARFI'], os.path.join(inputDir, 'ARFI_Norm_HistEq.nii.gz')) )
+    self.assertTrue( slicer.util.saveNode(usNodes['Bmode'], os.path.join(inputDir, 'Bmode.nii.gz')) )
+    with open(os.path.join(inputDir, 'ARFI_Lesions.json'), 'w') as lesionFile:
+      json.dump({'lesions': [{'name': 'lesion1', 'labelValue': 34}]}, lesionFile)
+    slicer.mrmlScene.Clear(0)
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
     logic = LoadUltrasoundLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    benchmark = PhantomBenchmark('LoadUltrasound').start(dataDirectory)
+    self.assertTrue( benchmark.time('run', logic.run, '0', dataDirectory) )
+    self.assertTrue( logic.hasImageData(slicer.util.getNode('ARFI_Norm_HistEq')) )
+    self.assertTrue( logic.hasImageData(slicer.util.getNode('Bmode')) )
+
+    regressions = benchmark.finish()
+    shutil.rmtree(dataDirectory)
+    self.assertEqual( regressions, [] )
     self.delayDisplay('Test passed!')
@@ -4,6 +4,28 @@ from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import time 
+import hashlib
+import json
+import math
+import shutil
+import tempfile
+import zlib
+import multiprocessing
+import contextlib
+import functools
+import inspect
+import threading
+import bisect
+import sys
+import platform
+from multiprocessing.pool import ThreadPool
+import numpy
+import PreProcessInputs
+from vtk.util import numpy_support
+try:
+  import SimpleITK as sitk
+except ImportError:
+  sitk = None # resampling falls back to the CLI module
 
 #
 # This module is used to process and save U/S and MRI inputs prior to registration. 
@@ -33,6 +55,639 @@ def numericInputFrame(parent, label, tooltip, minimum, maximum, step, decimals):
     inputFrame.layout().addWidget(inputSpinBox)
     return inputFrame, inputSpinBox
 
+#
+# StageTrace
+#
+
+class StageTrace(object):
+  """ Records timed processing stages of one run (stage name, patient, parameters, wall time, CPU time, peak resident memory and
+  whether the stage ran CLI modules) and writes them as a Chrome trace (chrome://tracing or Perfetto) and a CSV summary
+  """
+
+  active = None # trace that timedStage methods, StageGraph stages and traceStage blocks record to
+  maxMemorySamples = 2048 # length of the resident memory track kept for background stages and the trace counter
+
+  def __init__(self, runName, patient='', traceDirectory=None):
+    self.runName = runName
+    self.patient = str(patient)
+    self.traceDirectory = traceDirectory or os.path.join(slicer.app.temporaryPath, 'StageTraces')
+    self.stages = []
+    self.depth = 0
+    self.previous = None
+    self.start_time = time.time()
+    # resident memory sampled in the background so each stage can report its peak. Open stages keep their own running peak,
+    # the track keeps the peak of every trackStride samples and is halved (doubling the stride) when it reaches maxMemorySamples
+    self.memoryTimes = []
+    self.memorySamples = []
+    self.memoryLock = threading.Lock()
+    self.openStagePeaks = {}
+    self.trackStride = 1
+    self.trackBucket = None # [start time, peak, samples] of the track entry being collected
+    self.stopSampling = threading.Event()
+    self.samplingThread = None
+
+  def start(self):
+    """ Makes this the active trace (an already active trace is restored by finish)
+    """
+    self.previous = StageTrace.active
+    StageTrace.active = self
+    self.start_time = time.time()
+    self.samplingThread = threading.Thread(target=self.sampleMemory, name='StageTraceMemory')
+    self.samplingThread.daemon = True
+    self.samplingThread.start()
+    return self
+
+  def sampleMemory(self, interval=0.02):
+    while not self.stopSampling.is_set():
+        self.addMemorySample(time.time(), residentMemory())
+        self.stopSampling.wait(interval)
+
+  def addMemorySample(self, sampleTime, sample):
+    with self.memoryLock:
+        for stageKey in self.openStagePeaks:
+            self.openStagePeaks[stageKey] = max(self.openStagePeaks[stageKey], sample)
+        if self.trackBucket is None:
+            self.trackBucket = [sampleTime, sample, 0]
+        self.trackBucket[1] = max(self.trackBucket[1], sample)
+        self.trackBucket[2] += 1
+        if self.trackBucket[2] < self.trackStride:
+            return
+        self.memoryTimes.append(self.trackBucket[0])
+        self.memorySamples.append(self.trackBucket[1])
+        self.trackBucket = None
+        if len(self.memoryTimes) >= self.maxMemorySamples:
+            # merge neighbouring entries, keeping the larger sample so peaks survive the thinning
+            self.memoryTimes = self.memoryTimes[0::2]
+            self.memorySamples = [max(self.memorySamples[i:i+2]) for i in range(0, len(self.memorySamples), 2)]
+            self.trackStride *= 2
+
+  def peakMemory(self, stageStart, stageMemory):
+    """ Returns the largest resident memory in the track since stageStart (absolute time), at least stageMemory.
+    The track entry that was being collected at stageStart is included, so the peak may come from up to one entry before the stage
+    """
+    with self.memoryLock:
+        firstSample = max(bisect.bisect_right(self.memoryTimes, stageStart)-1, 0)
+        samples = self.memorySamples[firstSample:] + ([self.trackBucket[1]] if self.trackBucket else [])
+    return max([stageMemory, residentMemory()] + samples)
+
+  def openStage(self, memory_start):
+    stageKey = object()
+    with self.memoryLock:
+        self.openStagePeaks[stageKey] = memory_start
+    return stageKey
+
+  def closeStage(self, stageKey):
+    """ Returns the peak resident memory sampled while the stage was open
+    """
+    with self.memoryLock:
+        stagePeak = self.openStagePeaks.pop(stageKey)
+    return max(stagePeak, residentMemory())
+
+  def cpuTime(self):
+    # includes CLI module processes once they have exited
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+  def cliNodeCount(self):
+    return slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLCommandLineModuleNode')
+
+  @contextlib.contextmanager
+  def stage(self, stageName, parameters=None):
+    """ Times the enclosed block as one stage. CLI use is detected from the CLI nodes added to the scene during the stage
+    """
+    record = {'stage': stageName, 'patient': self.patient, 'parameters': parameters or {}, 'depth': self.depth,
+              'start': time.time()-self.start_time, 'thread': threading.current_thread().ident}
+    cpu_start = self.cpuTime()
+    cli_start = self.cliNodeCount()
+    stageKey = self.openStage(residentMemory())
+    self.depth += 1
+    try:
+        yield record
+    finally:
+        self.depth -= 1
+        record['wall'] = time.time()-self.start_time-record['start']
+        record['cpu'] = self.cpuTime()-cpu_start
+        record['peakMemory'] = self.closeStage(stageKey)
+        record['cliRuns'] = self.cliNodeCount()-cli_start
+        record['cli'] = record['cliRuns'] > 0
+        self.stages.append(record)
+
+  def addStage(self, stageName, parameters, startTime, lane=0, cliRuns=0):
+    """ Records a stage that ran in the background (e.g. CLI nodes launched by StageGraph) from startTime (absolute time) until now.
+    Background stages are drawn on their own lanes and their CPU time is not attributed since other stages ran at the same time
+    """
+    record = {'stage': stageName, 'patient': self.patient, 'parameters': parameters or {}, 'depth': self.depth,
+              'start': startTime-self.start_time, 'thread': -(lane+1), 'wall': time.time()-startTime, 'cpu': 0.0,
+              'peakMemory': self.peakMemory(startTime, 0), 'cliRuns': cliRuns, 'cli': cliRuns > 0}
+    self.stages.append(record)
+    return record
+
+  def finish(self):
+    """ Writes the trace and CSV files, restores the previously active trace and returns the two file paths
+    """
+    if StageTrace.active is self:
+        StageTrace.active = self.previous
+    self.stopSampling.set()
+    if self.samplingThread:
+        self.samplingThread.join()
+    if not os.path.isdir(self.traceDirectory):
+        try:
+            os.makedirs(self.traceDirectory)
+        except OSError:
+            pass # created by another process in the meantime
+    baseName = '%s-Patient%s-%s' % (self.runName, self.patient, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time)))
+    tracePath = os.path.join(self.traceDirectory, baseName + '.json')
+    summaryPath = os.path.join(self.traceDirectory, baseName + '.csv')
+    self.writeChromeTrace(tracePath)
+    self.writeSummary(summaryPath)
+    print('Stage trace written to %s') % tracePath
+    return tracePath, summaryPath
+
+  def writeChromeTrace(self, tracePath):
+    """ Writes complete ('X') events in microseconds, nested stages show up below the stage that called them
+    """
+    processName = '%s Patient %s' % (self.runName, self.patient) if self.patient else self.runName
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0, 'args': {'name': processName}}]
+    for record in sorted(self.stages, key=lambda record: (record['start'], record['depth'])):
+        events.append({'name': record['stage'], 'cat': 'CLI' if record['cli'] else 'in-process', 'ph': 'X',
+                       'ts': int(record['start']*1e6), 'dur': int(record['wall']*1e6),
+                       'pid': os.getpid(), 'tid': record['thread'],
+                       'args': {'patient': record['patient'], 'parameters': record['parameters'],
+                                'cpuTime': record['cpu'], 'cliRuns': record['cliRuns'], 'peakMemoryMB': record['peakMemory']/1048576.0}})
+    # resident memory as a counter track (at most maxMemorySamples events, each the peak of its stretch of samples)
+    for sampleTime, sample in zip(self.memoryTimes, self.memorySamples):
+        events.append({'name': 'Resident memory', 'ph': 'C', 'ts': int((sampleTime-self.start_time)*1e6),
+                       'pid': os.getpid(), 'args': {'MB': sample/1048576.0}})
+    with open(tracePath, 'w') as traceFile:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+
+  def writeSummary(self, summaryPath):
+    import csv
+    with open(summaryPath, 'wb') as summaryFile:
+        csvWriter = csv.writer(summaryFile)
+        csvWriter.writerow(['Stage', 'Patient', 'Depth', 'Start (s)', 'Wall Time (s)', 'CPU Time (s)', 'CLI', 'CLI Runs', 'Peak Resident Memory (MB)', 'Parameters'])
+        for record in sorted(self.stages, key=lambda record: (record['start'], record['depth'])):
+            csvWriter.writerow([record['stage'], record['patient'], record['depth'], '%0.4f' % record['start'],
+                                '%0.4f' % record['wall'], '%0.4f' % record['cpu'], record['cli'], record['cliRuns'], '%0.1f' % (record['peakMemory']/1048576.0),
+                                json.dumps(record['parameters'], sort_keys=True)])
+
+
+def traceValue(value):
+  """ Converts a stage argument into something that can be written to the trace (nodes by name)
+  """
+  if hasattr(value, 'GetName') and hasattr(value, 'GetID'):
+    return value.GetName()
+  if isinstance(value, (list, tuple)):
+    return [traceValue(item) for item in value]
+  if isinstance(value, dict):
+    return dict((str(key), traceValue(item)) for key, item in value.items())
+  if value is None or isinstance(value, (bool, int, long, float, str, unicode)):
+    return value
+  return type(value).__name__
+
+
+@contextlib.contextmanager
+def traceStage(stageName, parameters=None):
+  """ Context manager running a block as a stage of the active trace and as a scope of the active IntermediateNodes registry
+  (either may be missing), so intermediates registered in the block are freed when it finishes
+  """
+  with (StageTrace.active.stage(stageName, parameters) if StageTrace.active else untracedStage()):
+    with (IntermediateNodes.active.scope(stageName) if IntermediateNodes.active else untracedStage()):
+      yield
+
+
+@contextlib.contextmanager
+def untracedStage():
+  yield None
+
+
+def timedStage(function):
+  """ Decorator recording a logic method run outside a StageGraph as a stage of the active trace, with its arguments as the stage parameters.
+  Without an active trace it only opens a scope of the active IntermediateNodes registry (graph stages are traced by StageGraph itself)
+  """
+  @functools.wraps(function)
+  def timedFunction(*args, **kwargs):
+    if StageTrace.active is None:
+      if IntermediateNodes.active is None:
+        return function(*args, **kwargs)
+      with IntermediateNodes.active.scope(function.__name__):
+        return function(*args, **kwargs)
+    callArguments = inspect.getcallargs(function, *args, **kwargs)
+    callArguments.pop('self', None)
+    parameters = dict((name, traceValue(value)) for name, value in callArguments.items())
+    with traceStage(function.__name__, parameters):
+      return function(*args, **kwargs)
+  return timedFunction
+
+
+def residentMemory():
+  """ Returns the resident memory of this process in bytes (the peak so far where the current value is not available)
+  """
+  try:
+    with open('/proc/self/statm', 'r') as statm:
+      return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError, AttributeError):
+    pass
+  try:
+    import resource
+  except ImportError:
+    return 0 # Windows
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+#
+# IntermediateNodes
+#
+
+class IntermediateNodes(object):
+  """ Registry of intermediate MRML nodes (meshes, cropped/smoothed labels, distance maps, trial volumes) created by a logic.
+  Nodes registered inside a stage (timedStage method, StageGraph stage or traceStage block) are released when that stage finishes, nodes registered
+  outside any stage when the run finishes or release is called. Released nodes stay in the scene for inspection until their
+  memory exceeds memoryBudget (bytes), then the oldest are removed first. A budget of 0 removes them as soon as they are released
+  """
+
+  active = None # registry that timedStage methods, StageGraph stages and traceStage blocks open scopes in
+
+  def __init__(self, memoryBudget=0):
+    self.memoryBudget = memoryBudget
+    self.scopes = [[]] # registered node IDs, one list per open stage (the first one is the run)
+    self.released = [] # (node, bytes) oldest first
+    self.previous = None
+
+  def start(self):
+    """ Makes this the active registry for a run (an already active registry is restored by finish)
+    """
+    self.previous = IntermediateNodes.active
+    IntermediateNodes.active = self
+    return self
+
+  def finish(self):
+    """ Releases the nodes registered during the run and restores the previously active registry
+    """
+    while len(self.scopes) > 1:
+        self.releaseScope()
+    self.releaseScope()
+    if IntermediateNodes.active is self:
+        IntermediateNodes.active = self.previous
+
+  def register(self, *nodes):
+    """ Registers nodes as intermediates of the innermost open stage and returns the first one
+    """
+    for node in nodes:
+        if node and all(node.GetID() not in scope for scope in self.scopes):
+            self.scopes[-1].append(node.GetID())
+    return nodes[0] if nodes else None
+
+  def keep(self, *nodes):
+    """ Removes nodes from the registry, so they are never freed by it
+    """
+    for node in nodes:
+        for scope in self.scopes:
+            if node.GetID() in scope:
+                scope.remove(node.GetID())
+
+  def release(self, *nodes):
+    """ Releases registered nodes before their stage or run finishes
+    """
+    self.keep(*nodes)
+    self.freeNodes(nodes)
+
+  @contextlib.contextmanager
+  def scope(self, stageName):
+    self.scopes.append([])
+    try:
+        yield
+    finally:
+        self.releaseScope(stageName)
+
+  def releaseScope(self, stageName=None):
+    """ Releases the nodes of the innermost open stage, or of the run if no stage is open
+    """
+    nodeIDs = self.scopes.pop() if len(self.scopes) > 1 else self.scopes[0]
+    nodes = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in nodeIDs]
+    del nodeIDs[:]
+    freedNodes, freedBytes = self.freeNodes(nodes)
+    if freedNodes:
+        print('%s: freed %i intermediate nodes (%0.1f MB)') % (stageName or 'Run', freedNodes, freedBytes/1048576.0)
+
+  def freeNodes(self, nodes):
+    """ Queues released nodes and removes the oldest released nodes from the scene while over the memory budget.
+    Returns the number of nodes and bytes removed
+    """
+    for node in nodes:
+        if node and node.GetScene():
+            # a node released again (e.g. overwritten by name in a later run) is queued once, as the newest
+            self.released = [(releasedNode, nodeBytes) for releasedNode, nodeBytes in self.released if releasedNode is not node]
+            self.released.append((node, self.nodeMemory(node)))
+
+    freedNodes = freedBytes = 0
+    while self.released and sum(nodeBytes for node, nodeBytes in self.released) > self.memoryBudget:
+        node, nodeBytes = self.released.pop(0)
+        if node.GetScene():
+            slicer.mrmlScene.RemoveNode(node)
+            freedNodes += 1
+            freedBytes += nodeBytes
+    return freedNodes, freedBytes
+
+  def nodeMemory(self, node):
+    """ Returns the bytes held by the image data or polydata of a node
+    """
+    data = None
+    if node.IsA('vtkMRMLVolumeNode'):
+        data = node.GetImageData()
+    elif node.IsA('vtkMRMLModelNode'):
+        data = node.GetPolyData()
+    return data.GetActualMemorySize()*1024 if data else 0
+
+#
+# StageGraph
+#
+
+class StageResult(object):
+  """ Placeholder for a node returned by a StageGraph stage (e.g. a model made from a label), usable as an argument or input of later stages
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+
+class StageGraph(object):
+  """ Processing stages of one run declared with the nodes they read (inputs) and write (outputs) and their parameters.
+  Stage order follows from the nodes: a stage runs after the last stage writing any node it reads or writes, and after the stages reading a node
+  it overwrites, so stages of independent branches (e.g. the US and MR chains) can run at the same time.
+
+  With a stage cache all stage keys are computed before anything runs (from the input content keys and the parameters), so a changed input or
+  parameter only reruns the stages downstream of it. Cached stages whose outputs no rerun stage needs are skipped without loading them.
+  With a RunCheckpoint every cached stage that ran is checkpointed, and when resuming all checkpointed stages are treated like cached ones.
+  Uncached stages that only move nodes (geometryOnly) are checkpointed as the change of their output matrices, other uncached stages run again.
+  Stages with a CLI module are launched in the background as soon as they are ready while the other stages run on the main thread
+  """
+
+  def __init__(self, logic):
+    self.logic = logic
+    self.stages = []
+    self.lastWriter = {} # node ID or StageResult -> index of the last stage writing it
+    self.readers = {} # node ID or StageResult -> indices of the stages reading it since it was last written
+    self.results = {} # StageResult -> node returned by its stage, until the stages reading it have finished
+    self.finished = set() # indices of finished stages
+
+  def nodeKey(self, node):
+    return node if isinstance(node, StageResult) else node.GetID()
+
+  def add(self, stageName, stageFunction, arguments=(), inputs=(), outputs=(), parameters=None, cached=True, cliModule=None, cliParameters=None, returns=None,
+          geometryOnly=False):
+    """ Declares a stage running stageFunction(*arguments), or one cliModule node with cliParameters(*arguments) if a CLI module is given.
+    Uncached stages (cheap in place changes such as geometry) always run, geometryOnly marks uncached stages that only change the matrices of their outputs.
+    Returns a StageResult for the node returned by the stage if returns names it
+    """
+    stage = {'index': len(self.stages), 'name': stageName, 'function': stageFunction, 'arguments': list(arguments),
+             'inputs': list(inputs), 'outputs': list(outputs), 'parameters': parameters or {}, 'cached': cached, 'geometryOnly': geometryOnly,
+             'cliModule': cliModule, 'cliParameters': cliParameters, 'returns': StageResult(returns) if returns else None,
+             'dependencies': set(), 'inputWriters': [], 'action': 'run', 'key': None, 'store': None}
+
+    for node in stage['inputs']:
+        writer = self.lastWriter.get(self.nodeKey(node))
+        stage['inputWriters'].append(writer)
+        if writer is not None:
+            stage['dependencies'].add(writer)
+    for node in stage['outputs']:
+        if self.nodeKey(node) in self.lastWriter:
+            stage['dependencies'].add(self.lastWriter[self.nodeKey(node)])
+        stage['dependencies'].update(self.readers.get(self.nodeKey(node), []))
+    stage['dependencies'].discard(stage['index'])
+
+    for node in stage['inputs']:
+        self.readers.setdefault(self.nodeKey(node), []).append(stage['index'])
+    for node in stage['outputs'] + ([stage['returns']] if stage['returns'] else []):
+        self.lastWriter[self.nodeKey(node)] = stage['index']
+        self.readers[self.nodeKey(node)] = []
+
+    self.stages.append(stage)
+    return stage['returns']
+
+  def plan(self, finalNodes):
+    """ Computes the stage keys and decides for each stage whether it runs, loads its outputs from the stage cache or is skipped
+    """
+    stageCache = self.logic.stageCache
+    checkpoint = self.logic.checkpoint
+    keyStore = stageCache or (checkpoint.stages if checkpoint else None)
+    if not keyStore:
+        return
+    plannedKeys = {}
+    for stage in self.stages:
+        inputKeys = [plannedKeys.get(self.nodeKey(node)) or self.logic.NodeKey(node) for node in stage['inputs']]
+        stage['key'] = keyStore.stageKey(stage['name'], stage['parameters'], inputKeys)
+        for index, node in enumerate(stage['outputs'] + ([stage['returns']] if stage['returns'] else [])):
+            plannedKeys[self.nodeKey(node)] = stage['key'] + ':' + str(index)
+        # stages finished before a crash are resumed from the checkpoint, including the uncached geometry stages
+        if checkpoint and checkpoint.resume and checkpoint.stages.lookup(stage['key']):
+            stage['action'], stage['store'] = 'skip', checkpoint.stages
+        elif stage['cached'] and stageCache and stageCache.lookup(stage['key']):
+            stage['action'], stage['store'] = 'skip', stageCache
+
+    # Cached outputs are only loaded where a stage that runs reads them, or where they are final outputs of the run.
+    # Geometry entries move the nodes as they are, so the stages writing their inputs are loaded too (last stages first, so this propagates)
+    for node in finalNodes:
+        writer = self.lastWriter.get(self.nodeKey(node))
+        if writer is not None and self.stages[writer]['action'] == 'skip':
+            self.stages[writer]['action'] = 'load'
+    for stage in reversed(self.stages):
+        if stage['action'] == 'run' or (stage['action'] == 'load' and stage['geometryOnly']):
+            for writer in stage['inputWriters']:
+                if writer is not None and self.stages[writer]['action'] == 'skip':
+                    self.stages[writer]['action'] = 'load'
+
+  def resolve(self, value):
+    if isinstance(value, StageResult):
+        return self.results[value]
+    return value
+
+  def run(self, finalNodes=()):
+    """ Runs the stages, launching ready CLI stages in the background and running one ready main thread stage at a time.
+    finalNodes are the nodes the run hands on (e.g. for saving), their cached outputs are always loaded. If a CLI stage does not complete,
+    no further stage is started and RuntimeError is raised once the running CLI stages have finished (the failed outputs are neither cached nor checkpointed)
+    """
+    self.plan(finalNodes)
+    print('Stage graph: %i stages run, %i loaded from stage cache or checkpoint, %i skipped') % tuple(
+        len([stage for stage in self.stages if stage['action'] == action]) for action in ('run', 'load', 'skip'))
+
+    pending = list(self.stages)
+    running = [] # (stage, cliNode, start time, lane)
+    failedStages = [] # (stage name, CLI status) of CLI stages that did not complete
+    while (pending and not failedStages) or running:
+        progressed = False
+        readyStages = [stage for stage in pending if stage['dependencies'] <= self.finished] if not failedStages else []
+
+        # Launch ready CLI stages in the background, at most maxConcurrentCLINodes at once
+        for stage in readyStages:
+            if stage['action'] == 'run' and stage['cliModule'] and len(running) < self.logic.maxConcurrentCLINodes:
+                cliNode = slicer.cli.run(stage['cliModule'], None, stage['cliParameters'](*[self.resolve(argument) for argument in stage['arguments']]), wait_for_completion=False)
+                lanes = [lane for runningStage, runningNode, startTime, lane in running]
+                running.append((stage, cliNode, time.time(), min(set(range(len(running)+1)) - set(lanes))))
+                pending.remove(stage)
+                progressed = True
+
+        # Run the first ready main thread stage (CLI stages keep running meanwhile)
+        for stage in readyStages:
+            if stage in pending and not (stage['action'] == 'run' and stage['cliModule']):
+                pending.remove(stage)
+                self.runStage(stage)
+                progressed = True
+                break
+
+        # Let the CLI nodes report completion to the main thread
+        if running:
+            slicer.app.processEvents()
+            for stage, cliNode, startTime, lane in list(running):
+                if cliNode.IsBusy():
+                    continue
+                running.remove((stage, cliNode, startTime, lane))
+                if StageTrace.active:
+                    StageTrace.active.addStage(stage['name'], traceValue(stage['arguments']), startTime, lane, cliRuns=1)
+                progressed = True
+                if cliNode.GetStatus() != cliNode.Completed:
+                    logging.error('StageGraph: %s finished with status %s' % (stage['name'], cliNode.GetStatusString()))
+                    failedStages.append((stage['name'], cliNode.GetStatusString()))
+                    continue
+                self.finishStage(stage, None)
+
+        if not progressed:
+            if not running:
+                raise RuntimeError('StageGraph: no stage can run, %s are waiting' % ', '.join(stage['name'] for stage in pending))
+            time.sleep(0.05)
+
+    if failedStages:
+        raise RuntimeError('StageGraph: %s did not complete, %i stages were not run' % (
+            ', '.join('%s (%s)' % failedStage for failedStage in failedStages), len(pending)))
+
+  def runStage(self, stage):
+    """ Runs, loads or skips one stage on the main thread
+    """
+    returnedNode = None
+    if stage['action'] == 'load':
+        fromCheckpoint = self.logic.checkpoint and stage['store'] is self.logic.checkpoint.stages
+        entryPath = stage['store'].lookup(stage['key'])
+        if not entryPath:
+            raise RuntimeError('StageGraph: stage cache entry of %s was evicted during the run' % stage['name'])
+        print('%s outputs loaded from %s') % (stage['name'], 'checkpoint' if fromCheckpoint else 'stage cache')
+        with traceStage(stage['name'] + (' (checkpoint)' if fromCheckpoint else ' (cache hit)'), dict(stage['parameters'], outputs=traceValue(stage['outputs']))):
+            returnedNode = self.logic.readStageEntry(entryPath, stage['outputs'])
+    elif stage['action'] == 'run':
+        if stage['geometryOnly'] and self.logic.checkpoint:
+            stage['geometryBefore'] = [self.logic.WorldMatrix(node) for node in stage['outputs']]
+        with traceStage(stage['name'], dict(stage['parameters'], outputs=traceValue(stage['outputs']))):
+            returnedNode = stage['function'](*[self.resolve(argument) for argument in stage['arguments']])
+    self.finishStage(stage, returnedNode)
+
+  def finishStage(self, stage, returnedNode):
+    """ Writes the outputs of a stage that ran to the stage cache and checkpoint (only the matrix changes of geometry stages, nothing of other
+    uncached stages), sets the output content keys and releases returned nodes no longer needed
+    """
+    stageCache = self.logic.stageCache
+    checkpoint = self.logic.checkpoint
+    if stage['action'] == 'run' and stage['cached'] and stageCache:
+        with traceStage(stage['name'] + ' (cache write)', dict(stage['parameters'], outputs=traceValue(stage['outputs']))):
+            entryPath = stageCache.beginEntry(stage['key'])
+            self.logic.writeStageEntry(entryPath, stage['outputs'], returnedNode)
+            stageCache.commitEntry(stage['key'], entryPath)
+    if stage['action'] == 'run' and checkpoint and (stage['cached'] or stage['geometryOnly']):
+        with traceStage(stage['name'] + ' (checkpoint write)', dict(stage['parameters'], outputs=traceValue(stage['outputs']))):
+            entryPath = checkpoint.stages.beginEntry(stage['key'])
+            if stage['geometryOnly']:
+                self.logic.writeGeometryEntry(entryPath, stage['outputs'], stage.pop('geometryBefore'))
+            else:
+                self.logic.writeStageEntry(entryPath, stage['outputs'], returnedNode)
+            checkpoint.stages.commitEntry(stage['key'], entryPath)
+
+    if stage['returns'] and returnedNode:
+        self.results[stage['returns']] = returnedNode
+        self.logic.intermediates.register(returnedNode)
+    if stage['key']:
+        for index, node in enumerate(stage['outputs'] + ([returnedNode] if returnedNode else [])):
+            self.logic.nodeKeys[node.GetID()] = stage['key'] + ':' + str(index)
+
+    # A returned node is released once every stage reading it has finished
+    self.finished.add(stage['index'])
+    for result, node in list(self.results.items()):
+        if all(reader in self.finished for reader in self.readers.get(result, [])):
+            self.logic.intermediates.release(node)
+            del self.results[result]
+
+#
+# SimpleITKBridge
+#
+
+class SimpleITKBridge(object):
+  """ Moves voxels between volume nodes and SimpleITK images without going through sitkUtils read/write addresses.
+  Volumes are wrapped as NumPy views of their vtkImageData scalars and copied once into SimpleITK images with the node geometry (LPS),
+  since SimpleITK cannot wrap an external buffer. Results are read through a view of the image and written into the existing image data
+  of output nodes when size and type match. Every call records the bytes it copied (see report)
+  """
+
+  def __init__(self, logic=None):
+    self.logic = logic or PreProcessLogic()
+    self.calls = [] # (call, node name, bytes copied)
+
+  def record(self, call, node, bytesCopied):
+    self.calls.append((call, node.GetName(), bytesCopied))
+    return bytesCopied
+
+  def arrayFromVolume(self, volumeNode):
+    """ Returns the (k,j,i) NumPy view of a volume (no copy)
+    """
+    self.record('arrayFromVolume', volumeNode, 0)
+    return self.logic.arrayFromVolume(volumeNode)
+
+  def imageFromVolume(self, volumeNode):
+    """ Returns a SimpleITK image of a volume with its geometry including parent transforms. The voxels are copied once into the image
+    """
+    voxels = self.logic.arrayFromVolume(volumeNode)
+    image = sitk.GetImageFromArray(voxels)
+    self.record('imageFromVolume', volumeNode, voxels.nbytes)
+    origin, spacing, direction = self.logic.sitkGeometry(volumeNode)
+    image.SetOrigin(origin)
+    image.SetSpacing(spacing)
+    image.SetDirection(direction)
+    return image
+
+  def writeVolume(self, volumeNode, image):
+    """ Writes a SimpleITK image with its geometry into a volume node, reusing the node's image data if its size and scalar type match
+    """
+    if hasattr(sitk, 'GetArrayViewFromImage'):
+        voxels = sitk.GetArrayViewFromImage(image)
+        bytesCopied = 0
+    else:
+        voxels = sitk.GetArrayFromImage(image)
+        bytesCopied = voxels.nbytes
+    if (self.logic.hasImageData(volumeNode) and volumeNode.GetImageData().GetNumberOfScalarComponents() == 1 and
+        self.logic.arrayFromVolume(volumeNode).shape == voxels.shape and self.logic.arrayFromVolume(volumeNode).dtype == voxels.dtype):
+        self.logic.arrayFromVolume(volumeNode)[:] = voxels
+        bytesCopied += voxels.nbytes
+        self.logic.arrayFromVolumeModified(volumeNode)
+    else:
+        volumeNode.SetAndObserveImageData(self.logic.imageDataFromArray(voxels))
+        bytesCopied += voxels.nbytes
+
+    # LPS geometry of the image to the IJK to RAS matrix of the node
+    lps = [-1.0, -1.0, 1.0]
+    spacing, origin, direction = image.GetSpacing(), image.GetOrigin(), image.GetDirection()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for row in range(3):
+        for column in range(3):
+            ijkToRAS.SetElement(row, column, lps[row]*direction[3*row+column]*spacing[column])
+        ijkToRAS.SetElement(row, 3, lps[row]*origin[row])
+    volumeNode.SetIJKToRASMatrix(ijkToRAS)
+    return self.record('writeVolume', volumeNode, bytesCopied)
+
+  def report(self):
+    """ Prints the bytes copied by each call and in total, and returns the total
+    """
+    totalBytes = sum(bytesCopied for call, name, bytesCopied in self.calls)
+    for call, name, bytesCopied in self.calls:
+        print('%-16s %-40s %12i bytes copied') % (call, name, bytesCopied)
+    print('SimpleITK bridge: %i calls, %0.1f MB copied') % (len(self.calls), totalBytes/1024.0**2)
+    return totalBytes
+
 #
 # PreProcess
 #
@@ -92,6 +747,31 @@ class PreProcessWidget(ScriptedLoadableModuleWidget):
     self.SaveDataCheckBox.checked = False
     parametersFormLayout.addWidget(self.SaveDataCheckBox)
 
+    self.LabelEngineCheckBox = qt.QCheckBox("Process Labels In-Process (NumPy)")
+    self.LabelEngineCheckBox.toolTip = "Threshold and combine labelmaps in the Slicer process instead of running a CLI module for each step."
+    self.LabelEngineCheckBox.checked = True
+    parametersFormLayout.addWidget(self.LabelEngineCheckBox)
+
+    self.StageCacheCheckBox = qt.QCheckBox("Reuse Cached Stage Outputs")
+    self.StageCacheCheckBox.toolTip = "Skip processing stages whose input files and parameters have not changed since a previous run."
+    self.StageCacheCheckBox.checked = True
+    parametersFormLayout.addWidget(self.StageCacheCheckBox)
+
+    self.SaveCompressionComboBox = qt.QComboBox()
+    self.SaveCompressionComboBox.addItems(['full', 'fast', 'raw'])
+    self.SaveCompressionComboBox.toolTip = "Compression of saved NRRD labelmaps: full gzip, fast gzip (level 1) or raw (no compression)."
+    parametersFormLayout.addRow("NRRD Compression:", self.SaveCompressionComboBox)
+
+    self.MRAlignmentComboBox = qt.QComboBox()
+    self.MRAlignmentComboBox.addItems(['bounds', 'centroid', 'model'])
+    self.MRAlignmentComboBox.toolTip = "MRI to U/S capsule alignment: bounding box or centroid of the MR capsule label voxels, or bounding box of an MR capsule model (ModelMaker)."
+    parametersFormLayout.addRow("MR Alignment:", self.MRAlignmentComboBox)
+
+    self.CheckpointComboBox = qt.QComboBox()
+    self.CheckpointComboBox.addItems(['off', 'write', 'resume'])
+    self.CheckpointComboBox.toolTip = "Write every completed stage to a patient checkpoint (write), or reload the checkpoint of an interrupted run and continue from the unfinished stages (resume)."
+    parametersFormLayout.addRow("Checkpoints:", self.CheckpointComboBox)
+
     # Apply Button
     #
     self.applyButton = qt.QPushButton("Apply")
@@ -115,7 +795,11 @@ class PreProcessWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = True
 
   def onApplyButton(self):
-    logic = PreProcessLogic()
+    stageCache = PreProcessStageCache() if self.StageCacheCheckBox.checked else None
+    checkpointDirectory = os.path.join(slicer.app.temporaryPath, 'Checkpoints') if self.CheckpointComboBox.currentText != 'off' else None
+    logic = PreProcessLogic(useInProcessLabelEngine=self.LabelEngineCheckBox.checked, stageCache=stageCache,
+                            saveCompression=self.SaveCompressionComboBox.currentText, mrAlignment=self.MRAlignmentComboBox.currentText,
+                            checkpointDirectory=checkpointDirectory, resume=self.CheckpointComboBox.currentText == 'resume')
     logic.run(str(int(self.PatientNumberIterationsSpinBox.value)), self.SaveDataCheckBox.checked)
 # PreProcessLogic
 #
@@ -130,6 +814,47 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  dataRoot = PreProcessInputs.dataRoot # location of the invivo patient directories
+
+  # Anti-aliasing of each label before its gaussian smoothing, as done by the labelmapsmoothing CLI (passed to the CLI as well so both agree)
+  labelSmoothingIterations = 50
+  labelSmoothingRMSError = 0.01
+
+  # gzip level used for saved NRRD files (mostly empty label volumes save much faster with raw or fast compression)
+  saveCompressionLevels = {'raw': 0, 'fast': 1, 'full': 6}
+
+  def __init__(self, useInProcessLabelEngine=True, maxConcurrentCLINodes=None, useNativeVoxelizer=True, stageCache=None, saveCompression='full', traceDirectory=None,
+               useInProcessResampler=True, useInProcessSmoothing=True, useInProcessMesher=True, mrAlignment='bounds',
+               intermediateMemoryBudget=0, checkpointDirectory=None, resume=False):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # Optional PreProcessStageCache used by run() to skip stages whose inputs and parameters are unchanged
+    self.stageCache = stageCache
+    # run() writes every completed stage to a per patient RunCheckpoint in checkpointDirectory, resume reloads them and runs the unfinished stages
+    self.checkpointDirectory = checkpointDirectory
+    self.resume = resume
+    self.checkpoint = None # RunCheckpoint of the running patient
+    self.saveCompression = saveCompression # key of saveCompressionLevels
+    self.traceDirectory = traceDirectory # StageTrace output of run(), defaults to the Slicer temporary directory
+    self.nodeKeys = {} # node ID -> content key of the node data
+    self.modalityTransforms = {} # 'US'/'MR' -> linear transform node composed by US_transform and MR_translate
+    # Intermediate nodes (MR models, ModelMaker hierarchies) are removed from the scene once their stage is done and they exceed this many bytes
+    self.intermediates = IntermediateNodes(intermediateMemoryBudget)
+    # Label thresholding/combining runs on NumPy views of the volume nodes when True,
+    # otherwise (or when inputs do not allow it) every step runs as a CLI module
+    self.useInProcessLabelEngine = useInProcessLabelEngine
+    # Models are rasterized in process with a polydata stencil when True, otherwise with the modeltolabelmap CLI
+    self.useNativeVoxelizer = useNativeVoxelizer
+    # Volumes are resampled onto the ARFI grid with SimpleITK in process when True, otherwise with the resamplescalarvectordwivolume CLI
+    self.useInProcessResampler = useInProcessResampler
+    # Labelmaps are smoothed in one in-process SimpleITK pass by BatchLabelMapSmoothing when True, otherwise with the labelmapsmoothing CLI
+    self.useInProcessSmoothing = useInProcessSmoothing
+    # Models are built from labels in process by LabelToModel when True, otherwise with the modelmaker CLI
+    self.useInProcessMesher = useInProcessMesher
+    # MR_translate alignment: 'bounds' or 'centroid' of the MR capsule label voxels, or 'model' for the bounds of an MR capsule mesh
+    self.mrAlignment = mrAlignment
+    # Maximum number of independent CLI nodes run at once in the background (defaults to number of cores)
+    self.maxConcurrentCLINodes = maxConcurrentCLINodes or multiprocessing.cpu_count()
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -143,6 +868,71 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  def canUseLabelEngine(self, *inputVolumes):
+    """ Returns true if the in-process label engine can be used on all inputted volumes (single component image data of the same dimensions)
+    """
+    if not self.useInProcessLabelEngine:
+      return False
+    dimensions = None
+    for inputVolume in inputVolumes:
+      if not self.hasImageData(inputVolume):
+        return False
+      imageData = inputVolume.GetImageData()
+      if imageData.GetNumberOfScalarComponents() != 1:
+        logging.debug('canUseLabelEngine failed: %s is not a single component volume' % inputVolume.GetName())
+        return False
+      if dimensions is None:
+        dimensions = imageData.GetDimensions()
+      elif imageData.GetDimensions() != dimensions:
+        logging.debug('canUseLabelEngine failed: %s has different dimensions' % inputVolume.GetName())
+        return False
+    return True
+
+  def arrayFromVolume(self, inputVolume):
+    """ Returns a NumPy view (k,j,i ordering) of the scalars of an input volume. Changes to the array modify the volume without copying
+    """
+    imageData = inputVolume.GetImageData()
+    dimensions = imageData.GetDimensions()
+    scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    return scalars.reshape(dimensions[2], dimensions[1], dimensions[0])
+
+  def arrayFromVolumeModified(self, inputVolume):
+    """ Notifies the scene that the voxels of an input volume were changed through its NumPy view
+    """
+    imageData = inputVolume.GetImageData()
+    imageData.GetPointData().GetScalars().Modified()
+    imageData.Modified()
+    inputVolume.Modified()
+
+  def updateVolumeFromArray(self, outputVolume, outputArray, referenceVolume):
+    """ Writes a (k,j,i) array into an output volume, allocating image data with the reference volume geometry if the output does not match
+    """
+    if self.hasImageData(outputVolume) and outputVolume.GetImageData().GetDimensions() == referenceVolume.GetImageData().GetDimensions():
+        # write in place so no new image data is allocated
+        outputView = self.arrayFromVolume(outputVolume)
+        outputView[:] = outputArray
+        self.arrayFromVolumeModified(outputVolume)
+    else:
+        outputVolume.SetAndObserveImageData(self.imageDataFromArray(outputArray))
+    outputVolume.CopyOrientation(referenceVolume)
+    if referenceVolume.GetParentTransformNode() or outputVolume.GetParentTransformNode():
+        # keep the output on the reference grid in world coordinates
+        worldToOutputParent = self.TransformToWorld(outputVolume)
+        worldToOutputParent.Invert()
+        ijkToRAS = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(worldToOutputParent, self.WorldIJKToRAS(referenceVolume), ijkToRAS)
+        outputVolume.SetIJKToRASMatrix(ijkToRAS)
+
+  def imageDataFromArray(self, inputArray):
+    """ Allocates new single component image data with the dimensions and scalar type of a (k,j,i) array and copies the array into it
+    """
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(inputArray.shape[2], inputArray.shape[1], inputArray.shape[0])
+    imageData.AllocateScalars(numpy_support.get_vtk_array_type(inputArray.dtype), 1)
+    imageView = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    imageView[:] = numpy.ascontiguousarray(inputArray).ravel()
+    return imageData
+
   def isValidUltrasoundData(self, VolumeNode1, VolumeNode2, VolumeNode3, ModelNode1, ModelNode2):
     """Validates if ultrasound data is defined
     """
@@ -213,9 +1003,8 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     invert_transform = vtk.vtkMatrix4x4()
     invert_transform.SetElement(2,2,-1) # put a -1 in 3rd entry of diagonal of matrix
 
-    # Apply transform to all input nodes
-    for ARFIinput in ARFIinputs:
-        ARFIinput.ApplyTransformMatrix(invert_transform)
+    # Compose onto the US transform observed by all input nodes (model points are not rewritten)
+    self.ComposeModalityTransform('US', invert_transform, *ARFIinputs)
     # inputARFI.ApplyTransformMatrix(invert_transform)
     # inputBmode.ApplyTransformMatrix(invert_transform)
     # inputCC.ApplyTransformMatrix(invert_transform)
@@ -226,6 +1015,58 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def ComposeModalityTransform(self, modality, matrix, *inputNodes):
+    """ Concatenates a matrix onto the linear transform node of a modality (created on first use) and makes the input nodes observe it.
+    Node geometry is only changed when the transform is hardened (see HardenTransforms), or when an input node observes another transform,
+    which is hardened into the node first so it is not lost
+    """
+    transformNode = self.modalityTransforms.get(modality)
+    if transformNode is None:
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetName(modality + ' Transform')
+        slicer.mrmlScene.AddNode(transformNode)
+        self.modalityTransforms[modality] = transformNode
+
+    currentMatrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(currentMatrix)
+    composedMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(matrix, currentMatrix, composedMatrix) # new matrix applied after the current one
+    transformNode.SetMatrixTransformToParent(composedMatrix)
+
+    for inputNode in inputNodes:
+        if inputNode.GetTransformNodeID() != transformNode.GetID():
+            if inputNode.GetParentTransformNode():
+                logging.debug('ComposeModalityTransform: hardening the transform %s observes before the %s transform' % (inputNode.GetName(), modality))
+                slicer.vtkSlicerTransformLogic().hardenTransform(inputNode)
+            inputNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    return transformNode
+
+  def HardenTransforms(self, *inputNodes):
+    """ Bakes parent transforms into the nodes (volume geometry or model points) for consumers that read node data directly (CLI modules, saving)
+    """
+    transformLogic = slicer.vtkSlicerTransformLogic()
+    for inputNode in inputNodes:
+        if inputNode.GetParentTransformNode():
+            transformLogic.hardenTransform(inputNode)
+
+  def TransformToWorld(self, inputNode):
+    """ Returns the matrix of the (linear) parent transforms of a node, identity if it has none
+    """
+    toWorld = vtk.vtkMatrix4x4()
+    transformNode = inputNode.GetParentTransformNode()
+    if transformNode:
+        transformNode.GetMatrixTransformToWorld(toWorld)
+    return toWorld
+
+  def WorldIJKToRAS(self, inputVolume):
+    """ Returns the IJK to RAS matrix of a volume including its parent transforms
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    worldIJKToRAS = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(self.TransformToWorld(inputVolume), ijkToRAS, worldIJKToRAS)
+    return worldIJKToRAS
+
   def ModelToLabelMap(self, inputVolume, inputModel, outputVolume, sampleDistance):
     """ Converts models into a labelmap on the input T2-MRI volume using sample distance  provided(smaller than smallest pixel width in input volume)
     """
@@ -236,14 +1077,71 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # Get spacing of inputVolume and multiply by 0.8 to determine sample distance
     # samplevoxeldistance = round(0.8*min(inputVolume.GetSpacing()),2) # rounds to 2 decimal points for 80% of smallest voxel
 
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': outputVolume.GetID(), 'sampleDistance': sampleDistance, 'labelValue': 10}
-    cliNode = slicer.cli.run(slicer.modules.modeltolabelmap, None, cliParams, wait_for_completion=True)
+    if self.useNativeVoxelizer:
+        # Rasterize in process (voxel centers are tested directly so sample distance is not needed)
+        self.VoxelizeModel(inputVolume, inputModel, outputVolume)
+    else:
+        # Run the slicer module in CLI
+        self.HardenTransforms(inputVolume, inputModel)
+        cliParams = self.ModelToLabelMapParameters(inputVolume, inputModel, outputVolume, sampleDistance)
+        cliNode = slicer.cli.run(slicer.modules.modeltolabelmap, None, cliParams, wait_for_completion=True)
     
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def ModelToLabelMapParameters(self, inputVolume, inputModel, outputVolume, sampleDistance):
+    """ Returns the modeltolabelmap CLI parameters for converting a model onto the input volume grid with label value 10.
+    The CLI reads node data as stored, so parent transforms of the input volume and model must be hardened first (see HardenTransforms)
+    """
+    return {'InputVolume': inputVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': outputVolume.GetID(), 'sampleDistance': sampleDistance, 'labelValue': 10}
+
+  def VoxelizeModel(self, inputVolume, inputModel, outputVolume, labelValue=10):
+    """ Converts a closed model onto the input volume grid in process using a polydata-to-stencil rasterization limited to the bounding box of the model
+    """
+    # Move the model into IJK coordinates of the input volume so voxel centers fall on integer positions
+    # (parent transforms of the model and volume are composed here, the model points are not rewritten)
+    rasToIJK = self.WorldIJKToRAS(inputVolume)
+    rasToIJK.Invert()
+    rasToIJKTransform = vtk.vtkTransform()
+    rasToIJKTransform.SetMatrix(rasToIJK)
+    rasToIJKTransform.Concatenate(self.TransformToWorld(inputModel))
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(inputModel.GetPolyData())
+    transformFilter.SetTransform(rasToIJKTransform)
+    transformFilter.Update()
+    ijkPolyData = transformFilter.GetOutput()
+
+    # Only voxels inside the model bounding box (clipped to the volume) are rasterized
+    dimensions = inputVolume.GetImageData().GetDimensions()
+    bounds = ijkPolyData.GetBounds()
+    extent = []
+    for axis in range(3):
+        extent.append(max(0, int(math.ceil(bounds[2*axis]))))
+        extent.append(min(dimensions[axis]-1, int(math.floor(bounds[2*axis+1]))))
+
+    labelArray = numpy.zeros((dimensions[2], dimensions[1], dimensions[0]), dtype=numpy.uint8)
+    if extent[0] <= extent[1] and extent[2] <= extent[3] and extent[4] <= extent[5]:
+        polyDataToStencil = vtk.vtkPolyDataToImageStencil()
+        polyDataToStencil.SetInputData(ijkPolyData)
+        polyDataToStencil.SetOutputOrigin(0, 0, 0)
+        polyDataToStencil.SetOutputSpacing(1, 1, 1)
+        polyDataToStencil.SetOutputWholeExtent(extent)
+
+        stencilToImage = vtk.vtkImageStencilToImage()
+        stencilToImage.SetInputConnection(polyDataToStencil.GetOutputPort())
+        stencilToImage.SetInsideValue(labelValue)
+        stencilToImage.SetOutsideValue(0)
+        stencilToImage.SetOutputScalarTypeToUnsignedChar()
+        stencilToImage.Update()
+
+        # Paste the bounding box block into the full size label
+        blockScalars = numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars())
+        blockArray = blockScalars.reshape(extent[5]-extent[4]+1, extent[3]-extent[2]+1, extent[1]-extent[0]+1)
+        labelArray[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1] = blockArray
+
+    self.updateVolumeFromArray(outputVolume, labelArray, inputVolume)
+
   def MRCapModelMaker(self, inputMRlabel):
     """ Converts MRI labelmap segemntation into slicer VTK model node
     """
@@ -251,6 +1149,12 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Creating MR Model...'),
     start_time = time.time()
 
+    if self.useInProcessMesher:
+        outputMRModel = self.LabelToModel(inputMRlabel, 'mr-cap_1_1', 70)
+        end_time = time.time()
+        print('done (%0.2f s)') % float(end_time-start_time)
+        return outputMRModel
+
     # Set model parameters
     parameters = {} 
     parameters["InputVolume"] = inputMRlabel.GetID()
@@ -283,6 +1187,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     outHierarchy.SetScene( slicer.mrmlScene )
     outHierarchy.SetName( "MRI Models" )
     slicer.mrmlScene.AddNode( outHierarchy )
+    self.intermediates.register(outHierarchy) # only needed while ModelMaker runs
 
     # Set the parameter for the output model heirarchy
     parameters["ModelSceneFile"] = outHierarchy
@@ -309,6 +1214,12 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # Change input label value
     self.ThresholdScalarVolume(inputMRlabel,  34)
 
+    if self.useInProcessMesher:
+        outputMRModel = self.LabelToModel(inputMRlabel, 'model_34_34', smoothingValue)
+        end_time = time.time()
+        print('done (%0.2f s)') % float(end_time-start_time)
+        return outputMRModel
+
     # Set model parameters
     parameters = {} 
     parameters["InputVolume"] = inputMRlabel.GetID()
@@ -342,6 +1253,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     outHierarchy.SetScene( slicer.mrmlScene )
     outHierarchy.SetName( ('MRI Models Smooth '+ str(smoothingValue)) )
     slicer.mrmlScene.AddNode( outHierarchy )
+    self.intermediates.register(outHierarchy) # only needed while ModelMaker runs
 
     # Set the parameter for the output model heirarchy
     parameters["ModelSceneFile"] = outHierarchy
@@ -359,6 +1271,64 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     return outputMRModel  
 
 
+  def LabelToModel(self, inputLabel, name, smoothingIterations, decimate=0.1):
+    """ Builds a surface model of the nonzero voxels of a labelmap in process (discrete flying edges, windowed sinc smoothing and decimation)
+    and returns the new model node. The label is padded by one voxel so surfaces touching the volume edge are closed
+    """
+    labelArray = numpy.pad((self.arrayFromVolume(inputLabel) > 0).astype(numpy.uint8), 1, 'constant')
+    paddedImage = self.imageDataFromArray(labelArray)
+    paddedImage.SetOrigin(-1, -1, -1) # points come out in IJK coordinates of the unpadded label
+
+    # Discrete flying edges (VTK 8.1 and later) is much faster than discrete marching cubes and gives the same surface
+    if hasattr(vtk, 'vtkDiscreteFlyingEdges3D'):
+        surfaceExtractor = vtk.vtkDiscreteFlyingEdges3D()
+    else:
+        surfaceExtractor = vtk.vtkDiscreteMarchingCubes()
+    surfaceExtractor.SetInputData(paddedImage)
+    surfaceExtractor.SetValue(0, 1)
+    surfaceExtractor.ComputeNormalsOff()
+    surfaceExtractor.ComputeGradientsOff()
+    surfaceExtractor.ComputeScalarsOff()
+
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(surfaceExtractor.GetOutputPort())
+    smoother.SetNumberOfIterations(int(smoothingIterations))
+    smoother.SetPassBand(0.1)
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+
+    decimator = vtk.vtkDecimatePro()
+    decimator.SetInputConnection(smoother.GetOutputPort())
+    decimator.SetTargetReduction(decimate)
+    decimator.PreserveTopologyOn()
+
+    # Move the surface from IJK to RAS, flipping triangle orientation if the volume axes are mirrored
+    ijkToRAS = self.WorldIJKToRAS(inputLabel)
+    ijkToRASTransform = vtk.vtkTransform()
+    ijkToRASTransform.SetMatrix(ijkToRAS)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(decimator.GetOutputPort())
+    transformFilter.SetTransform(ijkToRASTransform)
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformFilter.GetOutputPort())
+    normals.ComputePointNormalsOn()
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    normals.SetFlipNormals(ijkToRAS.Determinant() < 0)
+    normals.Update()
+
+    outputModel = slicer.vtkMRMLModelNode()
+    outputModel.SetName(name)
+    outputModel.SetAndObservePolyData(normals.GetOutput())
+    slicer.mrmlScene.AddNode(outputModel)
+    displayNode = slicer.vtkMRMLModelDisplayNode()
+    slicer.mrmlScene.AddNode(displayNode)
+    outputModel.SetAndObserveDisplayNodeID(displayNode.GetID())
+    return outputModel
+
   def MR_translate(self, movingMRIModel, fixedUSModel, *MRIinputs): 
     """ Translates MRI capsule and T2 imaging volume to roughly align with US capsule model so T2 prostate is within ARFI image
     """
@@ -367,26 +1337,113 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     start_time = time.time()
 
     # Find out coordinates of models to be used for translation matrix
-    moving_bounds = movingMRIModel.GetPolyData().GetBounds()
-    fixed_bounds  =   fixedUSModel.GetPolyData().GetBounds()
+    moving_bounds = self.ModelBounds(movingMRIModel)
+    fixed_bounds  = self.ModelBounds(fixedUSModel)
 
-    
-    # Define transform matrix
-    translate_transform = vtk.vtkMatrix4x4()
-    translate_transform.SetElement(2,3,fixed_bounds[5] - moving_bounds[5]) # lines up base of prostate 
-    translate_transform.SetElement(1,3,fixed_bounds[2] - moving_bounds[2]) # lines up posterior of prostate 
-    translate_transform.SetElement(0,3,fixed_bounds[0] - moving_bounds[0]) # lines up right side of prostate 
-    
-    # OPTIONAL: print transform to Python CLI
-    print translate_transform 
+    self.TranslateMRInputs(self.BoundsTranslation(moving_bounds, fixed_bounds), *MRIinputs)
+
+    # print to Slicer CLI
+    end_time = time.time()
+    print('done (%0.2f s)') % float(end_time-start_time)
+
+  def MR_translateFromLabel(self, movingMRILabel, fixedUSModel, *MRIinputs):
+    """ Same alignment as MR_translate but measured directly on the MR capsule label voxels, so no MR capsule mesh is needed.
+    Uses bounding boxes or centroids depending on mrAlignment
+    """
+    # Print to Slicer CLI
+    print('Translating MRI inputs to U/S capsule (%s of label)...') % self.mrAlignment,
+    start_time = time.time()
 
-    # Apply transform to all MRI inputs
-    for MRIinput in MRIinputs:
-        MRIinput.ApplyTransformMatrix(translate_transform)
+    if self.mrAlignment == 'centroid':
+        translation = [a-b for a, b in zip(self.ModelCentroid(fixedUSModel), self.LabelCentroid(movingMRILabel))]
+    else:
+        translation = self.BoundsTranslation(self.LabelBounds(movingMRILabel), self.ModelBounds(fixedUSModel))
+    self.TranslateMRInputs(translation, *MRIinputs)
 
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
+
+  def BoundsTranslation(self, moving_bounds, fixed_bounds):
+    """ Returns the RAS translation lining up base, posterior and right side of the moving and fixed prostate bounds
+    """
+    return [fixed_bounds[0] - moving_bounds[0],  # lines up right side of prostate
+            fixed_bounds[2] - moving_bounds[2],  # lines up posterior of prostate
+            fixed_bounds[5] - moving_bounds[5]]  # lines up base of prostate
+
+  def TranslateMRInputs(self, translation, *MRIinputs):
+    """ Applies an RAS translation to all MRI inputs
+    """
+    # Define transform matrix
+    translate_transform = vtk.vtkMatrix4x4()
+    for axis in range(3):
+        translate_transform.SetElement(axis, 3, translation[axis])
+
+    # OPTIONAL: print transform to Python CLI
+    print translate_transform
+
+    # Compose onto the MR transform observed by all MRI inputs
+    self.ComposeModalityTransform('MR', translate_transform, *MRIinputs)
+
+  def LabelBounds(self, inputLabel):
+    """ Returns the RAS bounds (xmin, xmax, ymin, ymax, zmin, zmax) of the voxel centers of the nonzero voxels of a labelmap
+    """
+    mask = self.arrayFromVolume(inputLabel) > 0
+    indexRanges = []
+    for axis, otherAxes in ((2, (0, 1)), (1, (0, 2)), (0, (1, 2))): # i, j, k
+        occupied = numpy.nonzero(mask.any(axis=otherAxes))[0] # projection of the label onto one axis
+        if not len(occupied):
+            return (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        indexRanges.append((occupied[0], occupied[-1]))
+
+    # RAS bounds are the extremes of the corners of the IJK bounding box
+    ijkToRAS = self.WorldIJKToRAS(inputLabel)
+    corners = numpy.array([[i, j, k, 1.0] for i in indexRanges[0] for j in indexRanges[1] for k in indexRanges[2]])
+    matrix = numpy.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+    rasCorners = corners.dot(matrix.T)[:, :3]
+    minimum, maximum = rasCorners.min(axis=0), rasCorners.max(axis=0)
+    return (minimum[0], maximum[0], minimum[1], maximum[1], minimum[2], maximum[2])
+
+  def LabelCentroid(self, inputLabel):
+    """ Returns the RAS centroid of the nonzero voxels of a labelmap
+    """
+    mask = self.arrayFromVolume(inputLabel) > 0
+    count = float(numpy.count_nonzero(mask))
+    if not count:
+        return [0.0, 0.0, 0.0]
+    # mean index along each axis from the projections of the label onto that axis
+    meanIndex = [numpy.dot(numpy.arange(mask.shape[axis]), mask.sum(axis=otherAxes))/count
+                 for axis, otherAxes in ((2, (0, 1)), (1, (0, 2)), (0, (1, 2)))]
+    ijkToRAS = self.WorldIJKToRAS(inputLabel)
+    return list(ijkToRAS.MultiplyPoint(meanIndex + [1.0])[:3])
+
+  def ModelCentroid(self, inputModel):
+    """ Returns the centroid of the volume enclosed by a closed surface model (sum of signed tetrahedra to the origin)
+    """
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(inputModel.GetPolyData())
+    triangleFilter.PassLinesOff()
+    triangleFilter.PassVertsOff()
+    triangleFilter.Update()
+    triangles = triangleFilter.GetOutput()
+    points = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData()).astype(numpy.float64)
+    cells = numpy_support.vtk_to_numpy(triangles.GetPolys().GetData()).reshape(-1, 4)[:, 1:]
+    a, b, c = points[cells[:, 0]], points[cells[:, 1]], points[cells[:, 2]]
+    volumes = numpy.einsum('ij,ij->i', a, numpy.cross(b, c)) / 6.0
+    if volumes.sum():
+        centroid = (volumes[:, None]*(a + b + c)/4.0).sum(axis=0) / volumes.sum()
+    else:
+        centroid = points.mean(axis=0)
+    return list(self.TransformToWorld(inputModel).MultiplyPoint(list(centroid) + [1.0])[:3])
+
+  def ModelBounds(self, inputModel):
+    """ Returns the RAS bounds of a model including its parent (linear) transform
+    """
+    bounds = inputModel.GetPolyData().GetBounds()
+    toWorld = self.TransformToWorld(inputModel)
+    corners = numpy.array([toWorld.MultiplyPoint([x, y, z, 1.0])[:3] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+    minimum, maximum = corners.min(axis=0), corners.max(axis=0)
+    return (minimum[0], maximum[0], minimum[1], maximum[1], minimum[2], maximum[2])
   
   def SegmentationSmoothing(self, inputVolume, outputsmoothedVolume, *labelNumber):
     """ Smooths an input volume into an outputVolume using the Segmentation Smoothing Module from SlicerProstate module
@@ -396,11 +1453,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     start_time = time.time()
 
     # Define parameters for smoothing
-    parameters = {}
-    parameters["inputImageName"]= inputVolume.GetID()
-    parameters["outputImageName"]= outputsmoothedVolume.GetID()
-    if labelNumber:
-        parameters['labelNumber'] = int(labelNumber[0]) # have to grab first value of tuple for optional argument
+    parameters = self.SegmentationSmoothingParameters(inputVolume, outputsmoothedVolume, *labelNumber)
 
     # Rn the smoothing segmentation module from CLI
     cliNode = slicer.cli.run(slicer.modules.segmentationsmoothing, None, parameters, wait_for_completion = True)
@@ -409,6 +1462,16 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def SegmentationSmoothingParameters(self, inputVolume, outputsmoothedVolume, *labelNumber):
+    """ Returns the segmentationsmoothing CLI parameters for one smoothing
+    """
+    parameters = {}
+    parameters["inputImageName"]= inputVolume.GetID()
+    parameters["outputImageName"]= outputsmoothedVolume.GetID()
+    if labelNumber:
+        parameters['labelNumber'] = int(labelNumber[0]) # have to grab first value of tuple for optional argument
+    return parameters
+
   def ResampleVolumefromReference(self, referenceVolume, *inputVolumes):
     """ Resamples an input volume to match ARFI reference volume spacing, size, orientation, and origin
     """
@@ -416,15 +1479,69 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Resampling volumes to match ARFI...'),
     start_time = time.time()
 
-    for inputVolume in inputVolumes:
-        # Run Resample ScalarVectorDWIVolume Module from CLI
-        cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': inputVolume.GetID(), 'referenceVolume': referenceVolume.GetID()}
-        cliNode = slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, cliParams, wait_for_completion=True)
+    singleComponent = all(self.hasImageData(inputVolume) and inputVolume.GetImageData().GetNumberOfScalarComponents() == 1 for inputVolume in inputVolumes)
+    if self.useInProcessResampler and sitk is not None and singleComponent:
+        self.ResampleVolumesInProcess(referenceVolume, *inputVolumes)
+    else:
+        for inputVolume in inputVolumes:
+            # Run Resample ScalarVectorDWIVolume Module from CLI
+            cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': inputVolume.GetID(), 'referenceVolume': referenceVolume.GetID()}
+            cliNode = slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, cliParams, wait_for_completion=True)
 
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def ResampleVolumesInProcess(self, referenceVolume, *inputVolumes):
+    """ Resamples all input volumes onto the reference grid with SimpleITK (nearest neighbour for labelmaps, linear otherwise).
+    The reference grid is built once and the volumes are resampled at the same time on a thread pool
+    """
+    referenceOrigin, referenceSpacing, referenceDirection = self.sitkGeometry(referenceVolume)
+    referenceSize = [int(x) for x in referenceVolume.GetImageData().GetDimensions()]
+
+    # Node data is read on the main thread, the pool threads only see SimpleITK images
+    resampleJobs = []
+    for inputVolume in inputVolumes:
+        inputImage = sitk.GetImageFromArray(self.arrayFromVolume(inputVolume)) # copy, the input node is overwritten below
+        inputOrigin, inputSpacing, inputDirection = self.sitkGeometry(inputVolume)
+        inputImage.SetOrigin(inputOrigin)
+        inputImage.SetSpacing(inputSpacing)
+        inputImage.SetDirection(inputDirection)
+        interpolator = sitk.sitkNearestNeighbor if inputVolume.IsA('vtkMRMLLabelMapVolumeNode') else sitk.sitkLinear
+        resampleJobs.append((inputImage, interpolator))
+
+    def resample(resampleJob):
+        inputImage, interpolator = resampleJob
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetSize(referenceSize)
+        resampler.SetOutputOrigin(referenceOrigin)
+        resampler.SetOutputSpacing(referenceSpacing)
+        resampler.SetOutputDirection(referenceDirection)
+        resampler.SetInterpolator(interpolator)
+        resampler.SetDefaultPixelValue(0)
+        resampler.SetOutputPixelType(inputImage.GetPixelID())
+        return sitk.GetArrayFromImage(resampler.Execute(inputImage))
+
+    pool = ThreadPool(max(1, min(len(resampleJobs), multiprocessing.cpu_count())))
+    try:
+        resampledArrays = pool.map(resample, resampleJobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for inputVolume, resampledArray in zip(inputVolumes, resampledArrays):
+        self.updateVolumeFromArray(inputVolume, resampledArray, referenceVolume)
+
+  def sitkGeometry(self, inputVolume):
+    """ Returns the SimpleITK (LPS) origin, spacing and row-major direction of a volume node
+    """
+    ijkToRAS = self.WorldIJKToRAS(inputVolume)
+    lps = [-1.0, -1.0, 1.0]
+    origin = tuple(lps[row]*ijkToRAS.GetElement(row, 3) for row in range(3))
+    spacing = tuple(math.sqrt(sum(ijkToRAS.GetElement(row, column)**2 for row in range(3))) for column in range(3))
+    direction = tuple(lps[row]*ijkToRAS.GetElement(row, column)/spacing[column] for row in range(3) for column in range(3))
+    return origin, spacing, direction
+
   def LabelMapSmoothing(self, inputVolume, Sigma, *labelNumber):
     """ Smooths an input volume labelmap using value of sigma provided (number from 0-5). Optionally smooths only selected labels if more arguments passed
     """
@@ -443,6 +1560,69 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def BatchLabelMapSmoothing(self, Sigma, *inputVolumes):
+    """ Smooths every label of all input labelmaps in place with a gaussian of Sigma (mm) in one pass. Runs in process on a thread pool,
+    each label cropped to its bounding box plus a margin, or as one labelmapsmoothing CLI call per volume if SimpleITK is not available
+    """
+    # Print to Slicer CLI
+    print('Batched Label Map Smoothing of %i volumes...') % len(inputVolumes),
+    start_time = time.time()
+
+    singleComponent = all(self.hasImageData(inputVolume) and inputVolume.GetImageData().GetNumberOfScalarComponents() == 1 for inputVolume in inputVolumes)
+    if self.useInProcessSmoothing and sitk is not None and singleComponent:
+        self.SmoothLabelsInProcess(Sigma, *inputVolumes)
+    else:
+        for inputVolume in inputVolumes:
+            cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': inputVolume.GetID(), 'gaussianSigma': Sigma,
+                         'numberOfIterations': self.labelSmoothingIterations, 'maxRMSError': self.labelSmoothingRMSError}
+            cliNode = slicer.cli.run(slicer.modules.labelmapsmoothing, None, cliParams, wait_for_completion=True)
+
+    # print to Slicer CLI
+    end_time = time.time()
+    print('done (%0.2f s)') % float(end_time-start_time)
+
+  def SmoothLabelsInProcess(self, Sigma, *inputVolumes):
+    """ Smooths each label in each volume the way the labelmapsmoothing CLI does (anti-aliased binary mask, then a discrete gaussian with
+    variance Sigma^2 in mm, positive values keep the label) and writes the labels back in place
+    """
+    # One job per label of each volume, cropped on the main thread. The margin covers the gaussian kernel and the level set band
+    # of the anti-aliasing, so the cropped labels smooth as the whole volume would
+    smoothingJobs = []
+    for volumeIndex, inputVolume in enumerate(inputVolumes):
+        labelArray = self.arrayFromVolume(inputVolume)
+        spacing = inputVolume.GetSpacing()
+        margins = [int(math.ceil(3.0*Sigma/spacing[axis])) + 4 for axis in (2, 1, 0)] # (k,j,i) order
+        for label in numpy.unique(labelArray):
+            if label == 0:
+                continue
+            labelVoxels = numpy.nonzero(labelArray == label)
+            crop = tuple(slice(max(0, voxels.min()-margin), min(size, voxels.max()+margin+1))
+                         for voxels, margin, size in zip(labelVoxels, margins, labelArray.shape))
+            smoothingJobs.append((volumeIndex, label, crop, (labelArray[crop] == label).astype(numpy.float32), spacing))
+
+    def smooth(smoothingJob):
+        volumeIndex, label, crop, mask, spacing = smoothingJob
+        maskImage = sitk.GetImageFromArray(mask)
+        maskImage.SetSpacing(spacing)
+        levelSet = sitk.AntiAliasBinary(maskImage, self.labelSmoothingRMSError, self.labelSmoothingIterations) # positive inside the label
+        if Sigma > 0:
+            levelSet = sitk.DiscreteGaussian(levelSet, Sigma*Sigma)
+        return sitk.GetArrayFromImage(levelSet) > 0
+
+    pool = ThreadPool(max(1, min(len(smoothingJobs), multiprocessing.cpu_count())))
+    try:
+        smoothedMasks = pool.map(smooth, smoothingJobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for (volumeIndex, label, crop, mask, spacing), smoothedMask in zip(smoothingJobs, smoothedMasks):
+        labelRegion = self.arrayFromVolume(inputVolumes[volumeIndex])[crop]
+        labelRegion[labelRegion == label] = 0
+        labelRegion[smoothedMask] = label
+    for inputVolume in inputVolumes:
+        self.arrayFromVolumeModified(inputVolume)
+
   def ThresholdScalarVolume(self, inputVolume, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
@@ -450,9 +1630,15 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Changing Label Value...'),
     start_time = time.time()
 
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    if self.canUseLabelEngine(inputVolume):
+        # Set all values above 0.5 to the new label value in place
+        labelArray = self.arrayFromVolume(inputVolume)
+        labelArray[labelArray > 0.5] = newLabelVal
+        self.arrayFromVolumeModified(inputVolume)
+    else:
+        # Run the slicer module in CLI
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
     
     # print to Slicer CLI
     end_time = time.time()
@@ -473,33 +1659,62 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
  
-  def CreateRegistrationLabel(self, inputCapsule, inputCG, inputVM, registerLabel):
-
+  def CreateRegistrationLabel(self, inputCapsule, inputCG, inputVM, registerLabel, labelValue=None):
+    """ Creates the registration label (PZ and VM) from capsule, CG and VM labels without changing the inputs. Registration label has a value of 1 unless a final label value is provided
+    """
     # Print to Slicer CLI
     print('Creating Registration Label...'),
     start_time = time.time()
 
-    # Change Label Values for processing
-    self.ThresholdScalarVolume(inputCapsule,  1) 
-    self.ThresholdScalarVolume(inputCG,       2)
-    self.ThresholdScalarVolume(inputVM,       3)
+    if self.canUseLabelEngine(inputCapsule, inputCG, inputVM):
+        # Single lookup table pass over the three labels
+        self.FusedRegistrationLabel(inputCapsule, inputCG, inputVM, registerLabel, labelValue or 1)
+    else:
+        # Work on copies so the CLI chain leaves the inputs untouched
+        volumesLogic = slicer.modules.volumes.logic()
+        inputCapsule = volumesLogic.CloneVolume(inputCapsule, inputCapsule.GetName()+'-RegistrationCopy')
+        inputCG      = volumesLogic.CloneVolume(inputCG,      inputCG.GetName()+'-RegistrationCopy')
+        inputVM      = volumesLogic.CloneVolume(inputVM,      inputVM.GetName()+'-RegistrationCopy')
+
+        # Change Label Values for processing
+        self.ThresholdScalarVolume(inputCapsule,  1) 
+        self.ThresholdScalarVolume(inputCG,       2)
+        self.ThresholdScalarVolume(inputVM,       3)
+
+        # Combine CG and Capsule Labelmaps
+        self.ImageLabelCombine(inputCG, inputCapsule, registerLabel) # first label overwrites second
+
+        # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
+        self.ThresholdAbove(registerLabel, 1.5, 0) # PZ has value of 1
 
-    # Combine CG and Capsule Labelmaps
-    self.ImageLabelCombine(inputCG, inputCapsule, registerLabel) # first label overwrites second
+        # # Threshold VM to 1 before adding
+        self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
 
-    # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
-    self.ThresholdAbove(registerLabel, 1.5, 0) # PZ has value of 1
+        # # Add VM to output Label
+        self.ImageLabelCombine(registerLabel, inputVM, registerLabel) # first label overwrites 2nd label
 
-    # # Threshold VM to 1 before adding
-    self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
+        # Change label value for registration label
+        if labelValue:
+            self.ThresholdScalarVolume(registerLabel, labelValue)
 
-    # # Add VM to output Label
-    self.ImageLabelCombine(registerLabel, inputVM, registerLabel) # first label overwrites 2nd label
+        self.RemoveNode(inputCapsule, inputCG, inputVM)
 
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def FusedRegistrationLabel(self, inputCapsule, inputCG, inputVM, registerLabel, labelValue=1):
+    """ Writes the PZ+VM registration label in a single vectorized lookup table pass over the capsule, CG and VM labels (inputs are only read)
+    """
+    # Lookup table indexed by capsule + 2*CG + 4*VM: PZ (capsule outside CG) and all of VM get the label value
+    registrationLookupTable = numpy.array([0, 1, 0, 0, 1, 1, 1, 1], dtype=numpy.uint8) * numpy.uint8(labelValue)
+
+    lookupIndex = (self.arrayFromVolume(inputCapsule) > 0.5).view(numpy.uint8)
+    lookupIndex |= (self.arrayFromVolume(inputCG) > 0.5).view(numpy.uint8) << 1
+    lookupIndex |= (self.arrayFromVolume(inputVM) > 0.5).view(numpy.uint8) << 2
+
+    self.updateVolumeFromArray(registerLabel, registrationLookupTable.take(lookupIndex), inputCapsule)
+
   def ImageLabelCombine(self, inputLabelA, inputLabelB, outputLabel):
     """ Combines labelmaps with label A overwriting label B if any overlapping area
     """
@@ -507,9 +1722,16 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Combining Labels...'),
     start_time = time.time()
 
-    # Run the slicer module in CLI
-    cliParams = {'InputLabelMap_A': inputLabelA.GetID(),'InputLabelMap_B': inputLabelB.GetID(), 'OutputLabelMap': outputLabel.GetID()} 
-    cliNode = slicer.cli.run(slicer.modules.imagelabelcombine, None, cliParams, wait_for_completion=True)
+    if self.canUseLabelEngine(inputLabelA, inputLabelB):
+        # Nonzero values of label A overwrite label B
+        labelArrayA = self.arrayFromVolume(inputLabelA)
+        labelArrayB = self.arrayFromVolume(inputLabelB)
+        combinedArray = numpy.where(labelArrayA != 0, labelArrayA, labelArrayB).astype(labelArrayA.dtype)
+        self.updateVolumeFromArray(outputLabel, combinedArray, inputLabelA)
+    else:
+        # Run the slicer module in CLI
+        cliParams = {'InputLabelMap_A': inputLabelA.GetID(),'InputLabelMap_B': inputLabelB.GetID(), 'OutputLabelMap': outputLabel.GetID()} 
+        cliNode = slicer.cli.run(slicer.modules.imagelabelcombine, None, cliParams, wait_for_completion=True)
     
     # print to Slicer CLI
     end_time = time.time()
@@ -522,9 +1744,15 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Thresholding Label Value...'),
     start_time = time.time()
 
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': thresholdVal, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    if self.canUseLabelEngine(inputVolume):
+        # Set all values above the threshold to the new label value in place
+        labelArray = self.arrayFromVolume(inputVolume)
+        labelArray[labelArray > thresholdVal] = newLabelVal
+        self.arrayFromVolumeModified(inputVolume)
+    else:
+        # Run the slicer module in CLI
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': thresholdVal, 'OutsideValue': newLabelVal} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
     
     # print to Slicer CLI
     end_time = time.time()
@@ -536,18 +1764,197 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Thresholding Label Value...'),
     start_time = time.time()
 
-    # Turn zero values into 3
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': 3, 'Negate': True} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    if self.canUseLabelEngine(inputVolume):
+        # Turn zero values into 3 and values above 5 into 0 (masks taken before either change)
+        labelArray = self.arrayFromVolume(inputVolume)
+        zeroMask = labelArray <= 0.5
+        aboveMask = labelArray > 5
+        labelArray[zeroMask] = 3
+        labelArray[aboveMask] = 0
+        self.arrayFromVolumeModified(inputVolume)
+    else:
+        # Turn zero values into 3
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': 3, 'Negate': True} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
 
-    # Turn values of above 5 into 0
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 5, 'OutsideValue': 0} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+        # Turn values of above 5 into 0
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 5, 'OutsideValue': 0} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
     
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
+  def NodeKey(self, node):
+    """ Returns the content key of a node: the key set when it was loaded or produced by a stage, otherwise a hash of its data
+    """
+    if node.GetID() in self.nodeKeys:
+      return self.nodeKeys[node.GetID()]
+    contentHash = hashlib.sha1()
+    if node.IsA('vtkMRMLModelNode'):
+      if node.GetPolyData() and node.GetPolyData().GetPoints():
+        contentHash.update(numpy_support.vtk_to_numpy(node.GetPolyData().GetPoints().GetData()).tostring())
+    elif self.hasImageData(node):
+      ijkToRAS = vtk.vtkMatrix4x4()
+      node.GetIJKToRASMatrix(ijkToRAS)
+      contentHash.update(str([ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)]))
+      contentHash.update(self.arrayFromVolume(node).tostring())
+    return contentHash.hexdigest()
+
+  def SetFileKeys(self, *inputNodes):
+    """ Sets the content key of loaded input nodes to the hash of the file they were loaded from
+    """
+    keyStore = self.stageCache or (self.checkpoint.stages if self.checkpoint else None)
+    if not keyStore:
+      return
+    for inputNode in inputNodes:
+      storageNode = inputNode.GetStorageNode()
+      if storageNode and storageNode.GetFileName() and os.path.isfile(storageNode.GetFileName()):
+        self.nodeKeys[inputNode.GetID()] = keyStore.fileKey(storageNode.GetFileName())
+
+  def writeStageEntry(self, entryPath, outputNodes, returnedNode):
+    """ Writes stage output volumes (compressed arrays with IJK to RAS matrix) and models (binary VTK) into a cache entry directory.
+    Parent transforms are included in the stored geometry, so entries of nodes observing a modality transform load correctly in a new run
+    """
+    entries = []
+    for index, node in enumerate(list(outputNodes) + ([returnedNode] if returnedNode else [])):
+      if node.IsA('vtkMRMLModelNode'):
+        fileName = 'output%i.vtk' % index
+        toWorld = vtk.vtkTransform()
+        toWorld.SetMatrix(self.TransformToWorld(node))
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(node.GetPolyData())
+        transformFilter.SetTransform(toWorld)
+        transformFilter.Update()
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+        writer.SetInputData(transformFilter.GetOutput())
+        writer.SetFileName(os.path.join(entryPath, fileName))
+        writer.Write()
+      else:
+        fileName = 'output%i.npz' % index
+        ijkToRAS = self.WorldIJKToRAS(node)
+        ijkToRASArray = numpy.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+        numpy.savez_compressed(os.path.join(entryPath, fileName), voxels=self.arrayFromVolume(node), ijkToRAS=ijkToRASArray)
+      entries.append({'file': fileName, 'name': node.GetName(), 'returned': node is returnedNode})
+
+    with open(os.path.join(entryPath, 'entry.json'), 'w') as entryFile:
+      json.dump(entries, entryFile)
+
+  def WorldMatrix(self, node):
+    """ Returns the matrix placing a node in the world: IJK to RAS with parent transforms for volumes, the parent transforms for models
+    """
+    return self.TransformToWorld(node) if node.IsA('vtkMRMLModelNode') else self.WorldIJKToRAS(node)
+
+  def writeGeometryEntry(self, entryPath, outputNodes, matricesBefore):
+    """ Writes the change of the world matrices (see WorldMatrix) a geometry only stage made to its output nodes into an entry directory,
+    instead of their voxels or points
+    """
+    entries = []
+    for node, matrixBefore in zip(outputNodes, matricesBefore):
+      inverseBefore = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Invert(matrixBefore, inverseBefore)
+      change = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Multiply4x4(self.WorldMatrix(node), inverseBefore, change)
+      entries.append({'geometry': [change.GetElement(row, column) for row in range(4) for column in range(4)], 'name': node.GetName(), 'returned': False})
+
+    with open(os.path.join(entryPath, 'entry.json'), 'w') as entryFile:
+      json.dump(entries, entryFile)
+
+  def readStageEntry(self, entryPath, outputNodes):
+    """ Loads a cache entry into the output nodes and recreates the returned model node, if the stage returned one.
+    Geometry entries (see writeGeometryEntry) move the output nodes as they are, with the parent transforms baked in
+    """
+    with open(os.path.join(entryPath, 'entry.json'), 'r') as entryFile:
+      entries = json.load(entryFile)
+
+    returnedNode = None
+    for index, entry in enumerate(entries):
+      if 'geometry' in entry:
+        node = outputNodes[index]
+        change = vtk.vtkMatrix4x4()
+        change.DeepCopy(entry['geometry'])
+        worldMatrix = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(change, self.WorldMatrix(node), worldMatrix)
+        node.SetAndObserveTransformNodeID(None)
+        if node.IsA('vtkMRMLModelNode'):
+          toWorld = vtk.vtkTransform()
+          toWorld.SetMatrix(worldMatrix)
+          transformFilter = vtk.vtkTransformPolyDataFilter()
+          transformFilter.SetInputData(node.GetPolyData())
+          transformFilter.SetTransform(toWorld)
+          transformFilter.Update()
+          node.SetAndObservePolyData(transformFilter.GetOutput())
+        else:
+          node.SetIJKToRASMatrix(worldMatrix)
+        continue
+
+      filePath = os.path.join(entryPath, entry['file'])
+      if entry['returned']:
+        returnedNode = slicer.vtkMRMLModelNode()
+        returnedNode.SetName(entry['name'])
+        slicer.mrmlScene.AddNode(returnedNode)
+        displayNode = slicer.vtkMRMLModelDisplayNode()
+        slicer.mrmlScene.AddNode(displayNode)
+        returnedNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+        node = returnedNode
+      else:
+        node = outputNodes[index]
+        node.SetAndObserveTransformNodeID(None) # stored geometry includes the parent transforms
+
+      if filePath.endswith('.vtk'):
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(filePath)
+        reader.Update()
+        node.SetAndObservePolyData(reader.GetOutput())
+      else:
+        stored = numpy.load(filePath)
+        ijkToRASArray = stored['ijkToRAS']
+        ijkToRAS = vtk.vtkMatrix4x4()
+        for row in range(4):
+          for column in range(4):
+            ijkToRAS.SetElement(row, column, ijkToRASArray[row, column])
+        node.SetAndObserveImageData(self.imageDataFromArray(stored['voxels']))
+        node.SetIJKToRASMatrix(ijkToRAS)
+
+    return returnedNode
+
+  def BenchmarkLabelEngine(self, inputLabel, repeats=3):
+    """ Times the label value chain of one modality (label values, registration label and final label value) on copies of an input label with CLI modules and with the in-process label engine
+    """
+    volumesLogic = slicer.modules.volumes.logic()
+    useInProcessLabelEngine = self.useInProcessLabelEngine
+    timings = {}
+    try:
+        for engineName, engineEnabled in (('CLI', False), ('In-process', True)):
+            self.useInProcessLabelEngine = engineEnabled
+            elapsed = 0.0
+            for repeat in range(repeats):
+                # Work on copies so that the input label is untouched
+                benchmarkCapsule = volumesLogic.CloneVolume(inputLabel, inputLabel.GetName()+'-BenchmarkCapsule')
+                benchmarkCG      = volumesLogic.CloneVolume(inputLabel, inputLabel.GetName()+'-BenchmarkCG')
+                benchmarkVM      = volumesLogic.CloneVolume(inputLabel, inputLabel.GetName()+'-BenchmarkVM')
+                benchmarkRegister_Label = self.CreateNewLabelVolume(inputLabel.GetName()+'-BenchmarkRegistration')
+
+                start_time = time.time()
+                self.ThresholdScalarVolume(benchmarkCapsule, 1)
+                self.ThresholdScalarVolume(benchmarkCG,      2)
+                self.ThresholdScalarVolume(benchmarkVM,      3)
+                self.CreateRegistrationLabel(benchmarkCapsule, benchmarkCG, benchmarkVM, benchmarkRegister_Label, 10)
+                elapsed += time.time() - start_time
+
+                self.RemoveNode(benchmarkCapsule, benchmarkCG, benchmarkVM, benchmarkRegister_Label)
+            timings[engineName] = elapsed/repeats
+    finally:
+        self.useInProcessLabelEngine = useInProcessLabelEngine
+
+    # run() makes this chain once for U/S and once for MRI
+    print('Label chain time per modality: CLI %0.2f s, In-process %0.2f s') % (timings['CLI'], timings['In-process'])
+    print('Estimated label time saved per patient: %0.1f s') % (2*(timings['CLI']-timings['In-process']))
+
+    return timings
+
+  @timedStage
   def SaveUSRegistrationInputs(self, PatientNumber, inputARFI,  inputBmode,  inputCC, outputUSCaps_Seg,  outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label):
     """ Saves Ultrasound volumes and labelmaps after preprocessing prior to registration
     """
@@ -555,19 +1962,15 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Saving Ultrasound Results...'),
     start_time = time.time()
 
-    # Define filepath    
-    root = '/luscinia/ProstateStudy/invivo/Patient'
-    inputspath = '/Registration/RegistrationInputs/'
-
     # Save Ultrasound Files
-    slicer.util.saveNode(inputARFI,              (root+PatientNumber+inputspath+'us_ARFI.nii'))
-    slicer.util.saveNode(inputBmode,             (root+PatientNumber+inputspath+'us_Bmode.nii'))
-    slicer.util.saveNode(inputCC,                (root+PatientNumber+inputspath+'us_ARFICCMask.nrrd'))
-    slicer.util.saveNode(outputUSCaps_Seg,       (root+PatientNumber+inputspath+'us_cap-label.nrrd'))
-    slicer.util.saveNode(outputUSCG_Seg,         (root+PatientNumber+inputspath+'us_cg-label.nrrd'))
-    slicer.util.saveNode(outputUSVM_Seg,         (root+PatientNumber+inputspath+'us_urethra-label.nrrd'))
-    slicer.util.saveNode(outputUSIndex_Seg,      (root+PatientNumber+inputspath+'us_indexlesion-label.nrrd'))
-    slicer.util.saveNode(outputUSRegister_Label, (root+PatientNumber+inputspath+'us_registration-label.nrrd'))
+    self.SaveRegistrationInputs(PatientNumber, [(inputARFI,              'us_ARFI.nii'),
+                                                (inputBmode,             'us_Bmode.nii'),
+                                                (inputCC,                'us_ARFICCMask.nrrd'),
+                                                (outputUSCaps_Seg,       'us_cap-label.nrrd'),
+                                                (outputUSCG_Seg,         'us_cg-label.nrrd'),
+                                                (outputUSVM_Seg,         'us_urethra-label.nrrd'),
+                                                (outputUSIndex_Seg,      'us_indexlesion-label.nrrd'),
+                                                (outputUSRegister_Label, 'us_registration-label.nrrd')])
 
     # print to Slicer CLI
     end_time = time.time()
@@ -576,6 +1979,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # Return time elapsed
     return float(end_time-start_time)
 
+  @timedStage
   def SaveMRRegistrationInputs(self, PatientNumber, inputT2, outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label):
     """ Saves MRI volumes and labelmaps after preprocessing prior to registration
     """
@@ -583,18 +1987,13 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     print('Saving MRI Results...'),
     start_time = time.time()
 
-    # Define filepath    
-    root = '/luscinia/ProstateStudy/invivo/Patient'
-    inputspath = '/Registration/RegistrationInputs/'
-
     # Save MRI Files
-    slicer.util.saveNode(inputT2,                (root+PatientNumber+inputspath+'mr_T2_AXIAL.nii'))
-    slicer.util.saveNode(outputMRCaps_Seg,       (root+PatientNumber+inputspath+'mr_cap-label.nrrd'))
-    slicer.util.saveNode(outputMRCG_Seg,         (root+PatientNumber+inputspath+'mr_cg-label.nrrd'))
-    slicer.util.saveNode(outputMRVM_Seg,         (root+PatientNumber+inputspath+'mr_urethra-label.nrrd'))
-    slicer.util.saveNode(outputMRIndex_Seg,      (root+PatientNumber+inputspath+'mr_indexlesion-label.nrrd'))
-    slicer.util.saveNode(outputMRRegister_Label, (root+PatientNumber+inputspath+'mr_registration-label.nrrd'))
-
+    self.SaveRegistrationInputs(PatientNumber, [(inputT2,                'mr_T2_AXIAL.nii'),
+                                                (outputMRCaps_Seg,       'mr_cap-label.nrrd'),
+                                                (outputMRCG_Seg,         'mr_cg-label.nrrd'),
+                                                (outputMRVM_Seg,         'mr_urethra-label.nrrd'),
+                                                (outputMRIndex_Seg,      'mr_indexlesion-label.nrrd'),
+                                                (outputMRRegister_Label, 'mr_registration-label.nrrd')])
 
     # print to Slicer CLI
     end_time = time.time()
@@ -603,48 +2002,140 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # Return time elapsed
     return float(end_time-start_time)
 
-  def loadUSInputs(self,PatientNumber):
-    """ Loads Ultrasound inputs from designated location on luscinia to nodes in the scene. If inputs are not present, saves node variable as a string with missing filepath for error output
+  def SaveRegistrationInputs(self, PatientNumber, nodesToSave):
+    """ Saves (node, filename) pairs to the patient RegistrationInputs directory. NRRD files are compressed and written concurrently on a thread pool
+    using the saveCompression mode while the remaining files are saved with slicer.util.saveNode on the main thread. Prints time and bytes written per file
     """
+    inputspath = self.dataRoot+'/invivo/Patient'+PatientNumber+'/Registration/RegistrationInputs/'
+    compressionLevel = self.saveCompressionLevels[self.saveCompression]
+
+    # Saved files hold the geometry after the modality transforms
+    self.HardenTransforms(*[node for node, fileName in nodesToSave])
+
+    # Voxel views and geometry are taken on the main thread, only array compression and file writing happen in the pool
+    nrrdJobs = []
+    otherNodes = []
+    for node, fileName in nodesToSave:
+        if fileName.endswith('.nrrd'):
+            ijkToRAS = vtk.vtkMatrix4x4()
+            node.GetIJKToRASMatrix(ijkToRAS)
+            ijkToRASList = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+            nrrdJobs.append((inputspath+fileName, self.arrayFromVolume(node), ijkToRASList, compressionLevel))
+        else:
+            otherNodes.append((node, fileName))
+
+    def writeJob(nrrdJob):
+        save_start_time = time.time()
+        bytesWritten = self.writeNRRD(*nrrdJob)
+        return os.path.basename(nrrdJob[0]), bytesWritten, time.time()-save_start_time
+
+    pool = ThreadPool(max(1, min(len(nrrdJobs), multiprocessing.cpu_count())))
+    try:
+        asyncResult = pool.map_async(writeJob, nrrdJobs)
+
+        # MRML storage nodes are not thread safe so other formats are saved here in the meantime
+        savedFiles = []
+        for node, fileName in otherNodes:
+            save_start_time = time.time()
+            slicer.util.saveNode(node, inputspath+fileName)
+            bytesWritten = os.path.getsize(inputspath+fileName) if os.path.isfile(inputspath+fileName) else 0
+            savedFiles.append((fileName, bytesWritten, time.time()-save_start_time))
+
+        savedFiles += asyncResult.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    print('')
+    for fileName, bytesWritten, saveTime in savedFiles:
+        print('  %-28s %8.2f MB written  %6.2f s') % (fileName, bytesWritten/1048576.0, saveTime)
+
+  def writeNRRD(self, filePath, voxelArray, ijkToRAS, compressionLevel):
+    """ Writes a (k,j,i) voxel array with an IJK to RAS matrix (nested lists) as an attached NRRD file in LPS space.
+    Compression level 0 writes raw data, otherwise gzip at that level. Returns the number of bytes written (safe to call from worker threads)
+    """
+    nrrdTypes = {'uint8': 'unsigned char', 'int8': 'signed char', 'uint16': 'unsigned short', 'int16': 'short',
+                 'uint32': 'unsigned int', 'int32': 'int', 'uint64': 'unsigned long long', 'int64': 'long long',
+                 'float32': 'float', 'float64': 'double'}
+    voxelArray = numpy.ascontiguousarray(voxelArray)
+    # '<' and '>' are explicit, '=' (native) and '|' (single byte) are written in the byte order of this machine
+    endian = {'<': 'little', '>': 'big'}.get(voxelArray.dtype.byteorder, sys.byteorder)
+
+    # RAS to LPS: negate the first two components of the directions and origin
+    lps = [-1, -1, 1]
+    directions = ' '.join('(%.17g,%.17g,%.17g)' % tuple(lps[row]*ijkToRAS[row][column] for row in range(3)) for column in range(3))
+    origin = '(%.17g,%.17g,%.17g)' % tuple(lps[row]*ijkToRAS[row][3] for row in range(3))
+
+    header = ['NRRD0004',
+              '# Complete NRRD file format specification at:',
+              '# http://teem.sourceforge.net/nrrd/format.html',
+              'type: %s' % nrrdTypes[voxelArray.dtype.name],
+              'dimension: 3',
+              'space: left-posterior-superior',
+              'sizes: %i %i %i' % (voxelArray.shape[2], voxelArray.shape[1], voxelArray.shape[0]),
+              'space directions: %s' % directions,
+              'kinds: domain domain domain',
+              'endian: %s' % endian,
+              'encoding: %s' % ('gzip' if compressionLevel else 'raw'),
+              'space origin: %s' % origin]
+
+    data = voxelArray.tostring()
+    if compressionLevel:
+        # gzip container so the file can be read by ITK/Teem
+        compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+
+    with open(filePath, 'wb') as nrrdFile:
+        nrrdFile.write(('\n'.join(header) + '\n\n').encode('ascii'))
+        nrrdFile.write(data)
+    return os.path.getsize(filePath)
+
+  # slicer.util loader of each input kind (see PreProcessInputs)
+  inputLoaders = {'volume': 'loadVolume', 'label': 'loadLabelVolume', 'model': 'loadModel'}
+
+  def usInputFiles(self, PatientNumber):
+    """ Returns (full filepath, slicer.util loader) for each Ultrasound input in the order returned by loadUSInputs
+    """
+    return [(filePath, getattr(slicer.util, self.inputLoaders[kind])) for filePath, kind in PreProcessInputs.usInputPaths(PatientNumber, self.dataRoot)]
+
+  def mrInputFiles(self, PatientNumber):
+    """ Returns (full filepath, slicer.util loader) for each MRI input in the order returned by loadMRInputs
+    """
+    return [(filePath, getattr(slicer.util, self.inputLoaders[kind])) for filePath, kind in PreProcessInputs.mrInputPaths(PatientNumber, self.dataRoot)]
 
+  @timedStage
+  def PreflightCheck(self, *PatientNumbers):
+    """ Checks with os.stat that every expected input file of each patient exists (and is not empty) before anything is loaded.
+    Prints file sizes and missing inputs and returns {PatientNumber: [missing filepaths]}
+    """
     # Print to Slicer CLI
-    print('Loading Ultrasound Inputs...'),
+    print('Checking input files...'),
     start_time = time.time()
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/ARFI_Norm_HistEq.nii.gz'):
-        inputARFI = slicer.util.getNode('ARFI_Norm_HistEq')
-    else:
-        inputARFI = '/invivo/Patient'+PatientNumber+'/slicer/ARFI_Norm_HistEq.nii.gz'
+    missingInputs, fileSizes = PreProcessInputs.checkInputFiles(PatientNumbers, self.dataRoot)
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/Bmode.nii.gz'):
-        inputBmode = slicer.util.getNode('Bmode')
-    else: 
-        inputBmode = '/invivo/Patient'+PatientNumber+'/slicer/Bmode.nii.gz'
+    # print to Slicer CLI
+    end_time = time.time()
+    print('done (%0.3f s)') % float(end_time-start_time)
 
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/ARFI_CC_Mask.nii.gz'):
-        inputCC = slicer.util.getNode('ARFI_CC_Mask')
-    else:
-        inputCC = '/invivo/Patient'+PatientNumber+'/slicer/ARFI_CC_Mask.nii.gz'
+    for PatientNumber, filePath, fileSize in fileSizes:
+        if fileSize:
+            print('  Patient %s: %8.1f MB  %s') % (PatientNumber, fileSize/1048576.0, filePath[len(self.dataRoot):])
+        else:
+            print('  Patient %s: %s  %s') % (PatientNumber, 'missing' if fileSize is None else '  empty', filePath[len(self.dataRoot):])
 
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_cap.vtk'):
-        inputUSCaps_Model = slicer.util.getNode('us_cap')
-    else:
-        inputUSCaps_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_cap.vtk'
+    return missingInputs
 
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_cg.vtk'):
-        inputUSCG_Model = slicer.util.getNode('us_cg')
-    else:
-        inputUSCG_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_cg.vtk'
+  @timedStage
+  def loadUSInputs(self,PatientNumber):
+    """ Loads Ultrasound inputs from designated location on luscinia to nodes in the scene. If inputs are not present, saves node variable as a string with missing filepath for error output
+    """
 
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_urethra.vtk'):
-        inputUSVM_Model = slicer.util.getNode('us_urethra')
-    else:
-        inputUSVM_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_urethra.vtk'
+    # Print to Slicer CLI
+    print('Loading Ultrasound Inputs...'),
+    start_time = time.time()
 
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_lesion1.vtk'):
-        inputUSIndex_Model = slicer.util.getNode('us_lesion1')
-    else:
-        inputUSIndex_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_lesion1.vtk'
+    inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model = self.loadInputFiles(self.usInputFiles(PatientNumber))
 
     # print to Slicer CLI
     end_time = time.time()
@@ -652,45 +2143,78 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
     return inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model
 
+  @timedStage
   def loadMRInputs(self,PatientNumber):
-    """ Loads Ultrasound inputs from designated location on luscinia to nodes in the scene
+    """ Loads MRI inputs from designated location on luscinia to nodes in the scene. If inputs are not present, saves node variable as a string with missing filepath for error output
     """
 
     # Print to Slicer CLI
     print('Loading MRI Inputs...'),
     start_time = time.time()
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/T2/P'+PatientNumber+'_no_PHI.nii.gz'):
-        inputT2 = slicer.util.getNode('P'+PatientNumber+'_no_PHI')
-    else:
-        inputT2 = '/invivo/Patient'+PatientNumber+'/MRI_Images/T2/P'+PatientNumber+'_no_PHI.nii.gz'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/P'+PatientNumber+'_segmentation_final.nrrd'):
-        inputMRCaps_Seg = slicer.util.getNode('P'+PatientNumber+'_segmentation_final')
-    else:
-        inputMRCaps_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/P'+PatientNumber+'_segmentation_final.nrrd'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_zones_seg.nii.gz'):
-        inputMRZones_Seg = slicer.util.getNode('P'+PatientNumber+'_zones_seg')
-    else:
-        inputMRZones_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_zones_seg.nii.gz'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_urethra_seg.nrrd'):
-        inputMRVM_Seg = slicer.util.getNode('P'+PatientNumber+'_urethra_seg')
-    else:
-        inputMRVM_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_urethra_seg.nrrd'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Cancer/P'+PatientNumber+'_lesion1_seg.nrrd'):
-        inputMRIndex_Seg = slicer.util.getNode('P'+PatientNumber+'_lesion1_seg')
-    else:
-        inputMRIndex_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Cancer/P'+PatientNumber+'_lesion1_seg.nrrd'
+    inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg = self.loadInputFiles(self.mrInputFiles(PatientNumber))
 
     # print to Slicer CLI
     end_time = time.time()
     print('done (%0.2f s)') % float(end_time-start_time)
 
     return inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg
-  
+
+  def loadInputFiles(self, inputFiles):
+    """ Prefetches (filepath, loader) inputs concurrently and then creates their nodes on the main thread.
+    Returns the loaded nodes, with a string of the missing filepath in place of any input that could not be loaded
+    """
+    prefetched = self.PrefetchInputFiles([filePath for filePath, loader in inputFiles])
+
+    # MRML nodes can only be created on the main thread
+    inputNodes = []
+    timings = []
+    for filePath, loader in inputFiles:
+        bytesRead, readTime = prefetched[filePath]
+        parse_start_time = time.time()
+        loaded, inputNode = loader(filePath, returnNode=True)
+        if loaded:
+            inputNodes.append(inputNode)
+        else:
+            inputNodes.append(filePath[len(self.dataRoot):])
+        timings.append((os.path.basename(filePath), bytesRead, readTime, time.time()-parse_start_time))
+
+    # Separate I/O time from parse time for each file
+    print('')
+    for fileName, bytesRead, readTime, parseTime in timings:
+        print('  %-32s %8.1f MB read  %6.2f s I/O  %6.2f s parse') % (fileName, bytesRead/1048576.0, readTime, parseTime)
+
+    return inputNodes
+
+  def PrefetchInputFiles(self, filePaths, maxThreads=12, chunkSize=8*1048576):
+    """ Reads input files concurrently on a thread pool so that Slicer's serial reads are served from the page cache.
+    Nothing is written; the bytes are discarded chunk by chunk. Returns {filepath: (bytes read, read time)}
+    """
+    def prefetch(filePath):
+        if not os.path.isfile(filePath):
+            return filePath, (0, 0.0)
+        try:
+            read_start_time = time.time()
+            bytesRead = 0
+            with open(filePath, 'rb') as inputFile:
+                chunk = inputFile.read(chunkSize)
+                while chunk:
+                    bytesRead += len(chunk)
+                    chunk = inputFile.read(chunkSize)
+            return filePath, (bytesRead, time.time()-read_start_time)
+        except (IOError, OSError) as prefetchError:
+            # Slicer still reads the original file
+            logging.warning('PrefetchInputFiles: could not prefetch %s (%s)' % (filePath, prefetchError))
+            return filePath, (0, 0.0)
+
+    pool = ThreadPool(max(1, min(maxThreads, len(filePaths))))
+    try:
+        prefetched = dict(pool.map(prefetch, filePaths))
+    finally:
+        pool.close()
+        pool.join()
+    return prefetched
+
   def CreateNewLabelVolume(self,name):
     """ Creates a new labelmap volume with the inputted name
     """
@@ -710,6 +2234,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
     return labelNode
 
+  @timedStage
   def createUSOutputs(self):
     """ Preallocates output labelmaps with correct names for US
     """
@@ -730,6 +2255,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
     return outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label
 
+  @timedStage
   def createMROutputs(self):
     """ Preallocates output labelmaps with correct names for MR
     """
@@ -767,6 +2293,22 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
 
   def run(self, PatientNumber, SaveDataBool):
+    """ Runs preprocessing for one patient with a stage trace written to traceDirectory, intermediate nodes freed after use and,
+    with a checkpointDirectory, completed stages checkpointed (or reloaded when resuming) (see runPatient)
+    """
+    trace = StageTrace('PreProcess', PatientNumber, self.traceDirectory).start()
+    self.intermediates.start()
+    if self.checkpointDirectory:
+        self.checkpoint = RunCheckpoint(self.checkpointDirectory, 'PreProcess', PatientNumber, self.resume)
+    try:
+        return self.runPatient(PatientNumber, SaveDataBool)
+    finally:
+        self.checkpoint = None
+        self.intermediates.finish()
+        trace.finish()
+
+  @timedStage
+  def runPatient(self, PatientNumber, SaveDataBool):
   #"""
   #      inputARFI,   inputBmode,  inputCC,  inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model,  inputUSIndex_Model,
   #                                          outputUSCaps_Seg,  outputUSCG_Seg,  outputUSVM_Seg,   outputUSIndex_Seg,  outputUSRegister_Label,
@@ -781,6 +2323,11 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     start_time_overall = time.time() # start timer
     print('Expected Algorithm Time: 270 seconds') # based on previous trials of the algorithm
 
+    # Check that every input file exists before any volume is loaded or output node created
+    if self.PreflightCheck(PatientNumber)[PatientNumber]:
+        print "Exiting process. Not all inputs supplied."
+        return
+
     # Load Ultrasound Inputs
     inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model = self.loadUSInputs(PatientNumber)
 
@@ -799,78 +2346,106 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
         print "Exiting process. Not all inputs supplied."
         return
     
-    # Center all of the volume inputs
-    self.CenterVolume(inputARFI, inputBmode, inputCC, inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg, inputMRIndex_Seg)
-
-    # # Transform all US inputs using inversion transform
-    self.US_transform(inputARFI,   inputBmode,  inputCC,  inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model,  inputUSIndex_Model)
+    # One composed transform per modality for this patient
+    self.modalityTransforms = {}
+
+    # Key the loaded inputs by file content so unchanged stages can be reused from the stage cache
+    self.SetFileKeys(inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model, 
+                     inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg)
+
+    # The stages below are declared as a graph with the nodes each one reads and writes. The US and MR chains only meet where a stage reads
+    # nodes of both, so CLI stages of one chain run in the background while the other chain continues, and with a stage cache only the
+    # stages downstream of a changed input file or parameter are rerun
+    usVolumes = [inputARFI, inputBmode, inputCC]
+    usModels  = [inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model]
+    usInputs  = usVolumes + usModels
+    mrVolumes = [inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg]
+    graph = StageGraph(self)
+    smoothingModule = slicer.modules.segmentationsmoothing
+    modelToLabelModule = None if self.useNativeVoxelizer else slicer.modules.modeltolabelmap
+
+    # US chain: center the volumes and transform all US inputs using inversion transform
+    graph.add('CenterVolume', self.CenterVolume, usVolumes, usVolumes, usVolumes, cached=False, geometryOnly=True)
+    graph.add('US_transform', self.US_transform, usInputs, usInputs, usInputs, cached=False, geometryOnly=True)
+
+    # MR chain: center the volumes and smooth MR Final Segmentation to turn into single labelmap of capsule
+    graph.add('CenterVolume', self.CenterVolume, mrVolumes, mrVolumes, mrVolumes, cached=False, geometryOnly=True)
+    graph.add('SegmentationSmoothing', self.SegmentationSmoothing, [inputMRCaps_Seg, inputMRCaps_Seg], [inputMRCaps_Seg], [inputMRCaps_Seg], {'labelNumber': None},
+              cliModule=smoothingModule, cliParameters=self.SegmentationSmoothingParameters)
+
+    # Transform MRI inputs to match Ultrasound so that MR capsule fits in US volume prior to registration
+    if self.mrAlignment == 'model':
+        # Make Model of MRI input capsule segmentation using Model Maker Module for MRI translation coordinates
+        intermediateMRCaps_Model = graph.add('MRCapModelMaker', self.MRCapModelMaker, [inputMRCaps_Seg], [inputMRCaps_Seg], [], {'inProcessMesher': self.useInProcessMesher},
+                                             returns='intermediateMRCaps_Model')
+        graph.add('MR_translate', self.MR_translate, [intermediateMRCaps_Model, inputUSCaps_Model] + mrVolumes, [intermediateMRCaps_Model, inputUSCaps_Model] + mrVolumes, mrVolumes,
+                  cached=False, geometryOnly=True)
+    else:
+        # Bounds or centroid of the capsule label voxels, no MR capsule model needed
+        graph.add('MR_translate', self.MR_translateFromLabel, [inputMRCaps_Seg, inputUSCaps_Model] + mrVolumes, [inputUSCaps_Model] + mrVolumes, mrVolumes,
+                  {'alignment': self.mrAlignment}, cached=False, geometryOnly=True)
 
-    # Smooth MR Final Segmentation to turn into single labelmap of capsule
-    self.SegmentationSmoothing(inputMRCaps_Seg, inputMRCaps_Seg)
-    
-    # Make Model of MRI input capsule segmentation using Model Maker Module for MRI translation coordinates
-    intermediateMRCaps_Model = self.MRCapModelMaker(inputMRCaps_Seg)
+    # Volume consumers from here on (CLI modules, resampling, cache entries) read the stored geometry, so the composed US and MR transforms
+    # are baked into the volumes now, which only changes their IJK to RAS matrices. US models stay observed, the voxelizer composes their transform
+    graph.add('HardenTransforms', self.HardenTransforms, usVolumes, usVolumes, usVolumes, cached=False, geometryOnly=True)
+    graph.add('HardenTransforms', self.HardenTransforms, mrVolumes, mrVolumes, mrVolumes, cached=False, geometryOnly=True)
 
-    # # Transform MRI inputs to match Ultrasound so that MR capsule fits in US volume prior to registration
-    self.MR_translate(intermediateMRCaps_Model, inputUSCaps_Model, inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg) # add more MRI inputs to the function
+    # The modeltolabelmap CLI reads the model points as stored, so with the CLI the US models observing the US transform are hardened too
+    if modelToLabelModule:
+        graph.add('HardenTransforms', self.HardenTransforms, usModels, usModels, usModels, cached=False, geometryOnly=True)
 
-    # Make models of MRI index lesion and veramontanum
-    inputMRIndex_Model = self.MRModelMaker(inputMRIndex_Seg, 20) # smooth 20
-    inputMRVM_Model    = self.MRModelMaker(inputMRVM_Seg,    30) # smooth 30
+    # Make models of MRI index lesion and veramontanum (model maker also changes the input label value)
+    inputMRIndex_Model = graph.add('MRModelMaker', self.MRModelMaker, [inputMRIndex_Seg, 20], [inputMRIndex_Seg], [inputMRIndex_Seg], # smooth 20
+                                   {'smoothing': 20, 'inProcessMesher': self.useInProcessMesher}, returns='inputMRIndex_Model')
+    inputMRVM_Model    = graph.add('MRModelMaker', self.MRModelMaker, [inputMRVM_Seg, 30],    [inputMRVM_Seg],    [inputMRVM_Seg], # smooth 30
+                                   {'smoothing': 30, 'inProcessMesher': self.useInProcessMesher}, returns='inputMRVM_Model')
 
     # Convert US Capsule and CG models to labelmap on T2 volume (use T2 for faster conversion since larger image spacing)
-    self.ModelToLabelMap(inputT2, inputUSCaps_Model, outputUSCaps_Seg, 0.25)
-    self.ModelToLabelMap(inputT2, inputUSCG_Model, outputUSCG_Seg, 0.25)
-
-    # Use Segmentation Smoothing Module on US and MRI Capsule and US CG labels
-    self.SegmentationSmoothing(outputUSCaps_Seg, outputUSCaps_Seg) # (inputVolume, outputVolume)
-    self.SegmentationSmoothing(outputUSCG_Seg,   outputUSCG_Seg) # define input and output as same volume to keep segmentation applied to output
-    self.SegmentationSmoothing(inputMRCaps_Seg,  outputMRCaps_Seg)
-
-    # Use Segmentation Smoothing on MRI zones seg to pick out and smooth only central gland values
-    self.SegmentationSmoothing(inputMRZones_Seg, outputMRCG_Seg, 9) # label value 9
+    modelToLabelParameters = {'sampleDistance': 0.25, 'nativeVoxelizer': self.useNativeVoxelizer}
+    for inputModel, outputLabel in ((inputUSCaps_Model, outputUSCaps_Seg), (inputUSCG_Model, outputUSCG_Seg)):
+        graph.add('ModelToLabelMap', self.ModelToLabelMap, [inputT2, inputModel, outputLabel, 0.25], [inputT2, inputModel], [outputLabel], modelToLabelParameters,
+                  cliModule=modelToLabelModule, cliParameters=self.ModelToLabelMapParameters)
+
+    # Use Segmentation Smoothing Module on US and MRI Capsule and US CG labels, and on MRI zones seg to pick out and smooth only central gland values
+    # (define input and output as same volume to keep segmentation applied to output). The four smoothings are independent so they run at the same time
+    for inputLabel, outputLabel, labelNumber in ((outputUSCaps_Seg, outputUSCaps_Seg, None), (outputUSCG_Seg, outputUSCG_Seg, None),
+                                                 (inputMRCaps_Seg, outputMRCaps_Seg, None), (inputMRZones_Seg, outputMRCG_Seg, 9)): # label value 9
+        graph.add('SegmentationSmoothing', self.SegmentationSmoothing, [inputLabel, outputLabel] + ([labelNumber] if labelNumber else []), [inputLabel], [outputLabel],
+                  {'labelNumber': labelNumber}, cliModule=smoothingModule, cliParameters=self.SegmentationSmoothingParameters)
 
     # Resample all segmentations and volumes to match ARFI spacing, size, orientation, origin
-    self.ResampleVolumefromReference(inputARFI, outputUSCaps_Seg, outputUSCG_Seg, outputMRCaps_Seg, outputMRCG_Seg, inputT2)
+    resampledVolumes = [outputUSCaps_Seg, outputUSCG_Seg, outputMRCaps_Seg, outputMRCG_Seg, inputT2]
+    graph.add('ResampleVolumefromReference', self.ResampleVolumefromReference, [inputARFI] + resampledVolumes, [inputARFI] + resampledVolumes, resampledVolumes,
+              {'inProcessResampler': self.useInProcessResampler})
 
     # Additional smoothing of output labelmaps in label map smoothing module using sigma = 3 (SlicerProstate manuscript)
-    self.LabelMapSmoothing(outputUSCaps_Seg, 1) #(input/output volume, sigma for gaussian smoothing, [label to smooth-optional])
-    self.LabelMapSmoothing(outputUSCG_Seg,   1)
-    self.LabelMapSmoothing(outputMRCaps_Seg, 1)
-    self.LabelMapSmoothing(outputMRCG_Seg,   1)
-
-    # Model to labelmap for veramontanum models (** LONG STEP **)
-    self.ModelToLabelMap(inputARFI, inputUSVM_Model, outputUSVM_Seg, 0.1)
-    self.ModelToLabelMap(inputARFI, inputMRVM_Model, outputMRVM_Seg, 0.1)
+    smoothedLabels = [outputUSCaps_Seg, outputUSCG_Seg, outputMRCaps_Seg, outputMRCG_Seg]
+    graph.add('BatchLabelMapSmoothing', self.BatchLabelMapSmoothing, [1] + smoothedLabels, smoothedLabels, smoothedLabels, # (sigma for gaussian smoothing, input/output volumes)
+              {'sigma': 1, 'inProcess': self.useInProcessSmoothing})
 
-    # Model to labelmap for tumor models for ARFI and MRI (** LONG STEP **)
-    self.ModelToLabelMap(inputARFI, inputUSIndex_Model, outputUSIndex_Seg, 0.1)
-    self.ModelToLabelMap(inputARFI, inputMRIndex_Model, outputMRIndex_Seg, 0.1)
+    # Model to labelmap for veramontanum and tumor models for ARFI and MRI (** LONG STEP **)
+    # The four conversions are independent so they run at the same time (MR models are freed once converted)
+    modelToLabelParameters = {'sampleDistance': 0.1, 'nativeVoxelizer': self.useNativeVoxelizer}
+    for inputModel, outputLabel in ((inputUSVM_Model, outputUSVM_Seg), (inputMRVM_Model, outputMRVM_Seg), (inputUSIndex_Model, outputUSIndex_Seg), (inputMRIndex_Model, outputMRIndex_Seg)):
+        graph.add('ModelToLabelMap', self.ModelToLabelMap, [inputARFI, inputModel, outputLabel, 0.1], [inputARFI, inputModel], [outputLabel], modelToLabelParameters,
+                  cliModule=modelToLabelModule, cliParameters=self.ModelToLabelMapParameters)
 
     # Change Label Value for MRI registration label
     # self.MRVMLabelValueProcess(outputMRVM_Seg)
     
     ### Change label map values for output labels before saving
-    # For Ultrasound
-    self.ThresholdScalarVolume(outputUSCaps_Seg,  1)  #(input volume, new label value for nonzero pixels) # 1 for Capsule
-    self.ThresholdScalarVolume(outputUSCG_Seg,    2)  # 2 is CG label
-    self.ThresholdScalarVolume(outputUSVM_Seg,    3)  # 3 for VM
-    self.ThresholdScalarVolume(outputUSIndex_Seg, 34) # 34 for index tumor
-    self.ThresholdScalarVolume(inputCC,         255) # 255 for CC Mask label
-
-    # For MRI
-    self.ThresholdScalarVolume(outputMRCaps_Seg,  1)  # 1 for MRI Capsule
-    self.ThresholdScalarVolume(outputMRCG_Seg,    2)  # 2 is CG label
-    self.ThresholdScalarVolume(outputMRVM_Seg,    3)  # 3 for VM
-    self.ThresholdScalarVolume(outputMRIndex_Seg, 34) # 34 for index tumor
-
-    # Create output registration labelmap for MR and US combining Capsule, CG, and VM labelmaps
-    self.CreateRegistrationLabel(outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSRegister_Label) # for ultrasound
-    self.CreateRegistrationLabel(outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRRegister_Label) # for ultrasound
-
-    # Change label value for registration labels
-    self.ThresholdScalarVolume(outputUSRegister_Label, 10) # 10 for registration label
-    self.ThresholdScalarVolume(outputMRRegister_Label, 10) # 10 for registration label
+    # For Ultrasound: 1 for Capsule, 2 is CG label, 3 for VM, 34 for index tumor, 255 for CC Mask label
+    # For MRI: 1 for MRI Capsule, 2 is CG label, 3 for VM, 34 for index tumor
+    for outputLabel, newLabelVal in ((outputUSCaps_Seg, 1), (outputUSCG_Seg, 2), (outputUSVM_Seg, 3), (outputUSIndex_Seg, 34), (inputCC, 255),
+                                     (outputMRCaps_Seg, 1), (outputMRCG_Seg, 2), (outputMRVM_Seg, 3), (outputMRIndex_Seg, 34)):
+        graph.add('ThresholdScalarVolume', self.ThresholdScalarVolume, [outputLabel, newLabelVal], [outputLabel], [outputLabel], {'newLabelVal': newLabelVal}, cached=False)
+
+    # Create output registration labelmap for MR and US combining Capsule, CG, and VM labelmaps (10 for registration label)
+    for registrationLabels in ((outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSRegister_Label), (outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRRegister_Label)):
+        graph.add('CreateRegistrationLabel', self.CreateRegistrationLabel, list(registrationLabels) + [10], registrationLabels[:3], registrationLabels[3:], {'labelValue': 10}, cached=False)
+
+    graph.run(finalNodes=[inputARFI, inputBmode, inputCC, outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label,
+                          inputT2, outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label])
 
     # Save data if user specifies and figure out time required to save data
     if SaveDataBool:
@@ -890,6 +2465,440 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
     return True
 
+#
+# PreProcessStageCache
+#
+
+class PreProcessStageCache(object):
+  """ Content addressed disk cache of PreProcess stage outputs. Entries are keyed by the stage name, its parameters and the content keys of its inputs,
+  and the least recently used entries are evicted once the cache grows larger than maxBytes
+  """
+
+  cacheVersion = 2 # increase when stage outputs change for the same inputs and parameters (2: parent transforms baked into entries)
+
+  def __init__(self, cacheDirectory=None, maxBytes=10*1024**3):
+    if not cacheDirectory:
+      cacheDirectory = os.path.join(slicer.app.temporaryPath, 'PreProcessStageCache')
+    self.cacheDirectory = cacheDirectory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(self.cacheDirectory):
+      try:
+        os.makedirs(self.cacheDirectory)
+      except OSError:
+        pass # created by another worker in the meantime
+
+    # File hashes are remembered by path, size and modification time so unchanged inputs are not read again
+    self.fileKeysPath = os.path.join(self.cacheDirectory, 'fileKeys.json')
+    self.fileKeys = {}
+    if os.path.isfile(self.fileKeysPath):
+      try:
+        with open(self.fileKeysPath, 'r') as fileKeysFile:
+          self.fileKeys = json.load(fileKeysFile)
+      except ValueError:
+        logging.warning('PreProcessStageCache: ignoring unreadable %s' % self.fileKeysPath)
+
+  def fileKey(self, filePath):
+    """ Returns the SHA-1 of a file's content
+    """
+    fileStat = os.stat(filePath)
+    statKey = '%s|%i|%f' % (os.path.abspath(filePath), fileStat.st_size, fileStat.st_mtime)
+    if statKey not in self.fileKeys:
+      fileHash = hashlib.sha1()
+      with open(filePath, 'rb') as inputFile:
+        for chunk in iter(lambda: inputFile.read(1024*1024), b''):
+          fileHash.update(chunk)
+      self.fileKeys[statKey] = fileHash.hexdigest()
+      # Write to a temporary file first so concurrent workers never read a partial file
+      partialPath = '%s.%i' % (self.fileKeysPath, os.getpid())
+      with open(partialPath, 'w') as fileKeysFile:
+        json.dump(self.fileKeys, fileKeysFile)
+      if os.name == 'nt' and os.path.isfile(self.fileKeysPath):
+        os.remove(self.fileKeysPath)
+      os.rename(partialPath, self.fileKeysPath)
+    return self.fileKeys[statKey]
+
+  def stageKey(self, stageName, parameters, inputKeys):
+    """ Returns the cache key of a stage from its name, parameters and input content keys
+    """
+    description = json.dumps([self.cacheVersion, stageName, parameters, inputKeys], sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+  def lookup(self, stageKey):
+    """ Returns the entry directory of a stage key (marking it as recently used) or None if there is no entry
+    """
+    entryPath = os.path.join(self.cacheDirectory, stageKey)
+    if not os.path.isfile(os.path.join(entryPath, 'entry.json')):
+      return None
+    os.utime(entryPath, None)
+    return entryPath
+
+  def beginEntry(self, stageKey):
+    """ Creates a temporary directory for writing the outputs of a stage
+    """
+    partialPath = os.path.join(self.cacheDirectory, '%s.partial.%i' % (stageKey, os.getpid()))
+    if os.path.isdir(partialPath):
+      shutil.rmtree(partialPath)
+    os.makedirs(partialPath)
+    return partialPath
+
+  def commitEntry(self, stageKey, partialPath):
+    """ Moves a completely written entry into place and evicts least recently used entries if the cache is too large
+    """
+    entryPath = os.path.join(self.cacheDirectory, stageKey)
+    if os.path.isdir(entryPath):
+      shutil.rmtree(partialPath) # another run stored the same entry
+    else:
+      os.rename(partialPath, entryPath)
+    self.evict(keepKey=stageKey)
+
+  def evict(self, keepKey=None):
+    """ Removes least recently used entries until the cache is no larger than maxBytes
+    """
+    entries = []
+    totalBytes = 0
+    for entryName in os.listdir(self.cacheDirectory):
+      entryPath = os.path.join(self.cacheDirectory, entryName)
+      if not os.path.isdir(entryPath) or '.partial.' in entryName:
+        continue
+      entryBytes = sum(os.path.getsize(os.path.join(entryPath, fileName)) for fileName in os.listdir(entryPath))
+      entries.append((os.path.getmtime(entryPath), entryName, entryBytes))
+      totalBytes += entryBytes
+
+    for lastUsed, entryName, entryBytes in sorted(entries):
+      if totalBytes <= self.maxBytes:
+        break
+      if entryName == keepKey:
+        continue
+      shutil.rmtree(os.path.join(self.cacheDirectory, entryName))
+      totalBytes -= entryBytes
+
+#
+# RunCheckpoint
+#
+
+class RunCheckpoint(object):
+  """ Per patient checkpoint directory of a run. Completed stages are stored as stage entries (see PreProcessStageCache, never evicted here)
+  and other results (e.g. registration trials) as JSON records, all written to a temporary name first and moved into place, so a crash
+  never leaves a partial checkpoint. Without resume an existing checkpoint of the patient is discarded when the run starts
+  """
+
+  def __init__(self, checkpointDirectory, runName, patient='', resume=False):
+    self.directory = os.path.join(checkpointDirectory, '%s-Patient%s' % (runName, patient))
+    self.resume = resume
+    if not resume and os.path.isdir(self.directory):
+      shutil.rmtree(self.directory)
+    self.stages = PreProcessStageCache(os.path.join(self.directory, 'Stages'), maxBytes=float('inf'))
+    self.recordDirectory = os.path.join(self.directory, 'Records')
+    if not os.path.isdir(self.recordDirectory):
+      os.makedirs(self.recordDirectory)
+
+  def recordPath(self, recordName):
+    return os.path.join(self.recordDirectory, recordName + '.json')
+
+  def writeRecord(self, recordName, record):
+    """ Atomically writes a JSON record
+    """
+    partialPath = '%s.partial.%i' % (self.recordPath(recordName), os.getpid())
+    with open(partialPath, 'w') as recordFile:
+      json.dump(record, recordFile)
+    if os.name == 'nt' and os.path.isfile(self.recordPath(recordName)):
+      os.remove(self.recordPath(recordName))
+    os.rename(partialPath, self.recordPath(recordName))
+
+  def readRecord(self, recordName):
+    """ Returns a JSON record written by an earlier run when resuming, otherwise (or if there is none) None
+    """
+    if not self.resume or not os.path.isfile(self.recordPath(recordName)):
+      return None
+    with open(self.recordPath(recordName), 'r') as recordFile:
+      return json.load(recordFile)
+
+#
+# ProstatePhantom
+#
+
+class ProstatePhantom(object):
+  """ Synthetic prostate for offline tests and benchmarks: nested ellipsoid capsule, central gland (CG) and urethra labels and an index lesion
+  on an ultrasound grid, ARFI, B-mode and T2 like volumes, and "MR" copies of the labels deformed by releasing the probe compression,
+  a smooth bend and a shift. Arrays are (k,j,i) and the volumes are centered at the RAS origin
+  """
+
+  labelValues = (('capsule', 1), ('cg', 2), ('urethra', 3), ('lesion', 34)) # later labels are drawn over earlier ones
+
+  def __init__(self, dimensions=(96,96,64), spacing=(0.5,0.5,0.5), compression=1.12, bend=2.0, shift=(3,-2,1), seed=0):
+    self.dimensions = tuple(dimensions)
+    self.spacing = tuple(spacing)
+    self.origin = tuple(-0.5*(dimension-1)*voxelSize for dimension, voxelSize in zip(self.dimensions, self.spacing))
+    self.random = numpy.random.RandomState(seed)
+
+    # Ellipsoids (center offset and radii as fractions of the grid size); urethra and lesion are clipped to the capsule
+    k, j, i = numpy.indices(self.dimensions[::-1], dtype=numpy.float32)
+    def ellipsoid(offset, radii):
+        return sum(((index - (0.5*(dimension-1) + offset[axis]*dimension))/(radii[axis]*dimension))**2
+                   for axis, (index, dimension) in enumerate(((i, self.dimensions[0]), (j, self.dimensions[1]), (k, self.dimensions[2])))) <= 1.0
+    capsule = ellipsoid((0.0, 0.0, 0.0), (0.32, 0.26, 0.34))
+    self.usMasks = {'capsule': capsule,
+                    'cg':      ellipsoid((0.0, 0.05, 0.03), (0.17, 0.13, 0.2)),
+                    'urethra': ellipsoid((0.0, 0.06, 0.0), (0.03, 0.03, 0.4)) & capsule,
+                    'lesion':  ellipsoid((0.15, -0.12, -0.1), (0.07, 0.07, 0.08)) & capsule}
+
+    # Backward map of the "MR" grid onto the ultrasound grid (nearest neighbour)
+    center = [0.5*(dimension-1) for dimension in self.dimensions]
+    sourceI = i - shift[0]
+    sourceJ = center[1] + (j - shift[1] - center[1])/compression + bend*numpy.sin(numpy.pi*k/self.dimensions[2])
+    sourceK = k - shift[2]
+    self.mrSource = [numpy.rint(source).astype(numpy.intp) for source in (sourceK, sourceJ, sourceI)]
+    self.mrInside = numpy.ones(self.dimensions[::-1], dtype=bool)
+    for source, size in zip(self.mrSource, self.dimensions[::-1]):
+        self.mrInside &= (source >= 0) & (source < size)
+        numpy.clip(source, 0, size-1, out=source)
+    self.mrMasks = dict((name, self.deform(mask)) for name, mask in self.usMasks.items())
+
+  def deform(self, array):
+    """ Returns a (k,j,i) array of the ultrasound grid warped like the "MR" copy (zero where the warp leaves the grid)
+    """
+    return numpy.where(self.mrInside, array[self.mrSource[0], self.mrSource[1], self.mrSource[2]], 0).astype(array.dtype)
+
+  def labelArray(self, masks):
+    """ Returns one uint8 labelmap of the capsule (1), CG (2), urethra (3) and lesion (34) masks
+    """
+    labelArray = numpy.zeros(self.dimensions[::-1], dtype=numpy.uint8)
+    for name, labelValue in self.labelValues:
+        labelArray[masks[name]] = labelValue
+    return labelArray
+
+  def intensityArray(self, masks, intensities, noise):
+    """ Returns a float32 volume with one intensity per structure (and 'background') plus gaussian noise
+    """
+    intensityArray = numpy.empty(self.dimensions[::-1], dtype=numpy.float32)
+    intensityArray[:] = intensities['background']
+    for name, labelValue in self.labelValues:
+        intensityArray[masks[name]] = intensities[name]
+    intensityArray += self.random.normal(0.0, noise, intensityArray.shape).astype(numpy.float32)
+    return intensityArray
+
+  def createVolume(self, name, array, labelmap=False):
+    """ Creates a scalar or labelmap volume node of a (k,j,i) array on the phantom grid
+    """
+    logic = PreProcessLogic()
+    if labelmap:
+        volumeNode = logic.CreateNewLabelVolume(name)
+    else:
+        volumeNode = slicer.vtkMRMLScalarVolumeNode()
+        volumeNode.SetName(name)
+        slicer.mrmlScene.AddNode(volumeNode)
+        displayNode = slicer.vtkMRMLScalarVolumeDisplayNode()
+        slicer.mrmlScene.AddNode(displayNode)
+        displayNode.SetAndObserveColorNodeID(slicer.util.getNode('Grey').GetID())
+        volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+        volumeNode.CreateDefaultStorageNode()
+    volumeNode.SetSpacing(self.spacing)
+    volumeNode.SetOrigin(self.origin)
+    volumeNode.SetAndObserveImageData(logic.imageDataFromArray(array))
+    return volumeNode
+
+  def createModel(self, name, mask):
+    """ Creates a surface model node of a mask (through a temporary labelmap, see PreProcessLogic.LabelToModel)
+    """
+    logic = PreProcessLogic()
+    maskLabel = self.createVolume(name+'-Mask', mask.astype(numpy.uint8), labelmap=True)
+    modelNode = logic.LabelToModel(maskLabel, name, 10, decimate=0.0)
+    logic.RemoveNode(maskLabel)
+    return modelNode
+
+  def createUltrasoundNodes(self):
+    """ Creates the ultrasound inputs of PreProcess: ARFI, B-mode and confidence (CC) mask volumes and capsule, CG, urethra and lesion models
+    """
+    usNodes = {}
+    usNodes['ARFI'] = self.createVolume('ARFI_Norm_HistEq', self.intensityArray(self.usMasks,
+                          {'background': 0.2, 'capsule': 0.45, 'cg': 0.6, 'urethra': 0.5, 'lesion': 0.9}, 0.05))
+    speckle = self.random.rayleigh(1.0, self.dimensions[::-1]).astype(numpy.float32)
+    usNodes['Bmode'] = self.createVolume('Bmode', speckle*self.intensityArray(self.usMasks,
+                          {'background': 60.0, 'capsule': 90.0, 'cg': 70.0, 'urethra': 30.0, 'lesion': 50.0}, 0.0))
+    confidence = numpy.zeros(self.dimensions[::-1], dtype=numpy.uint8)
+    confidence[4:-4, 4:-4, 4:-4] = 1
+    usNodes['CC'] = self.createVolume('ARFI_CC_Mask', confidence, labelmap=True)
+    for name in ('capsule', 'cg', 'urethra', 'lesion'):
+        usNodes[name] = self.createModel('us_'+name, self.usMasks[name])
+    return usNodes
+
+  def createMRNodes(self):
+    """ Creates the MRI inputs of PreProcess from the deformed labels: T2 volume, capsule segmentation, zones (CG has value 9),
+    urethra and lesion labelmaps
+    """
+    mrNodes = {}
+    mrNodes['T2'] = self.createVolume('T2', self.intensityArray(self.mrMasks,
+                        {'background': 100.0, 'capsule': 300.0, 'cg': 180.0, 'urethra': 60.0, 'lesion': 120.0}, 10.0))
+    mrNodes['segmentation'] = self.createVolume('segmentation_final', self.mrMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    zones = numpy.where(self.mrMasks['cg'], 9, numpy.where(self.mrMasks['capsule'], 1, 0)).astype(numpy.uint8)
+    mrNodes['zones'] = self.createVolume('zones_seg', zones, labelmap=True)
+    mrNodes['urethra'] = self.createVolume('urethra_seg', self.mrMasks['urethra'].astype(numpy.uint8), labelmap=True)
+    mrNodes['lesion'] = self.createVolume('lesion1_seg', self.mrMasks['lesion'].astype(numpy.uint8), labelmap=True)
+    return mrNodes
+
+  def writePatient(self, dataRoot, PatientNumber):
+    """ Writes the phantom as the input files of a patient under dataRoot (see PreProcessLogic.usInputFiles and mrInputFiles)
+    and creates its RegistrationInputs directory, so PreProcessLogic.run can process it with dataRoot set
+    """
+    logic = PreProcessLogic()
+    logic.dataRoot = dataRoot
+    usNodes = self.createUltrasoundNodes()
+    mrNodes = self.createMRNodes()
+    nodes = ([usNodes[name] for name in ('ARFI', 'Bmode', 'CC', 'capsule', 'cg', 'urethra', 'lesion')] +
+             [mrNodes[name] for name in ('T2', 'segmentation', 'zones', 'urethra', 'lesion')])
+    inputFiles = logic.usInputFiles(PatientNumber) + logic.mrInputFiles(PatientNumber)
+    for node, (filePath, loader) in zip(nodes, inputFiles):
+        if not os.path.isdir(os.path.dirname(filePath)):
+            os.makedirs(os.path.dirname(filePath))
+        if not slicer.util.saveNode(node, filePath):
+            raise IOError('Could not write phantom input %s' % filePath)
+    inputspath = dataRoot+'/invivo/Patient'+PatientNumber+'/Registration/RegistrationInputs'
+    if not os.path.isdir(inputspath):
+        os.makedirs(inputspath)
+    logic.RemoveNode(*nodes)
+    return [filePath for filePath, loader in inputFiles]
+
+#
+# PhantomBenchmark
+#
+
+class PhantomBenchmark(object):
+  """ Times logic stages (best of repeats, each run as a stage of a StageTrace) and compares them with the baseline stored for this machine.
+  A stage is flagged as a regression when it takes longer than tolerance times its baseline and at least minimumSlowdown seconds more,
+  and a stage without a baseline is flagged too, so a missing or cleared baseline file never passes silently. The baseline file is
+  baselinePath or PHANTOM_BENCHMARK_BASELINE, and is only written when PHANTOM_BENCHMARK_UPDATE=1 (recording the current times)
+  """
+
+  def __init__(self, suiteName, baselinePath=None, repeats=3, tolerance=1.5, minimumSlowdown=0.05):
+    self.suiteName = suiteName
+    self.baselinePath = baselinePath or os.environ.get('PHANTOM_BENCHMARK_BASELINE')
+    self.repeats = repeats
+    self.tolerance = tolerance
+    self.minimumSlowdown = minimumSlowdown
+    self.timings = []
+    self.trace = None
+
+  def start(self, traceDirectory=None):
+    self.trace = StageTrace('Benchmark'+self.suiteName, 'Phantom', traceDirectory).start()
+    return self
+
+  def time(self, caseName, function, *args):
+    """ Calls function(*args) repeats times, records the shortest wall time and returns the result of the last call.
+    The volume and model nodes passed in (or their IDs) and the linear transforms of the scene are restored before each repeat,
+    so stages that change their inputs in place time the same data every time and leave the nodes as after a single call
+    """
+    inputState = self.saveInputs(args)
+    bestTime = None
+    for repeat in range(self.repeats):
+        if repeat:
+            self.restoreInputs(inputState)
+        start_time = time.time()
+        with traceStage(caseName, {'repeat': repeat}):
+            result = function(*args)
+        elapsed = time.time() - start_time
+        bestTime = elapsed if bestTime is None else min(bestTime, elapsed)
+    self.timings.append((caseName, bestTime))
+    return result
+
+  def saveInputs(self, args):
+    """ Returns copies of the data, geometry and parent transform of the volume and model arguments, and the matrices of all linear transforms
+    """
+    nodes = []
+    for arg in args:
+        for value in (arg if isinstance(arg, (list, tuple)) else [arg]):
+            node = slicer.mrmlScene.GetNodeByID(value) if isinstance(value, str) else value
+            if hasattr(node, 'IsA') and (node.IsA('vtkMRMLVolumeNode') or node.IsA('vtkMRMLModelNode')) and node not in nodes:
+                nodes.append(node)
+
+    nodeStates = []
+    for node in nodes:
+        data = node.GetImageData() if node.IsA('vtkMRMLVolumeNode') else node.GetPolyData()
+        dataCopy = None
+        if data:
+            dataCopy = data.NewInstance()
+            dataCopy.DeepCopy(data)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        if node.IsA('vtkMRMLVolumeNode'):
+            node.GetIJKToRASMatrix(ijkToRAS)
+        nodeStates.append((node, dataCopy, ijkToRAS, node.GetTransformNodeID()))
+    return nodeStates, self.transformMatrices()
+
+  def transformMatrices(self):
+    matrices = {}
+    transformNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLLinearTransformNode')
+    for i in range(transformNodes.GetNumberOfItems()):
+        transformNode = transformNodes.GetItemAsObject(i)
+        matrices[transformNode.GetID()] = vtk.vtkMatrix4x4()
+        transformNode.GetMatrixTransformToParent(matrices[transformNode.GetID()])
+    return matrices
+
+  def restoreInputs(self, inputState):
+    """ Puts back the state saved by saveInputs. Transforms created by the previous repeat (e.g. modality transforms) are reset to identity
+    """
+    nodeStates, matrices = inputState
+    for node, dataCopy, ijkToRAS, transformNodeID in nodeStates:
+        data = None
+        if dataCopy:
+            data = dataCopy.NewInstance()
+            data.DeepCopy(dataCopy)
+        if node.IsA('vtkMRMLVolumeNode'):
+            node.SetAndObserveImageData(data)
+            node.SetIJKToRASMatrix(ijkToRAS)
+        else:
+            node.SetAndObservePolyData(data)
+        node.SetAndObserveTransformNodeID(transformNodeID)
+    for transformNodeID in self.transformMatrices():
+        slicer.mrmlScene.GetNodeByID(transformNodeID).SetMatrixTransformToParent(matrices.get(transformNodeID, vtk.vtkMatrix4x4()))
+
+  def finish(self):
+    """ Finishes the trace, prints each stage with its baseline, stores new baselines and returns the regressions as
+    [(stage, baseline seconds or None if there is no baseline, seconds)]
+    """
+    if self.trace:
+        self.trace.finish()
+        self.trace = None
+
+    baseline = {}
+    if self.baselinePath and os.path.isfile(self.baselinePath):
+        with open(self.baselinePath, 'r') as baselineFile:
+            baseline = json.load(baselineFile)
+    elif not self.baselinePath:
+        print('No benchmark baseline file, set PHANTOM_BENCHMARK_BASELINE (and PHANTOM_BENCHMARK_UPDATE=1 to record one)')
+    suiteBaseline = baseline.setdefault(platform.node(), {}).setdefault(self.suiteName, {})
+    updateBaseline = os.environ.get('PHANTOM_BENCHMARK_UPDATE') == '1' and self.baselinePath
+
+    regressions = []
+    baselineChanged = False
+    print('\n%-40s %10s %10s  %s') % (self.suiteName+' stage', 'Time (s)', 'Base (s)', 'Status')
+    for caseName, seconds in self.timings:
+        baselineSeconds = suiteBaseline.get(caseName)
+        if updateBaseline:
+            suiteBaseline[caseName] = seconds
+            baselineChanged = True
+            status = 'new baseline'
+        elif baselineSeconds is None:
+            regressions.append((caseName, None, seconds))
+            print('%-40s %10.3f %10s  %s') % (caseName, seconds, '-', 'NO BASELINE')
+            continue
+        elif seconds > self.tolerance*baselineSeconds and seconds-baselineSeconds > self.minimumSlowdown:
+            regressions.append((caseName, baselineSeconds, seconds))
+            status = 'REGRESSION (%0.1fx)' % (seconds/max(baselineSeconds, 1e-6))
+        else:
+            status = 'ok'
+        print('%-40s %10.3f %10.3f  %s') % (caseName, seconds, suiteBaseline[caseName], status)
+
+    if baselineChanged:
+        # Written to a temporary file first so concurrently finishing suites never read a partial file
+        if not os.path.isdir(os.path.dirname(os.path.abspath(self.baselinePath))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.baselinePath)))
+        partialPath = '%s.partial.%i' % (self.baselinePath, os.getpid())
+        with open(partialPath, 'w') as baselineFile:
+            json.dump(baseline, baselineFile, indent=2, sort_keys=True)
+        if os.name == 'nt' and os.path.isfile(self.baselinePath):
+            os.remove(self.baselinePath)
+        os.rename(partialPath, self.baselinePath)
+    return regressions
+
 class PreProcessTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -907,39 +2916,606 @@ class PreProcessTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_PreProcess1()
+    self.setUp()
+    self.test_PreProcess2()
+    self.setUp()
+    self.test_PreProcess3()
+    self.setUp()
+    self.test_PreProcess4()
+    self.setUp()
+    self.test_PreProcess5()
+    self.setUp()
+    self.test_PreProcess6()
+    self.setUp()
+    self.test_PreProcess7()
+    self.setUp()
+    self.test_PreProcess8()
+    self.setUp()
+    self.test_PreProcess9()
+    self.setUp()
+    self.test_PreProcess10()
+    self.setUp()
+    self.test_PreProcess11()
+    self.setUp()
+    self.test_PreProcess12()
+    self.setUp()
+    self.test_PreProcess13()
 
   def test_PreProcess1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
-    """
-
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    """ Benchmarks the PreProcess logic stages on a synthetic prostate phantom (no downloads), checks their outputs against the phantom
+    and fails if a stage became slower than the stored baseline (see PhantomBenchmark)
+    """
+    self.delayDisplay("Starting the phantom benchmark")
+
+    phantom = ProstatePhantom()
     logic = PreProcessLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    benchmark = PhantomBenchmark('PreProcess').start(tempfile.mkdtemp())
+    usNodes = phantom.createUltrasoundNodes()
+    mrNodes = phantom.createMRNodes()
+    self.assertTrue( logic.hasImageData(usNodes['ARFI']) )
+
+    # Mesh the phantom capsule and voxelize the US capsule model back onto the ARFI grid
+    capsuleMask = phantom.createVolume('capsuleMask', phantom.usMasks['capsule'].astype(numpy.uint8), labelmap=True)
+    benchmark.time('LabelToModel', logic.LabelToModel, capsuleMask, 'capsuleModel', 10)
+    capsuleLabel = logic.CreateNewLabelVolume('capsuleLabel')
+    benchmark.time('VoxelizeModel', logic.VoxelizeModel, usNodes['ARFI'], usNodes['capsule'], capsuleLabel)
+    capsuleArray = logic.arrayFromVolume(capsuleLabel) > 0
+    dice = 2.0*numpy.count_nonzero(capsuleArray & phantom.usMasks['capsule'])/(numpy.count_nonzero(capsuleArray)+numpy.count_nonzero(phantom.usMasks['capsule']))
+    print('Voxelized capsule Dice: %0.3f') % dice
+    self.assertTrue( dice > 0.9 )
+
+    # Align the deformed MR capsule with the US capsule model; the phantom shift is recovered to within a voxel
+    logic.modalityTransforms = {}
+    mrVolumes = [mrNodes[name] for name in ('T2', 'segmentation', 'zones', 'urethra', 'lesion')]
+    benchmark.time('MR_translateFromLabel', logic.MR_translateFromLabel, mrNodes['segmentation'], usNodes['capsule'], *mrVolumes)
+    mrCenter = logic.LabelCentroid(mrNodes['segmentation'])
+    usCenter = logic.LabelCentroid(capsuleLabel)
+    self.assertTrue( abs(mrCenter[0]-usCenter[0]) < max(phantom.spacing) )
+    logic.HardenTransforms(*mrVolumes)
+
+    # Label chain of one modality on the deformed MR labels
+    benchmark.time('ResampleVolumefromReference', logic.ResampleVolumefromReference, usNodes['ARFI'], *mrVolumes[1:])
+    benchmark.time('BatchLabelMapSmoothing', logic.BatchLabelMapSmoothing, 1, mrNodes['segmentation'], mrNodes['lesion'])
+    zonesArray = logic.arrayFromVolume(mrNodes['zones']) # keep only the CG zone like SegmentationSmoothing with label 9
+    zonesArray[zonesArray != 9] = 0
+    logic.arrayFromVolumeModified(mrNodes['zones'])
+    benchmark.time('ThresholdScalarVolume', logic.ThresholdScalarVolume, mrNodes['zones'], 2)
+    logic.ThresholdScalarVolume(mrNodes['urethra'], 3)
+    registerLabel = logic.CreateNewLabelVolume('registration')
+    benchmark.time('CreateRegistrationLabel', logic.CreateRegistrationLabel, mrNodes['segmentation'], mrNodes['zones'], mrNodes['urethra'], registerLabel, 10)
+    self.assertTrue( numpy.count_nonzero(logic.arrayFromVolume(registerLabel)) > 0 )
+
+    saveDirectory = tempfile.mkdtemp()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    registerLabel.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASList = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+    benchmark.time('writeNRRD', logic.writeNRRD, os.path.join(saveDirectory, 'registration-label.nrrd'), logic.arrayFromVolume(registerLabel),
+                   ijkToRASList, logic.saveCompressionLevels[logic.saveCompression])
+
+    # Whole patient run on the phantom written as patient files (needs the SlicerProstate segmentation smoothing module)
+    if hasattr(slicer.modules, 'segmentationsmoothing'):
+        slicer.mrmlScene.Clear(0)
+        phantom.writePatient(saveDirectory, '0')
+        runLogic = PreProcessLogic()
+        runLogic.dataRoot = saveDirectory
+        benchmark.repeats = 1
+        self.assertTrue( benchmark.time('run', runLogic.run, '0', True) )
+        self.assertTrue( os.path.isfile(saveDirectory+'/invivo/Patient0/Registration/RegistrationInputs/us_registration-label.nrrd') )
+
+    regressions = benchmark.finish()
+    shutil.rmtree(saveDirectory)
+    self.assertEqual( regressions, [] )
+    self.delayDisplay('Test passed!')
+
+  def createSyntheticLabel(self, name, center, radii, labelValue, dimensions=(96,96,64), spacing=(0.5,0.5,0.5)):
+    """ Creates a labelmap node containing an ellipsoid (center and radii in voxels) of the inputted label value
+    """
+    k, j, i = numpy.mgrid[0:dimensions[2], 0:dimensions[1], 0:dimensions[0]]
+    inside = ((i-center[0])/float(radii[0]))**2 + ((j-center[1])/float(radii[1]))**2 + ((k-center[2])/float(radii[2]))**2 <= 1.0
+    labelArray = numpy.where(inside, labelValue, 0).astype(numpy.uint8)
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(dimensions)
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[:] = labelArray.ravel()
+
+    labelNode = PreProcessLogic().CreateNewLabelVolume(name)
+    labelNode.SetSpacing(spacing)
+    labelNode.SetAndObserveImageData(imageData)
+    return labelNode
+
+  def labelBoundary(self, labelArray):
+    """ Returns the voxels of a label array that have a 6-neighbour on the other side of the label boundary (inside or outside)
+    """
+    padded = numpy.pad(labelArray > 0, 1, mode='edge')
+    inside = padded[1:-1,1:-1,1:-1]
+    boundary = numpy.zeros(inside.shape, dtype=bool)
+    for neighbour in (padded[2:,1:-1,1:-1], padded[:-2,1:-1,1:-1], padded[1:-1,2:,1:-1], padded[1:-1,:-2,1:-1], padded[1:-1,1:-1,2:], padded[1:-1,1:-1,:-2]):
+        boundary |= neighbour != inside
+    return boundary
+
+  def test_PreProcess2(self):
+    """ Checks that the in-process label engine gives the same labels as the CLI modules and benchmarks both
+    """
+    self.delayDisplay("Starting the label engine test")
+
+    results = {}
+    for engineEnabled in (False, True):
+        logic = PreProcessLogic(useInProcessLabelEngine=engineEnabled)
+        capsule  = self.createSyntheticLabel('capsule',  (48,48,32), (30,24,20), 1)
+        cg       = self.createSyntheticLabel('cg',       (48,52,32), (16,12,12), 9)
+        vm       = self.createSyntheticLabel('vm',       (48,40,32), (4,4,18),   7)
+        register = logic.CreateNewLabelVolume('registration')
+
+        logic.ThresholdScalarVolume(capsule, 1)
+        logic.ThresholdScalarVolume(cg,      2)
+        logic.ThresholdScalarVolume(vm,      3)
+        vmBefore = logic.arrayFromVolume(vm).copy()
+        logic.CreateRegistrationLabel(capsule, cg, vm, register, 10)
+        self.assertTrue( numpy.array_equal(vmBefore, logic.arrayFromVolume(vm)) ) # inputs are left untouched
+        logic.MRVMLabelValueProcess(vm)
+
+        results[engineEnabled] = (logic.arrayFromVolume(register).copy(), logic.arrayFromVolume(vm).copy())
+        slicer.mrmlScene.Clear(0)
+
+    for cliArray, engineArray in zip(results[False], results[True]):
+        self.assertTrue( numpy.array_equal(cliArray, engineArray) )
+
+    # Times are only printed, wall times of a loaded machine do not decide whether the labels are right
+    PreProcessLogic().BenchmarkLabelEngine(self.createSyntheticLabel('benchmark', (48,48,32), (30,24,20), 1))
+    self.delayDisplay('Test passed!')
+
+  def createSyntheticModel(self, name, center, radii):
+    """ Creates a closed ellipsoid model node (center and radii in mm)
+    """
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(1.0)
+    sphere.SetThetaResolution(96)
+    sphere.SetPhiResolution(96)
+    scale = vtk.vtkTransform()
+    scale.Translate(center)
+    scale.Scale(radii)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(sphere.GetOutputPort())
+    transformFilter.SetTransform(scale)
+    transformFilter.Update()
+
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(name)
+    modelNode.SetAndObservePolyData(transformFilter.GetOutput())
+    slicer.mrmlScene.AddNode(modelNode)
+    return modelNode
+
+  def test_PreProcess3(self):
+    """ Validates the stencil voxelizer voxel for voxel against the modeltolabelmap CLI on a synthetic sphere and ellipsoid
+    """
+    self.delayDisplay("Starting the voxelizer test")
+
+    reference = self.createSyntheticLabel('reference', (0,0,0), (1,1,1), 0, spacing=(0.5,0.5,0.8))
+    reference.SetOrigin(-24.0, -24.0, -25.6)
+
+    for name, radii in (('sphere', (10,10,10)), ('ellipsoid', (14,9,7))):
+        model = self.createSyntheticModel(name, (1.3,-2.1,0.7), radii)
+        logic = PreProcessLogic()
+        cliLabel    = logic.CreateNewLabelVolume(name+'-cli')
+        nativeLabel = logic.CreateNewLabelVolume(name+'-native')
+
+        logic.useNativeVoxelizer = False
+        logic.ModelToLabelMap(reference, model, cliLabel, 0.1)
+        logic.useNativeVoxelizer = True
+        logic.ModelToLabelMap(reference, model, nativeLabel, 0.1)
+
+        cliArray = logic.arrayFromVolume(cliLabel)
+        nativeArray = logic.arrayFromVolume(nativeLabel)
+        mismatched = (cliArray > 0) != (nativeArray > 0)
+        print('%s: %i voxels labelled by CLI, %i mismatched voxels') % (name, numpy.count_nonzero(cliArray), numpy.count_nonzero(mismatched))
+
+        # Same grid and label value, and voxel for voxel equal except where a voxel center lies on the model surface, where the
+        # two rasterizers may round differently. Such voxels always have a 6-neighbour on the other side of the CLI label boundary,
+        # and only a few percent of the boundary voxels have their centers that close to the surface
+        self.assertEqual( cliArray.shape, nativeArray.shape )
+        self.assertEqual( set(numpy.unique(nativeArray)), set([0, 10]) )
+        boundary = self.labelBoundary(cliArray)
+        self.assertFalse( numpy.any(mismatched & ~boundary) )
+        self.assertTrue( numpy.count_nonzero(mismatched) <= 0.03*numpy.count_nonzero(boundary) )
+
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess4(self):
+    """ Checks that graph stages and timed stages are written to the Chrome trace and CSV summary with CLI use detected
+    """
+    self.delayDisplay("Starting the stage trace test")
+
+    traceDirectory = tempfile.mkdtemp()
+    capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+    trace = StageTrace('PreProcessTest', '0', traceDirectory).start()
+    for useInProcessLabelEngine, newLabelVal in ((True, 2), (False, 3)):
+        logic = PreProcessLogic(useInProcessLabelEngine=useInProcessLabelEngine)
+        graph = StageGraph(logic)
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [capsule, newLabelVal], [capsule], [capsule], {'newLabelVal': newLabelVal}, cached=False)
+        graph.run()
+    logic.PreflightCheck('0') # a timed stage outside the graph (missing input files are only reported)
+    tracePath, summaryPath = trace.finish()
+    self.assertTrue( StageTrace.active is None )
+
+    with open(tracePath, 'r') as traceFile:
+        events = [event for event in json.load(traceFile)['traceEvents'] if event['ph'] == 'X']
+    self.assertEqual( [event['name'] for event in events], ['ThresholdScalarVolume', 'ThresholdScalarVolume', 'PreflightCheck'] )
+    self.assertEqual( [event['cat'] for event in events], ['in-process', 'CLI', 'in-process'] )
+    self.assertEqual( events[0]['args']['parameters'], {'newLabelVal': 2, 'outputs': ['capsule']} )
+    self.assertEqual( events[2]['args']['parameters'], {'PatientNumbers': ['0']} )
+
+    import csv
+    with open(summaryPath, 'rb') as summaryFile:
+        rows = list(csv.DictReader(summaryFile))
+    self.assertEqual( [row['CLI'] for row in rows], ['False', 'True', 'False'] )
+    shutil.rmtree(traceDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess5(self):
+    """ Compares the SimpleITK shared-grid resampler with the resamplescalarvectordwivolume CLI on a rotated, shifted reference grid
+    """
+    self.delayDisplay("Starting the resampler test")
+
+    # Reference with different spacing, size, origin and orientation (like ARFI after US_transform)
+    reference = self.createSyntheticLabel('reference', (0,0,0), (1,1,1), 0, dimensions=(80,70,60), spacing=(0.6,0.55,0.7))
+    reference.SetOrigin(-20.0, -18.5, 21.0)
+    invert_transform = vtk.vtkMatrix4x4()
+    invert_transform.SetElement(2,2,-1)
+    reference.ApplyTransformMatrix(invert_transform)
+
+    results = {}
+    for inProcess in (False, True):
+        logic = PreProcessLogic(useInProcessResampler=inProcess)
+        label = self.createSyntheticLabel('label', (46,50,30), (28,22,18), 1)
+        label.SetOrigin(-22.0, -25.0, -15.0)
+        k, j, i = numpy.mgrid[0:64, 0:96, 0:96]
+        scalarVolume = slicer.vtkMRMLScalarVolumeNode() # scalar (not label) volume, linear interpolation
+        scalarVolume.SetName('scalar')
+        slicer.mrmlScene.AddNode(scalarVolume)
+        scalarVolume.SetSpacing(0.5, 0.5, 0.5)
+        scalarVolume.SetOrigin(-22.0, -25.0, -15.0)
+        scalarVolume.SetAndObserveImageData(logic.imageDataFromArray((i + 2*j + 3*k).astype(numpy.int16)))
+
+        logic.ResampleVolumefromReference(reference, label, scalarVolume)
+        self.assertEqual( label.GetImageData().GetDimensions(), reference.GetImageData().GetDimensions() )
+        results[inProcess] = (logic.arrayFromVolume(label).copy(), logic.arrayFromVolume(scalarVolume).astype(numpy.float64))
+        slicer.mrmlScene.RemoveNode(label)
+        slicer.mrmlScene.RemoveNode(scalarVolume)
+
+    # Labels: nearest neighbour only differs from the CLI (linear) on the boundary
+    mismatched = numpy.count_nonzero((results[False][0] > 0) != (results[True][0] > 0))
+    print('label: %i voxels labelled by CLI, %i mismatched voxels') % (numpy.count_nonzero(results[False][0]), mismatched)
+    self.assertTrue( mismatched <= 0.02*numpy.count_nonzero(results[False][0]) )
+
+    # Linear interpolation of a ramp: same values up to rounding, except along the edge of the input volume
+    difference = numpy.abs(results[False][1] - results[True][1])
+    self.assertTrue( numpy.count_nonzero(difference > 1) <= 0.01*difference.size )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess6(self):
+    """ Compares batched in-process label smoothing with the labelmapsmoothing CLI and checks a multi-label volume keeps all its labels
+    """
+    self.delayDisplay("Starting the batched smoothing test")
+
+    results = {}
+    for inProcess in (False, True):
+        logic = PreProcessLogic(useInProcessSmoothing=inProcess)
+        capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+        lesion  = self.createSyntheticLabel('lesion',  (40,56,30), (6,5,4),    34)
+        logic.BatchLabelMapSmoothing(1, capsule, lesion)
+        results[inProcess] = (logic.arrayFromVolume(capsule).copy(), logic.arrayFromVolume(lesion).copy())
+        slicer.mrmlScene.Clear(0)
+
+    # Same filters as the CLI, so the labels only differ where the smoothed level set is within rounding of zero, on the label boundary
+    for cliArray, batchArray in zip(results[False], results[True]):
+        mismatched = (cliArray > 0) != (batchArray > 0)
+        print('smoothing: %i voxels labelled by CLI, %i mismatched voxels') % (numpy.count_nonzero(cliArray), numpy.count_nonzero(mismatched))
+        self.assertEqual( set(numpy.unique(batchArray)), set(numpy.unique(cliArray)) )
+        self.assertFalse( numpy.any(mismatched & ~self.labelBoundary(cliArray)) )
+        self.assertTrue( numpy.count_nonzero(mismatched) <= 0.001*numpy.count_nonzero(cliArray) )
+
+    # One multi-label volume: both labels survive and voxels far from them stay empty
+    logic = PreProcessLogic()
+    multiLabel = self.createSyntheticLabel('multiLabel', (30,48,32), (12,12,12), 1)
+    logic.arrayFromVolume(multiLabel)[:] += logic.arrayFromVolume(self.createSyntheticLabel('second', (70,48,32), (10,10,10), 2))
+    logic.BatchLabelMapSmoothing(1, multiLabel)
+    smoothedArray = logic.arrayFromVolume(multiLabel)
+    self.assertEqual( set(numpy.unique(smoothedArray)), set([0, 1, 2]) )
+    self.assertEqual( smoothedArray[32,48,30], 1 )
+    self.assertEqual( smoothedArray[32,48,70], 2 )
+    self.assertEqual( smoothedArray[0,0,0], 0 )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess7(self):
+    """ Compares the in-process mesher with ModelMaker (surface bounds and enclosed volume) for the capsule and lesion models.
+    The run times of both are recorded with PhantomBenchmark but not asserted
+    """
+    self.delayDisplay("Starting the mesher test")
+
+    traceDirectory = tempfile.mkdtemp()
+    benchmark = PhantomBenchmark('PreProcessMesher').start(traceDirectory)
+    models = {}
+    for inProcess in (False, True):
+        logic = PreProcessLogic(useInProcessMesher=inProcess)
+        capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+        lesion  = self.createSyntheticLabel('lesion',  (40,56,30), (8,6,5),    1)
+        mesherName = 'in-process mesher' if inProcess else 'ModelMaker'
+        capsuleModel = benchmark.time('MRCapModelMaker (%s)' % mesherName, logic.MRCapModelMaker, capsule)
+        lesionModel  = benchmark.time('MRModelMaker (%s)' % mesherName, logic.MRModelMaker, lesion, 20)
+        models[inProcess] = []
+        for modelNode in (capsuleModel, lesionModel):
+            massProperties = vtk.vtkMassProperties()
+            massProperties.SetInputData(modelNode.GetPolyData())
+            massProperties.Update()
+            models[inProcess].append((modelNode.GetPolyData().GetBounds(), massProperties.GetVolume()))
+        slicer.mrmlScene.Clear(0)
+
+    benchmark.finish()
+    shutil.rmtree(traceDirectory)
+    for (modelMakerBounds, modelMakerVolume), (meshBounds, meshVolume) in zip(models[False], models[True]):
+        self.assertTrue( max(abs(a-b) for a, b in zip(modelMakerBounds, meshBounds)) < 1.0 ) # within 2 voxels (0.5 mm spacing)
+        self.assertTrue( abs(meshVolume-modelMakerVolume) < 0.05*modelMakerVolume )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess8(self):
+    """ Checks label voxel bounds and centroid against the capsule mesh and the translation applied by MR_translateFromLabel
+    """
+    self.delayDisplay("Starting the label alignment test")
+
+    logic = PreProcessLogic()
+    capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+    capsule.SetOrigin(-24.0, -24.0, 16.0)
+    capsuleModel = logic.MRCapModelMaker(capsule)
+
+    labelBounds = logic.LabelBounds(capsule)
+    meshBounds = capsuleModel.GetPolyData().GetBounds()
+    self.assertTrue( max(abs(a-b) for a, b in zip(labelBounds, meshBounds)) < 1.0 ) # smoothed mesh is within 2 voxels
+    labelCentroid = logic.LabelCentroid(capsule)
+    self.assertTrue( max(abs(a-b) for a, b in zip(labelCentroid, logic.ModelCentroid(capsuleModel))) < 0.25 )
+
+    # Align the label to a US capsule ellipsoid with known bounds
+    usCapsule = self.createSyntheticModel('usCapsule', (5.0, -3.0, 2.0), (15.0, 12.0, 10.0))
+    for alignment in ('bounds', 'centroid'):
+        logic.mrAlignment = alignment
+        logic.MR_translateFromLabel(capsule, usCapsule, capsule)
+        if alignment == 'bounds':
+            alignedBounds = logic.LabelBounds(capsule)
+            usBounds = usCapsule.GetPolyData().GetBounds()
+            for axis in (0, 2, 5): # right, posterior, base
+                self.assertAlmostEqual( alignedBounds[axis], usBounds[axis], places=3 )
+        else:
+            for a, b in zip(logic.LabelCentroid(capsule), logic.ModelCentroid(usCapsule)):
+                self.assertAlmostEqual( a, b, places=3 )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess9(self):
+    """ Checks that US_transform and MR_translate only compose observed transforms, that a transform the volume already observes is hardened
+    rather than replaced, and that voxelizing an observed model matches the hardened model
+    """
+    self.delayDisplay("Starting the composed transform test")
+
+    logic = PreProcessLogic()
+    volume = self.createSyntheticLabel('volume', (0,0,0), (1,1,1), 0, dimensions=(96,96,64), spacing=(0.5,0.5,0.5))
+    model = self.createSyntheticModel('model', (2.0,-1.0,-6.0), (10,8,6))
+    logic.CenterVolume(volume)
+    ijkToRASBefore = vtk.vtkMatrix4x4()
+    volume.GetIJKToRASMatrix(ijkToRASBefore)
+    pointsBefore = numpy_support.vtk_to_numpy(model.GetPolyData().GetPoints().GetData()).copy()
+
+    logic.US_transform(volume, model)
+    logic.TranslateMRInputs([1.5, 0.0, -2.0], volume) # a second modality transform on the volume
+    logic.US_transform(model) # composed onto the same US transform node
+    self.assertEqual( model.GetTransformNodeID(), logic.modalityTransforms['US'].GetID() )
+    self.assertEqual( volume.GetTransformNodeID(), logic.modalityTransforms['MR'].GetID() )
+
+    # Model points are not rewritten, the US transform is now the flip applied twice (identity)
+    self.assertTrue( numpy.array_equal(pointsBefore, numpy_support.vtk_to_numpy(model.GetPolyData().GetPoints().GetData())) )
+    self.assertEqual( logic.TransformToWorld(model).GetElement(2, 2), 1.0 )
+
+    # The US flip the volume observed was hardened into its geometry before it observed the MR translation, so both still apply
+    flip = vtk.vtkMatrix4x4()
+    flip.SetElement(2, 2, -1)
+    flipped = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(flip, ijkToRASBefore, flipped)
+    ijkToRASAfter = vtk.vtkMatrix4x4()
+    volume.GetIJKToRASMatrix(ijkToRASAfter)
+    self.assertEqual( [flipped.GetElement(r, c) for r in range(4) for c in range(4)], [ijkToRASAfter.GetElement(r, c) for r in range(4) for c in range(4)] )
+    self.assertEqual( logic.TransformToWorld(volume).GetElement(0, 3), 1.5 )
+    self.assertEqual( logic.TransformToWorld(volume).GetElement(2, 2), 1.0 )
+    translated = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(logic.TransformToWorld(volume), flipped, translated)
+    worldIJKToRAS = logic.WorldMatrix(volume)
+    self.assertEqual( [translated.GetElement(r, c) for r in range(4) for c in range(4)], [worldIJKToRAS.GetElement(r, c) for r in range(4) for c in range(4)] )
+
+    observedLabel = logic.CreateNewLabelVolume('observed')
+    hardenedLabel = logic.CreateNewLabelVolume('hardened')
+    logic.VoxelizeModel(volume, model, observedLabel)
+    logic.HardenTransforms(volume, model)
+    logic.VoxelizeModel(volume, model, hardenedLabel)
+    self.assertTrue( numpy.count_nonzero(logic.arrayFromVolume(hardenedLabel)) > 0 )
+    self.assertTrue( numpy.array_equal(logic.arrayFromVolume(observedLabel), logic.arrayFromVolume(hardenedLabel)) )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess10(self):
+    """ Checks that intermediates are freed when their stage finishes, that the memory budget keeps the newest released nodes, and peak memory tracing
+    """
+    self.delayDisplay("Starting the intermediate node test")
+
+    logic = PreProcessLogic()
+    label = self.createSyntheticLabel('label', (48,48,32), (30,24,20), 1)
+    labelBytes = logic.intermediates.nodeMemory(label)
+
+    registry = IntermediateNodes(memoryBudget=int(1.5*labelBytes)).start()
+    trace = StageTrace('PreProcessTest', '0', tempfile.mkdtemp()).start()
+    with traceStage('stage'):
+        stageNode = registry.register(self.createSyntheticLabel('stageNode', (48,48,32), (30,24,20), 1))
+        runNode = self.createSyntheticLabel('runNode', (48,48,32), (30,24,20), 1)
+    self.assertTrue( stageNode.GetScene() ) # within budget, kept for inspection
+    registry.register(runNode)
+    with traceStage('second stage'):
+        registry.register(self.createSyntheticLabel('secondNode', (48,48,32), (30,24,20), 1))
+    self.assertTrue( stageNode.GetScene() is None ) # oldest released node freed once over budget
+    self.assertTrue( runNode.GetScene() ) # run level node is held until the run finishes
+    registry.finish()
+    trace.finish()
+    self.assertTrue( runNode.GetScene() )
+    self.assertTrue( IntermediateNodes.active is None )
+    self.assertTrue( all(record['peakMemory'] > 0 for record in trace.stages) )
+    shutil.rmtree(trace.traceDirectory)
+
+    # The memory track stays bounded on long runs and keeps the peak of the samples it thins out
+    trace = StageTrace('PreProcessTest', '0', tempfile.mkdtemp())
+    stageKey = trace.openStage(0)
+    for sampleNumber in range(10*StageTrace.maxMemorySamples):
+        trace.addMemorySample(trace.start_time+sampleNumber*0.02, 2**40 if sampleNumber == 12345 else sampleNumber % 100)
+    self.assertTrue( len(trace.memorySamples) < StageTrace.maxMemorySamples )
+    self.assertEqual( max(trace.memorySamples), 2**40 )
+    self.assertEqual( trace.closeStage(stageKey), 2**40 )
+    self.assertTrue( trace.peakMemory(trace.start_time+20000*0.02, 0) < 2**40 )
+    shutil.rmtree(trace.traceDirectory)
+
+    # A budget of 0 frees everything as soon as it is released
+    registry = IntermediateNodes().start()
+    registry.register(runNode)
+    registry.finish()
+    self.assertTrue( runNode.GetScene() is None )
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess11(self):
+    """ Checks that graph stages wait for the stages writing their nodes, that unchanged cached stages are only loaded where a later stage
+    needs their outputs, that a changed parameter only reruns the stages downstream of it and that a failed CLI stage is not cached
+    """
+    self.delayDisplay("Starting the stage graph test")
+
+    cacheDirectory = tempfile.mkdtemp()
+    logic = PreProcessLogic(stageCache=PreProcessStageCache(cacheDirectory))
+    capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+    gland = self.createSyntheticLabel('gland', (48,48,32), (15,12,10), 1)
+    combined = self.createSyntheticLabel('combined', (0,0,0), (1,1,1), 0)
+
+    def runGraph(capsuleValue):
+        logic.nodeKeys = {capsule.GetID(): 'capsule', gland.GetID(): 'gland'} # as if loaded from unchanged input files
+        graph = StageGraph(logic)
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [capsule, capsuleValue], [capsule], [capsule], {'newLabelVal': capsuleValue})
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [gland, 2], [gland], [gland], {'newLabelVal': 2})
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [gland, 3], [gland], [gland], {'newLabelVal': 3})
+        graph.add('ImageLabelCombine', logic.ImageLabelCombine, [gland, capsule, combined], [gland, capsule], [combined], cached=False)
+        graph.run(finalNodes=[combined])
+        self.assertEqual( [stage['dependencies'] for stage in graph.stages], [set(), set(), set([1]), set([0, 2])] )
+        return [stage['action'] for stage in graph.stages]
+
+    self.assertEqual( runGraph(4), ['run', 'run', 'run', 'run'] )
+    self.assertEqual( set(numpy.unique(logic.arrayFromVolume(combined))), set([0, 3, 4]) )
+
+    # Nothing changed: the first gland threshold is not even loaded since its output is overwritten by the second one
+    self.assertEqual( runGraph(4), ['load', 'skip', 'load', 'run'] )
+    self.assertEqual( set(numpy.unique(logic.arrayFromVolume(combined))), set([0, 3, 4]) )
+
+    # A changed capsule value only reruns the capsule threshold and the stage reading it
+    self.assertEqual( runGraph(5), ['run', 'skip', 'load', 'run'] )
+    self.assertEqual( set(numpy.unique(logic.arrayFromVolume(combined))), set([0, 3, 5]) )
+
+    # A CLI stage that does not complete raises and leaves nothing in the stage cache
+    graph = StageGraph(logic)
+    graph.add('ThresholdScalarVolume', None, [gland], [gland], [gland], {'newLabelVal': 6}, cliModule=slicer.modules.thresholdscalarvolume,
+              cliParameters=lambda label: {'InputVolume': 'vtkMRMLScalarVolumeNodeMissing', 'OutputVolume': label.GetID(),
+                                           'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': 6})
+    with self.assertRaises(RuntimeError):
+        graph.run()
+    self.assertFalse( logic.stageCache.lookup(graph.stages[0]['key']) )
+    shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess12(self):
+    """ Checks that an interrupted stage graph resumes from its checkpoint, with geometry stages stored as matrices and other uncached stages
+    run again, and that checkpoint records are only read back when resuming
+    """
+    self.delayDisplay("Starting the checkpoint test")
+
+    checkpointDirectory = tempfile.mkdtemp()
+    combined = self.createSyntheticLabel('combined', (0,0,0), (1,1,1), 0)
+
+    def runGraph(resume, interrupted=False):
+        # inputs as loaded from their files at the start of every run
+        capsule = self.createSyntheticLabel('capsule', (48,48,32), (30,24,20), 1)
+        gland = self.createSyntheticLabel('gland', (48,48,32), (15,12,10), 1)
+        logic = PreProcessLogic()
+        logic.checkpoint = RunCheckpoint(checkpointDirectory, 'PreProcessTest', '0', resume)
+        logic.nodeKeys = {capsule.GetID(): 'capsule', gland.GetID(): 'gland'}
+
+        def combine(*labels):
+            if interrupted:
+                raise RuntimeError('interrupted')
+            logic.ImageLabelCombine(*labels)
+
+        graph = StageGraph(logic)
+        graph.add('CenterVolume', logic.CenterVolume, [capsule], [capsule], [capsule], cached=False, geometryOnly=True)
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [capsule, 4], [capsule], [capsule], {'newLabelVal': 4}, cached=False)
+        graph.add('ThresholdScalarVolume', logic.ThresholdScalarVolume, [gland, 3], [gland], [gland], {'newLabelVal': 3})
+        graph.add('ImageLabelCombine', combine, [gland, capsule, combined], [gland, capsule], [combined])
+        try:
+            graph.run(finalNodes=[combined])
+        except RuntimeError:
+            pass
+        return [stage['action'] for stage in graph.stages], capsule, graph.stages[0]['key']
+
+    actions, capsule, centerKey = runGraph(False, interrupted=True)
+    self.assertEqual( actions, ['run', 'run', 'run', 'run'] )
+    centeredOrigin = capsule.GetOrigin()
+    # the geometry stage is stored as its matrix change, the uncached threshold is not stored at all
+    self.assertEqual( os.listdir(RunCheckpoint(checkpointDirectory, 'PreProcessTest', '0', True).stages.lookup(centerKey)), ['entry.json'] )
+
+    actions, capsule, centerKey = runGraph(True)
+    self.assertEqual( actions, ['load', 'run', 'load', 'run'] )
+    for resumedValue, centeredValue in zip(capsule.GetOrigin(), centeredOrigin):
+        self.assertAlmostEqual( resumedValue, centeredValue )
+    self.assertEqual( set(numpy.unique(PreProcessLogic().arrayFromVolume(combined))), set([0, 3, 4]) )
+
+    checkpoint = RunCheckpoint(checkpointDirectory, 'PreProcessTest', '1')
+    checkpoint.writeRecord('Trial', {'similarities': [0.5]})
+    self.assertEqual( checkpoint.readRecord('Trial'), None ) # not resuming
+    self.assertEqual( RunCheckpoint(checkpointDirectory, 'PreProcessTest', '1', resume=True).readRecord('Trial'), {'similarities': [0.5]} )
+    self.assertEqual( os.listdir(checkpoint.recordDirectory), ['Trial.json'] ) # no partial files left
+    RunCheckpoint(checkpointDirectory, 'PreProcessTest', '1') # a new run without resume starts from an empty checkpoint
+    self.assertFalse( os.path.isfile(checkpoint.recordPath('Trial')) )
+    shutil.rmtree(checkpointDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_PreProcess13(self):
+    """ Checks that the SimpleITK bridge gives the same images as sitkUtils on an oblique grid and writes results into the existing image data
+    """
+    self.delayDisplay("Starting the SimpleITK bridge test")
+
+    import sitkUtils
+    label = self.createSyntheticLabel('label', (40,52,30), (20,16,12), 1)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    rotation = vtk.vtkTransform()
+    rotation.RotateZ(20)
+    rotation.Translate(-10.0, 4.0, 2.5)
+    rotation.Scale(0.5, 0.6, 0.8)
+    rotation.GetMatrix(ijkToRAS)
+    label.SetIJKToRASMatrix(ijkToRAS)
+
+    bridge = SimpleITKBridge()
+    bridgeImage = bridge.imageFromVolume(label)
+    sitkUtilsImage = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(label.GetName()))
+    self.assertEqual( bridgeImage.GetSize(), sitkUtilsImage.GetSize() )
+    for bridgeValue, sitkUtilsValue in zip(bridgeImage.GetOrigin() + bridgeImage.GetSpacing() + bridgeImage.GetDirection(),
+                                           sitkUtilsImage.GetOrigin() + sitkUtilsImage.GetSpacing() + sitkUtilsImage.GetDirection()):
+        self.assertAlmostEqual( bridgeValue, sitkUtilsValue, places=5 )
+    self.assertTrue( numpy.array_equal(sitk.GetArrayFromImage(bridgeImage), sitk.GetArrayFromImage(sitkUtilsImage)) )
+
+    # A result of the same size and type is written into the image data the output already has
+    output = self.createSyntheticLabel('output', (0,0,0), (1,1,1), 0)
+    imageData = output.GetImageData()
+    bridge.writeVolume(output, sitk.BinaryDilate(bridgeImage, 1))
+    self.assertTrue( output.GetImageData() is imageData )
+    for outputSpacing, labelSpacing in zip(output.GetSpacing(), label.GetSpacing()):
+        self.assertAlmostEqual( outputSpacing, labelSpacing, places=5 )
+    self.assertTrue( numpy.count_nonzero(PreProcessLogic().arrayFromVolume(output)) > numpy.count_nonzero(PreProcessLogic().arrayFromVolume(label)) )
+
+    self.assertEqual( [call for call, name, bytesCopied in bridge.calls], ['imageFromVolume', 'writeVolume'] )
+    self.assertEqual( bridge.calls[0][2], PreProcessLogic().arrayFromVolume(label).nbytes ) # reads copy once
+    self.assertTrue( bridge.report() <= 2*PreProcessLogic().arrayFromVolume(label).nbytes ) # at most one copy in and one copy out
     self.delayDisplay('Test passed!')
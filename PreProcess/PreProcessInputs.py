@@ -0,0 +1,54 @@
+import os
+
+#
+# Input file layout of the invivo patient directories read by PreProcess.
+#
+# Kept free of Slicer imports so the plain python batch runner (Scripts/PreProcessBatch.py) can check the input files
+# of all patients without starting Slicer. PreProcessLogic maps the input kinds to the slicer.util loaders
+#
+
+dataRoot = '/luscinia/ProstateStudy' # location of the invivo patient directories
+
+
+def usInputPaths(PatientNumber, dataRoot=dataRoot):
+  """ Returns (full filepath, kind) for each Ultrasound input in the order returned by PreProcessLogic.loadUSInputs,
+  kind being 'volume', 'label' or 'model'
+  """
+  slicerPath = dataRoot+'/invivo/Patient'+PatientNumber+'/slicer/'
+  return [(slicerPath+'ARFI_Norm_HistEq.nii.gz', 'volume'),
+          (slicerPath+'Bmode.nii.gz',            'volume'),
+          (slicerPath+'ARFI_CC_Mask.nii.gz',     'label'),
+          (slicerPath+'us_cap.vtk',              'model'),
+          (slicerPath+'us_cg.vtk',               'model'),
+          (slicerPath+'us_urethra.vtk',          'model'),
+          (slicerPath+'us_lesion1.vtk',          'model')]
+
+
+def mrInputPaths(PatientNumber, dataRoot=dataRoot):
+  """ Returns (full filepath, kind) for each MRI input in the order returned by PreProcessLogic.loadMRInputs
+  """
+  mriPath = dataRoot+'/invivo/Patient'+PatientNumber+'/MRI_Images/'
+  return [(mriPath+'T2/P'+PatientNumber+'_no_PHI.nii.gz',               'volume'),
+          (mriPath+'P'+PatientNumber+'_segmentation_final.nrrd',        'label'),
+          (mriPath+'Anatomy/P'+PatientNumber+'_zones_seg.nii.gz',       'label'),
+          (mriPath+'Anatomy/P'+PatientNumber+'_urethra_seg.nrrd',       'label'),
+          (mriPath+'Cancer/P'+PatientNumber+'_lesion1_seg.nrrd',        'label')]
+
+
+def checkInputFiles(PatientNumbers, dataRoot=dataRoot):
+  """ Checks with os.stat that every expected input file of each patient exists and is not empty.
+  Returns {PatientNumber: [missing filepaths]} and a list of (PatientNumber, filepath, size or None if missing)
+  """
+  missingInputs = {}
+  fileSizes = []
+  for PatientNumber in PatientNumbers:
+    missingInputs[PatientNumber] = []
+    for filePath, kind in usInputPaths(PatientNumber, dataRoot) + mrInputPaths(PatientNumber, dataRoot):
+      try:
+        fileSize = os.stat(filePath).st_size
+      except OSError:
+        fileSize = None
+      if not fileSize:
+        missingInputs[PatientNumber].append(filePath)
+      fileSizes.append((PatientNumber, filePath, fileSize))
+  return missingInputs, fileSizes
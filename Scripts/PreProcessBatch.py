@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# Headless batch preprocessing over a list or range of patients.
+#
+# The batch runner (plain python) starts one headless Slicer process per patient, at most --workers at a time:
+#
+#   python PreProcessBatch.py --slicer /opt/Slicer/Slicer --patients 59-70,75 --workers 4 --itk-threads 2 --save
+#
+# Each worker runs this same script inside Slicer (--no-main-window --python-script) in worker mode,
+# calls PreProcessLogic.run(PatientNumber, SaveDataBool) and writes its result to a JSON file.
+# Each worker also writes a stage trace (Chrome trace JSON and CSV) of its patient to the trace directory.
+# With --checkpoint-directory every completed stage is checkpointed per patient, and --resume continues interrupted patients from there.
+# A summary table of time per patient and any failures is printed when all patients are done.
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+scriptPath = os.path.abspath(sys.argv[0]) # also set when run by Slicer with --python-script
+repositoryDirectory = os.path.dirname(os.path.dirname(scriptPath))
+
+
+def parsePatientNumbers(patientSpecification):
+  """ Parses patient numbers such as "59-70,75,80" into a sorted list of patient number strings
+  """
+  patientNumbers = set()
+  for part in patientSpecification.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    if '-' in part:
+      first, last = [int(x) for x in part.split('-', 1)]
+      patientNumbers.update(range(first, last+1))
+    else:
+      patientNumbers.add(int(part))
+  return [str(x) for x in sorted(patientNumbers)]
+
+
+def runWorker(arguments):
+  """ Runs PreProcessLogic.run for one patient inside Slicer and writes the result JSON
+  """
+  result = {'patient': arguments.patient, 'status': 'failed', 'time': 0.0, 'error': ''}
+  start_time = time.time()
+  try:
+    # Make the module importable even if the extension is not on the Slicer module search paths
+    sys.path.insert(0, os.path.join(repositoryDirectory, 'PreProcess'))
+    from PreProcess import PreProcessLogic, PreProcessStageCache
+
+    stageCache = None if arguments.no_cache else PreProcessStageCache(arguments.cache_directory)
+    logic = PreProcessLogic(stageCache=stageCache, saveCompression=arguments.compression, traceDirectory=arguments.trace_directory,
+                            mrAlignment=arguments.mr_alignment, checkpointDirectory=arguments.checkpoint_directory, resume=arguments.resume)
+    if logic.run(arguments.patient, arguments.save):
+      result['status'] = 'ok'
+    else:
+      result['error'] = 'not all inputs supplied'
+  except Exception:
+    result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    traceback.print_exc()
+  result['time'] = time.time() - start_time
+
+  with open(arguments.result, 'w') as resultFile:
+    json.dump(result, resultFile)
+  sys.exit(0 if result['status'] == 'ok' else 1)
+
+
+def runPreflight(patientNumbers):
+  """ Checks the input files of all patients with os.stat in this process (no Slicer needed) and returns {patient: [missing filepaths]}
+  """
+  sys.path.insert(0, os.path.join(repositoryDirectory, 'PreProcess'))
+  from PreProcessInputs import checkInputFiles
+
+  missingInputs, fileSizes = checkInputFiles(patientNumbers)
+  print('Preflight check: %i of %i input files present' % (len([fileSize for patient, filePath, fileSize in fileSizes if fileSize]), len(fileSizes)))
+  return missingInputs
+
+
+def runPatient(arguments, patientNumber, logDirectory):
+  """ Starts a headless Slicer worker for one patient and returns its result
+  """
+  resultPath = os.path.join(logDirectory, 'Patient%s.json' % patientNumber)
+  logPath = os.path.join(logDirectory, 'Patient%s.log' % patientNumber)
+  command = [arguments.slicer, '--no-splash', '--no-main-window', '--python-script', scriptPath,
+             '--worker', '--patient', patientNumber, '--result', resultPath]
+  if arguments.save:
+    command.append('--save')
+  if arguments.no_cache:
+    command.append('--no-cache')
+  command += ['--compression', arguments.compression, '--trace-directory', arguments.trace_directory or logDirectory,
+              '--mr-alignment', arguments.mr_alignment]
+  if arguments.cache_directory:
+    command += ['--cache-directory', arguments.cache_directory]
+  if arguments.checkpoint_directory:
+    command += ['--checkpoint-directory', arguments.checkpoint_directory]
+  if arguments.resume:
+    command.append('--resume')
+
+  # Limit ITK threads (in process filters and CLI modules) so workers do not oversubscribe the cores
+  environment = dict(os.environ)
+  if arguments.itk_threads:
+    environment['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(arguments.itk_threads)
+
+  if os.path.isfile(resultPath):
+    os.remove(resultPath) # left over from an earlier batch
+
+  start_time = time.time()
+  with open(logPath, 'w') as logFile:
+    returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment)
+
+  if os.path.isfile(resultPath):
+    with open(resultPath, 'r') as resultFile:
+      return json.load(resultFile)
+  return {'patient': patientNumber, 'status': 'failed', 'time': time.time()-start_time,
+          'error': 'Slicer exited with code %i without a result (see %s)' % (returnCode, logPath)}
+
+
+def printSummary(results):
+  """ Prints a table of time per patient and any failures
+  """
+  print('\n%-10s %-8s %10s  %s' % ('Patient', 'Status', 'Time (s)', 'Error'))
+  print('-'*60)
+  for result in results:
+    print('%-10s %-8s %10.1f  %s' % (result['patient'], result['status'], result['time'], result['error']))
+  print('-'*60)
+  failed = [result for result in results if result['status'] != 'ok']
+  print('%i patients processed, %i failed, %0.1f s total worker time' % (len(results), len(failed), sum(result['time'] for result in results)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run PreProcess over a list or range of patients in parallel headless Slicer processes.')
+  parser.add_argument('--patients', help='patient numbers, e.g. "59-70,75"')
+  parser.add_argument('--slicer', default='Slicer', help='path to the Slicer executable')
+  parser.add_argument('--workers', type=int, default=2, help='number of Slicer processes run at once')
+  parser.add_argument('--itk-threads', type=int, default=0, help='ITK threads per worker (0 keeps the ITK default)')
+  parser.add_argument('--save', action='store_true', help='save registration inputs to disk (SaveDataBool)')
+  parser.add_argument('--compression', default='full', choices=['full', 'fast', 'raw'], help='compression of saved NRRD labelmaps')
+  parser.add_argument('--mr-alignment', default='bounds', choices=['bounds', 'centroid', 'model'], help='MR to US capsule alignment used by MR_translate')
+  parser.add_argument('--no-cache', action='store_true', help='do not reuse or store cached stage outputs')
+  parser.add_argument('--cache-directory', default=None, help='stage cache directory shared by the workers')
+  parser.add_argument('--checkpoint-directory', default=None, help='directory for per patient checkpoints of completed stages')
+  parser.add_argument('--resume', action='store_true', help='reload the checkpoints of interrupted patients and run only their unfinished stages')
+  parser.add_argument('--log-directory', default=None, help='directory for worker logs and results')
+  parser.add_argument('--trace-directory', default=None, help='directory for the per patient stage traces (defaults to the log directory)')
+  parser.add_argument('--summary', default=None, help='optional CSV file for the summary table')
+  parser.add_argument('--skip-preflight', action='store_true', help='do not check that all input files exist before starting the workers')
+  # worker mode (used by the batch runner when starting Slicer)
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--patient', help=argparse.SUPPRESS)
+  parser.add_argument('--result', help=argparse.SUPPRESS)
+  arguments = parser.parse_args()
+
+  if arguments.worker:
+    runWorker(arguments)
+    return
+
+  if not arguments.patients:
+    parser.error('--patients is required')
+  if arguments.resume and not arguments.checkpoint_directory:
+    parser.error('--resume needs the --checkpoint-directory of the interrupted batch')
+  patientNumbers = parsePatientNumbers(arguments.patients)
+  logDirectory = arguments.log_directory or tempfile.mkdtemp(prefix='PreProcessBatch-')
+  if not os.path.isdir(logDirectory):
+    os.makedirs(logDirectory)
+
+  start_time = time.time()
+
+  # Patients with missing input files are reported without starting a worker for them
+  results = []
+  if not arguments.skip_preflight:
+    missingInputs = runPreflight(patientNumbers)
+    for patientNumber in patientNumbers:
+      missingFiles = missingInputs.get(patientNumber, [])
+      if missingFiles:
+        results.append({'patient': patientNumber, 'status': 'missing', 'time': 0.0,
+                        'error': '%i input files missing, e.g. %s' % (len(missingFiles), missingFiles[0])})
+    patientNumbers = [patientNumber for patientNumber in patientNumbers if not missingInputs.get(patientNumber)]
+
+  print('Processing %i patients with %i workers (logs in %s)' % (len(patientNumbers), arguments.workers, logDirectory))
+  pool = ThreadPool(arguments.workers) # each thread waits on one Slicer process
+  results += pool.map(lambda patientNumber: runPatient(arguments, patientNumber, logDirectory), patientNumbers)
+  pool.close()
+  pool.join()
+  results.sort(key=lambda result: int(result['patient']))
+
+  printSummary(results)
+  print('Overall Elapsed Time: %0.1f seconds' % (time.time()-start_time))
+
+  if arguments.summary:
+    import csv
+    with open(arguments.summary, 'w') as summaryFile:
+      csvWriter = csv.writer(summaryFile)
+      csvWriter.writerow(['Patient', 'Status', 'Time', 'Error'])
+      for result in results:
+        csvWriter.writerow([result['patient'], result['status'], result['time'], result['error']])
+
+  sys.exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+#
+# File based work queue for running PreProcess and CustomRegister jobs with headless Slicer workers on several nodes.
+#
+# The queue is a directory on a filesystem shared by the nodes (e.g. next to the ProstateStudy data) with one JSON file per job:
+#
+#   <queue>/pending/   jobs waiting for a worker
+#   <queue>/claimed/   jobs being run (the file is touched by its worker as a heartbeat)
+#   <queue>/done/      finished jobs with their result
+#   <queue>/failed/    jobs that failed --max-attempts times
+#   <queue>/results/   job inputs, worker logs, stage traces and CSV results, one directory per job
+#
+# A worker claims a job by renaming it from pending to claimed. Renames are atomic (also on NFS) so exactly one worker gets each job.
+# Claimed jobs whose heartbeat is older than --stale-after seconds (crashed Slicer, lost node) are moved back to pending by any worker
+# and retried, from their checkpoint if a --checkpoint-directory is given. File ages are compared with the clock of the file server.
+#
+#   python WorkQueue.py --queue /luscinia/ProstateStudy/Queue submit-preprocess --patients 59-70,75 --save --checkpoint-directory /luscinia/ProstateStudy/Checkpoints
+#   python WorkQueue.py --queue /luscinia/ProstateStudy/Queue submit-register --patients 59-70
+#   python WorkQueue.py --queue /luscinia/ProstateStudy/Queue worker --slicer /opt/Slicer/Slicer --workers 4 --itk-threads 2   (on every node)
+#   python WorkQueue.py --queue /luscinia/ProstateStudy/Queue status
+#
+# The queue itself can be tested without Slicer: selftest starts several local worker processes on sleep jobs, kills one of them
+# while it runs a job and checks that every job finishes exactly once:
+#
+#   python WorkQueue.py --queue /tmp/TestQueue selftest --workers 3 --jobs 12
+#
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing.pool import ThreadPool
+
+scriptPath = os.path.abspath(sys.argv[0]) # also set when run by Slicer with --python-script
+repositoryDirectory = os.path.dirname(os.path.dirname(scriptPath))
+sys.path.insert(0, os.path.dirname(scriptPath))
+from PreProcessBatch import parsePatientNumbers
+
+
+class WorkQueue(object):
+  """ Job queue stored as JSON files in a shared directory (see the header of this script)
+  """
+
+  states = ('pending', 'claimed', 'done', 'failed')
+
+  def __init__(self, queueDirectory, staleAfter=300.0, maxAttempts=3):
+    self.queueDirectory = queueDirectory
+    self.staleAfter = staleAfter
+    self.maxAttempts = maxAttempts
+    for directoryName in self.states + ('results', 'tmp'):
+      directory = os.path.join(queueDirectory, directoryName)
+      if not os.path.isdir(directory):
+        try:
+          os.makedirs(directory)
+        except OSError:
+          pass # created by another worker in the meantime
+
+  def jobPath(self, state, jobName):
+    return os.path.join(self.queueDirectory, state, jobName + '.json')
+
+  def resultDirectory(self, jobName):
+    return os.path.join(self.queueDirectory, 'results', jobName)
+
+  def jobNames(self, state):
+    return sorted(fileName[:-len('.json')] for fileName in os.listdir(os.path.join(self.queueDirectory, state)) if fileName.endswith('.json'))
+
+  def readJob(self, filePath):
+    try:
+      with open(filePath, 'r') as jobFile:
+        return json.load(jobFile)
+    except (IOError, OSError, ValueError):
+      return None # moved by another worker or still being written
+
+  def writeJob(self, filePath, job):
+    """ Writes a job file to a temporary name first and moves it into place, so other workers never read a partial file
+    """
+    partialPath = os.path.join(self.queueDirectory, 'tmp', '%s.%s' % (os.path.basename(filePath), uuid.uuid4().hex))
+    with open(partialPath, 'w') as jobFile:
+      json.dump(job, jobFile, indent=2, sort_keys=True)
+    os.rename(partialPath, filePath)
+
+  def serverTime(self):
+    """ Returns the current time of the file server (modification time of a freshly touched file), so nodes with skewed clocks agree on stale jobs
+    """
+    probePath = os.path.join(self.queueDirectory, 'tmp', 'clock.%s.%i' % (socket.gethostname(), os.getpid()))
+    with open(probePath, 'a'):
+      os.utime(probePath, None)
+    return os.path.getmtime(probePath)
+
+  def submit(self, jobName, kind, parameters):
+    """ Adds a job unless it is already pending, claimed or done (failed jobs are submitted again). Returns true if the job was added
+    """
+    if any(os.path.isfile(self.jobPath(state, jobName)) for state in ('pending', 'claimed', 'done')):
+      return False
+    if os.path.isfile(self.jobPath('failed', jobName)):
+      os.remove(self.jobPath('failed', jobName))
+    job = {'name': jobName, 'kind': kind, 'parameters': parameters, 'attempts': 0, 'history': [], 'submitted': time.time()}
+    self.writeJob(self.jobPath('pending', jobName), job)
+    return True
+
+  def claim(self, workerName):
+    """ Claims the first pending job for a worker and returns it, or None if there is no pending job
+    """
+    for jobName in self.jobNames('pending'):
+      claimedPath = self.jobPath('claimed', jobName)
+      try:
+        os.rename(self.jobPath('pending', jobName), claimedPath)
+        # the rename keeps the mtime of the pending file, touch it so a job that waited longer than staleAfter is not requeued at once
+        os.utime(claimedPath, None)
+      except OSError:
+        continue # claimed by another worker first (or taken back by requeueStale, which returns it to pending)
+      job = self.readJob(claimedPath)
+      if job is None:
+        continue
+      job['attempts'] += 1
+      job['worker'] = workerName
+      job['claim'] = uuid.uuid4().hex
+      job['history'].append({'worker': workerName, 'claimed': time.time()})
+      self.writeJob(claimedPath, job)
+      return job
+    return None
+
+  def ownsClaim(self, job):
+    claimedJob = self.readJob(self.jobPath('claimed', job['name']))
+    return claimedJob is not None and claimedJob.get('claim') == job['claim']
+
+  def heartbeat(self, job):
+    """ Touches the claimed job file. Returns false if the claim was lost (the job was found stale and handed to another worker)
+    """
+    if not self.ownsClaim(job):
+      return False
+    try:
+      os.utime(self.jobPath('claimed', job['name']), None)
+    except OSError:
+      return False
+    return True
+
+  def complete(self, job, result):
+    """ Moves a claimed job to done with its result. Returns false without writing anything if the claim was lost
+    """
+    if not self.ownsClaim(job):
+      return False
+    job['result'] = result
+    job['history'][-1]['finished'] = time.time()
+    self.writeJob(self.jobPath('done', job['name']), job)
+    self.releaseClaim(job)
+    return True
+
+  def fail(self, job, error):
+    """ Moves a claimed job back to pending for another attempt, or to failed once it has run maxAttempts times. Returns the new state,
+    or 'lost' without writing anything if the claim was lost (the job was requeued by another worker)
+    """
+    if not self.ownsClaim(job):
+      return 'lost'
+    job['history'][-1]['finished'] = time.time()
+    job['history'][-1]['error'] = error
+    state = 'failed' if job['attempts'] >= self.maxAttempts else 'pending'
+    self.writeJob(self.jobPath(state, job['name']), dict((key, value) for key, value in job.items() if key != 'claim'))
+    self.releaseClaim(job)
+    return state
+
+  def releaseClaim(self, job):
+    if self.ownsClaim(job):
+      try:
+        os.remove(self.jobPath('claimed', job['name']))
+      except OSError:
+        pass
+
+  def requeueStale(self):
+    """ Moves claimed jobs without a heartbeat for staleAfter seconds back to pending (or to failed after maxAttempts). Returns their names
+    """
+    now = self.serverTime()
+    requeued = []
+    for jobName in self.jobNames('claimed'):
+      claimedPath = self.jobPath('claimed', jobName)
+      try:
+        if now - os.path.getmtime(claimedPath) < self.staleAfter:
+          continue
+      except OSError:
+        continue # finished in the meantime
+      # Take the stale job out of claimed first so only one worker requeues it
+      stalePath = os.path.join(self.queueDirectory, 'tmp', '%s.stale.%s' % (jobName, uuid.uuid4().hex))
+      try:
+        os.rename(claimedPath, stalePath)
+      except OSError:
+        continue
+      try:
+        touched = now - os.path.getmtime(stalePath) < self.staleAfter
+      except OSError:
+        continue
+      if touched:
+        # claimed or heartbeat between the age check and the rename: hand it back unless its worker already rewrote the claimed file
+        if not os.path.exists(claimedPath):
+          os.rename(stalePath, claimedPath)
+        else:
+          os.remove(stalePath)
+        continue
+      job = self.readJob(stalePath)
+      os.remove(stalePath)
+      if job is None:
+        continue
+      if 'claim' in job:
+        job['history'][-1]['error'] = 'heartbeat lost'
+        state = 'failed' if job['attempts'] >= self.maxAttempts else 'pending'
+        del job['claim']
+      else:
+        state = 'pending' # taken before its claim was recorded (the claiming worker gives it up), not a failed attempt
+      self.writeJob(self.jobPath(state, jobName), job)
+      requeued.append(jobName)
+    return requeued
+
+  def counts(self):
+    return dict((state, len(self.jobNames(state))) for state in self.states)
+
+
+#
+# Running jobs
+#
+
+def runSleepJob(queue, job):
+  """ Test job that runs in the worker process without Slicer (used by selftest)
+  """
+  endTime = time.time() + job['parameters']['seconds']
+  while time.time() < endTime:
+    time.sleep(0.1)
+  return {'status': 'ok', 'worker': job['worker'], 'pid': os.getpid()}
+
+
+def runSlicerJob(queue, job, arguments):
+  """ Runs a preprocess or register job in a headless Slicer process, touching the job file until Slicer exits.
+  Slicer is stopped if the claim is lost. Returns the result the Slicer process wrote
+  """
+  resultDirectory = queue.resultDirectory(job['name'])
+  if not os.path.isdir(resultDirectory):
+    os.makedirs(resultDirectory)
+  attemptName = 'attempt%i' % job['attempts']
+  jobPath = os.path.join(resultDirectory, attemptName + '-job.json')
+  resultPath = os.path.join(resultDirectory, attemptName + '-result.json')
+  logPath = os.path.join(resultDirectory, attemptName + '.log')
+  with open(jobPath, 'w') as jobFile:
+    json.dump(job, jobFile)
+
+  command = [arguments.slicer, '--no-splash', '--no-main-window', '--python-script', scriptPath, '--queue', arguments.queue,
+             'run-job', '--job', jobPath, '--result', resultPath]
+  # Limit ITK threads (in process filters and CLI modules) so workers do not oversubscribe the cores
+  environment = dict(os.environ)
+  if arguments.itk_threads:
+    environment['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(arguments.itk_threads)
+
+  with open(logPath, 'w') as logFile:
+    # the CustomRegister experiment writes its CSV results to the working directory
+    slicerProcess = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment, cwd=resultDirectory)
+    while slicerProcess.poll() is None:
+      time.sleep(min(5.0, queue.staleAfter/4.0))
+      if not queue.heartbeat(job):
+        slicerProcess.kill()
+        slicerProcess.wait()
+        return {'status': 'lost', 'error': 'claim lost (heartbeat too late), job handed to another worker'}
+
+  if os.path.isfile(resultPath):
+    with open(resultPath, 'r') as resultFile:
+      return json.load(resultFile)
+  return {'status': 'failed', 'error': 'Slicer exited with code %i without a result (see %s)' % (slicerProcess.returncode, logPath)}
+
+
+def heartbeatWhile(queue, job, function):
+  """ Runs function() in this process while a thread touches the job file
+  """
+  finished = threading.Event()
+  def beat():
+    while not finished.wait(min(5.0, queue.staleAfter/4.0)):
+      queue.heartbeat(job)
+  heartbeatThread = threading.Thread(target=beat)
+  heartbeatThread.daemon = True
+  heartbeatThread.start()
+  try:
+    return function()
+  finally:
+    finished.set()
+
+
+def runWorker(arguments, workerName):
+  """ Claims and runs jobs until the queue is empty (with --exit-when-empty) or forever
+  """
+  queue = WorkQueue(arguments.queue, arguments.stale_after, arguments.max_attempts)
+  while True:
+    for jobName in queue.requeueStale():
+      print('%s: requeued stale job %s' % (workerName, jobName))
+    job = queue.claim(workerName)
+    if job is None:
+      counts = queue.counts()
+      if arguments.exit_when_empty and not counts['pending'] and not counts['claimed']:
+        return
+      time.sleep(arguments.poll_interval)
+      continue
+
+    print('%s: running %s (attempt %i)' % (workerName, job['name'], job['attempts']))
+    start_time = time.time()
+    try:
+      if job['kind'] == 'sleep':
+        result = heartbeatWhile(queue, job, lambda: runSleepJob(queue, job))
+      else:
+        result = runSlicerJob(queue, job, arguments)
+    except Exception:
+      result = {'status': 'failed', 'error': traceback.format_exc().strip().splitlines()[-1]}
+    result['time'] = time.time() - start_time
+
+    if result['status'] == 'ok':
+      if queue.complete(job, result):
+        print('%s: finished %s (%0.1f s)' % (workerName, job['name'], result['time']))
+      else:
+        print('%s: finished %s but its claim was lost, result dropped' % (workerName, job['name']))
+    elif result['status'] != 'lost':
+      print('%s: %s failed, %s (%s)' % (workerName, job['name'], queue.fail(job, result['error']), result['error']))
+
+
+def runWorkers(arguments):
+  """ Runs --workers worker threads in this process, each one waits on its own Slicer process
+  """
+  workerNames = ['%s-%i-%i' % (socket.gethostname(), os.getpid(), index) for index in range(arguments.workers)]
+  pool = ThreadPool(arguments.workers)
+  pool.map(lambda workerName: runWorker(arguments, workerName), workerNames)
+  pool.close()
+  pool.join()
+
+
+#
+# Jobs inside Slicer (run-job)
+#
+
+def runJobInSlicer(arguments):
+  """ Runs one preprocess or register job in this Slicer process and writes the result JSON
+  """
+  with open(arguments.job, 'r') as jobFile:
+    job = json.load(jobFile)
+  parameters = job['parameters']
+  result = {'status': 'failed', 'error': ''}
+  try:
+    # Make the modules importable even if the extension is not on the Slicer module search paths
+    sys.path.insert(0, os.path.join(repositoryDirectory, 'PreProcess'))
+    sys.path.insert(0, os.path.join(repositoryDirectory, 'CustomRegister'))
+    # a retried job continues from the checkpoint of the previous attempt
+    resume = job['attempts'] > 1 and bool(parameters.get('checkpointDirectory'))
+    traceDirectory = os.path.dirname(os.path.abspath(arguments.job))
+    if job['kind'] == 'preprocess':
+      if runPreProcessJob(parameters, traceDirectory, resume):
+        result['status'] = 'ok'
+      else:
+        result['error'] = 'not all inputs supplied'
+    elif job['kind'] == 'register':
+      runRegisterJob(parameters, traceDirectory, resume)
+      result['status'] = 'ok'
+    else:
+      result['error'] = 'unknown job kind %s' % job['kind']
+  except Exception:
+    result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    traceback.print_exc()
+
+  with open(arguments.result, 'w') as resultFile:
+    json.dump(result, resultFile)
+  sys.exit(0 if result['status'] == 'ok' else 1)
+
+
+def runPreProcessJob(parameters, traceDirectory, resume):
+  from PreProcess import PreProcessLogic, PreProcessStageCache
+  stageCache = PreProcessStageCache(parameters['cacheDirectory']) if parameters.get('cache', True) else None
+  logic = PreProcessLogic(stageCache=stageCache, saveCompression=parameters.get('compression', 'full'), traceDirectory=traceDirectory,
+                          mrAlignment=parameters.get('mrAlignment', 'bounds'), checkpointDirectory=parameters.get('checkpointDirectory'), resume=resume)
+  return logic.run(parameters['patient'], parameters.get('save', False))
+
+
+def runRegisterJob(parameters, traceDirectory, resume):
+  """ Loads the saved registration inputs of a patient (US labels fixed, MR labels moving) and runs the CustomRegister experiment on them
+  """
+  import slicer
+  from PreProcess import PreProcessLogic, PreProcessStageCache
+  from CustomRegister import CustomRegisterLogic
+  inputDirectory = parameters.get('inputDirectory') or '%s/invivo/Patient%s/Registration/RegistrationInputs' % (PreProcessLogic.dataRoot, parameters['patient'])
+
+  parameterNode = slicer.vtkMRMLScriptedModuleNode()
+  slicer.mrmlScene.AddNode(parameterNode)
+  labelFiles = [('FixedLabelNodeID', 'us_registration-label.nrrd'), ('MovingLabelNodeID', 'mr_registration-label.nrrd')]
+  for index, labelType in enumerate(['registration', 'cg', 'urethra', 'indexlesion']):
+    labelFiles.append(('FixedSimilarityLabel%iNodeID' % (index+1), 'us_%s-label.nrrd' % labelType))
+    labelFiles.append(('MovingSimilarityLabel%iNodeID' % (index+1), 'mr_%s-label.nrrd' % labelType))
+  for attributeName, fileName in labelFiles:
+    loaded, labelNode = slicer.util.loadLabelVolume(os.path.join(inputDirectory, fileName), returnNode=True)
+    if not loaded:
+      raise IOError('could not load %s' % os.path.join(inputDirectory, fileName))
+    parameterNode.SetAttribute(attributeName, labelNode.GetID())
+
+  affineTransformNode = slicer.vtkMRMLLinearTransformNode()
+  affineTransformNode.SetName('Affine Transform')
+  slicer.mrmlScene.AddNode(affineTransformNode)
+  parameterNode.SetAttribute('AffineTransformNodeID', affineTransformNode.GetID())
+
+  # A worker started with --itk-threads keeps its registrations within that budget, one at a time
+  itkThreads = int(os.environ.get('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 0))
+  sweepParameters = {'maxConcurrentRegistrations': 1, 'registrationThreads': itkThreads} if itkThreads else {}
+  distanceMapCache = PreProcessStageCache(parameters['cacheDirectory']) if parameters.get('cache', True) else None
+  logic = CustomRegisterLogic(distanceMapCache=distanceMapCache, **sweepParameters)
+  logic.run(parameterNode, traceDirectory=traceDirectory, checkpointDirectory=parameters.get('checkpointDirectory'),
+            resume=resume, patient=parameters['patient'])
+
+
+#
+# Self test with local worker processes
+#
+
+def runSelfTest(arguments):
+  """ Starts local worker processes on sleep jobs, kills one of them while it runs a job and checks that every job finishes once
+  and the interrupted job is retried
+  """
+  if os.path.isdir(arguments.queue):
+    shutil.rmtree(arguments.queue)
+  queue = WorkQueue(arguments.queue, staleAfter=2.0, maxAttempts=3)
+  for index in range(arguments.jobs):
+    queue.submit('sleep%03i' % index, 'sleep', {'seconds': 1.0})
+  # Jobs that waited in pending for longer than the stale time must not be requeued as soon as they are claimed
+  submittedTime = queue.serverTime() - 60.0
+  for jobName in queue.jobNames('pending'):
+    os.utime(queue.jobPath('pending', jobName), (submittedTime, submittedTime))
+
+  workerCommand = [sys.executable, scriptPath, '--queue', arguments.queue, 'worker', '--workers', '1', '--exit-when-empty',
+                   '--stale-after', '2', '--poll-interval', '0.2']
+  workers = [subprocess.Popen(workerCommand) for index in range(arguments.workers)]
+
+  # Kill the first worker as soon as it has claimed a job, leaving the job claimed without a heartbeat
+  killedPid = workers[0].pid
+  while not any(job and job.get('worker', '').endswith('-%i-0' % killedPid) for job in
+                [queue.readJob(queue.jobPath('claimed', jobName)) for jobName in queue.jobNames('claimed')]):
+    time.sleep(0.05)
+  os.kill(killedPid, signal.SIGKILL)
+  for worker in workers:
+    worker.wait()
+
+  counts = queue.counts()
+  doneJobs = [queue.readJob(queue.jobPath('done', jobName)) for jobName in queue.jobNames('done')]
+  retried = [job['name'] for job in doneJobs if job['attempts'] > 1]
+  print('Queue after the self test: %s, retried: %s' % (counts, ', '.join(retried)))
+  passed = counts == {'pending': 0, 'claimed': 0, 'done': arguments.jobs, 'failed': 0} and len(retried) == 1 and \
+           all(job['result']['pid'] != killedPid for job in doneJobs) and all(worker.returncode == 0 for worker in workers[1:])
+  print('Self test %s' % ('passed' if passed else 'FAILED'))
+  sys.exit(0 if passed else 1)
+
+
+#
+# Command line
+#
+
+def submitJobs(arguments, kind):
+  queue = WorkQueue(arguments.queue)
+  submitted = 0
+  for patientNumber in parsePatientNumbers(arguments.patients):
+    parameters = {'patient': patientNumber, 'checkpointDirectory': arguments.checkpoint_directory,
+                  'cache': not arguments.no_cache, 'cacheDirectory': arguments.cache_directory}
+    if kind == 'preprocess':
+      parameters.update({'save': arguments.save, 'compression': arguments.compression, 'mrAlignment': arguments.mr_alignment})
+    else:
+      parameters['inputDirectory'] = arguments.input_directory and arguments.input_directory.replace('{patient}', patientNumber)
+    if queue.submit('%s-Patient%s' % (kind, patientNumber), kind, parameters):
+      submitted += 1
+  print('%i %s jobs submitted, queue: %s' % (submitted, kind, queue.counts()))
+
+
+def printStatus(arguments):
+  queue = WorkQueue(arguments.queue)
+  print('%-28s %-8s %8s  %-28s %s' % ('Job', 'State', 'Attempts', 'Worker', 'Error'))
+  print('-'*90)
+  for state in WorkQueue.states:
+    for jobName in queue.jobNames(state):
+      job = queue.readJob(queue.jobPath(state, jobName)) or {'attempts': 0, 'history': []}
+      lastAttempt = job['history'][-1] if job['history'] else {}
+      print('%-28s %-8s %8i  %-28s %s' % (jobName, state, job['attempts'], lastAttempt.get('worker', ''), lastAttempt.get('error', '')))
+  print('-'*90)
+  print(queue.counts())
+
+
+def main():
+  parser = argparse.ArgumentParser(description='File based work queue for headless PreProcess and CustomRegister workers on several nodes.')
+  parser.add_argument('--queue', required=True, help='queue directory on a filesystem shared by all nodes')
+  commands = parser.add_subparsers(dest='command')
+
+  for kind in ('preprocess', 'register'):
+    submitParser = commands.add_parser('submit-' + kind, help='add one %s job per patient' % kind)
+    submitParser.add_argument('--patients', required=True, help='patient numbers, e.g. "59-70,75"')
+    submitParser.add_argument('--checkpoint-directory', default=None, help='per patient checkpoints, retried jobs resume from them')
+    submitParser.add_argument('--no-cache', action='store_true', help='do not reuse or store cached stage outputs (preprocess) or distance maps (register)')
+    submitParser.add_argument('--cache-directory', default=None, help='stage and distance map cache directory shared by the workers')
+    if kind == 'preprocess':
+      submitParser.add_argument('--save', action='store_true', help='save registration inputs to disk (SaveDataBool)')
+      submitParser.add_argument('--compression', default='full', choices=['full', 'fast', 'raw'], help='compression of saved NRRD labelmaps')
+      submitParser.add_argument('--mr-alignment', default='bounds', choices=['bounds', 'centroid', 'model'], help='MR to US capsule alignment used by MR_translate')
+    else:
+      submitParser.add_argument('--input-directory', default=None, help='registration inputs, {patient} is replaced by the patient number (defaults to the patient RegistrationInputs directory)')
+
+  workerParser = commands.add_parser('worker', help='claim and run jobs on this node')
+  workerParser.add_argument('--slicer', default='Slicer', help='path to the Slicer executable')
+  workerParser.add_argument('--workers', type=int, default=2, help='number of Slicer processes run at once on this node')
+  workerParser.add_argument('--itk-threads', type=int, default=0, help='ITK threads per worker (0 keeps the ITK default)')
+  workerParser.add_argument('--stale-after', type=float, default=300.0, help='seconds without heartbeat after which a claimed job is retried')
+  workerParser.add_argument('--max-attempts', type=int, default=3, help='attempts before a job is moved to failed')
+  workerParser.add_argument('--poll-interval', type=float, default=10.0, help='seconds between looks at an empty queue')
+  workerParser.add_argument('--exit-when-empty', action='store_true', help='stop once no job is pending or claimed')
+
+  commands.add_parser('status', help='print the state of every job')
+
+  selfTestParser = commands.add_parser('selftest', help='test the queue with local worker processes and sleep jobs (clears the queue directory)')
+  selfTestParser.add_argument('--workers', type=int, default=3, help='number of local worker processes')
+  selfTestParser.add_argument('--jobs', type=int, default=12, help='number of sleep jobs')
+
+  # run by the workers inside Slicer
+  runJobParser = commands.add_parser('run-job')
+  runJobParser.add_argument('--job', required=True)
+  runJobParser.add_argument('--result', required=True)
+  arguments = parser.parse_args()
+
+  if arguments.command in ('submit-preprocess', 'submit-register'):
+    submitJobs(arguments, arguments.command[len('submit-'):])
+  elif arguments.command == 'worker':
+    runWorkers(arguments)
+  elif arguments.command == 'status':
+    printStatus(arguments)
+  elif arguments.command == 'selftest':
+    runSelfTest(arguments)
+  elif arguments.command == 'run-job':
+    runJobInSlicer(arguments)
+
+
+if __name__ == '__main__':
+  main()